@@ -0,0 +1,131 @@
+"""
+Benchmark of JSON/YAML extraction from multi-kilobyte responses.
+The previous implementation (eval first, re-slicing the content for every tag)
+is kept here as a baseline. All JSON blocks are extracted with get_json_from_response
+in a loop and with iter_json_from_response.
+
+    python benchmarks/response_parser_benchmark.py
+"""
+import json
+import timeit
+
+import yaml
+
+from flow_prompt.response_parsers import response_parser
+from flow_prompt.response_parsers.response_parser import (
+    get_json_from_response,
+    get_yaml_from_response,
+    iter_json_from_response,
+)
+from flow_prompt.responses import AIResponse
+
+SIZES_KB = [2, 16, 64]
+
+
+def legacy_get_format_from_response(text, tags, start_from=0):
+    """tags are (start_tag, end_tag, include_tag)"""
+    content = text[start_from:]
+    for start_tag, end_tag, include_tag in tags:
+        start_ind = content.find(start_tag)
+        end_ind = content.find(end_tag, start_ind + len(start_tag))
+        if start_ind != -1:
+            if include_tag:
+                end_ind += len(end_tag)
+            else:
+                start_ind += len(start_tag)
+            return content[start_ind:end_ind].strip()
+    return None
+
+
+def legacy_get_json(text):
+    content = legacy_get_format_from_response(
+        text, [("```json", "\n```", 0), ("```json", "```", 0), ("{", "}", 1)]
+    )
+    try:
+        return eval(content)
+    except Exception:
+        return json.loads(content)
+
+
+def legacy_get_yaml(text):
+    content = legacy_get_format_from_response(
+        text, [("```yaml", "```", 0), ("```", "```", 0)]
+    )
+    return yaml.safe_load(content)
+
+
+def get_all_json_in_loop(text):
+    response = AIResponse(_response=text)
+    results, start_from = [], 0
+    while True:
+        tagged_content = get_json_from_response(response, start_from=start_from)
+        if tagged_content is None:
+            return results
+        results.append(tagged_content.parsed_content)
+        start_from = tagged_content.end_ind
+
+
+def get_all_json(text):
+    response = AIResponse(_response=text)
+    return [tagged.parsed_content for tagged in iter_json_from_response(response)]
+
+
+def make_data(size_kb):
+    items, size = [], 0
+    while size < size_kb * 1024:
+        i = len(items)
+        items.append(
+            {"id": i, "name": f"item {i}", "tags": ["a", "b"], "ok": True, "score": None}
+        )
+        size += len(json.dumps(items[-1]))
+    return {"items": items}
+
+
+def make_responses(size_kb):
+    data = make_data(size_kb)
+    prose = "Here is the answer you asked for, let me know if you need anything else. " * 4
+    return {
+        "json fence": f"{prose}\n```json\n{json.dumps(data, indent=2)}\n```\n{prose}",
+        "bare json": f"{prose}\n{json.dumps(data)}\n{prose}",
+        "yaml fence": f"{prose}\n```yaml\n{yaml.safe_dump(data)}```\n{prose}",
+        "json blocks": "".join(
+            f"{prose}\n```json\n{json.dumps(item)}\n```\n" for item in data["items"]
+        ),
+    }
+
+
+def run(name, function, text):
+    try:
+        function(text)
+    except Exception as e:
+        return f"{name:>10}: failed with {type(e).__name__}"
+    number, seconds = timeit.Timer(lambda: function(text)).autorange()
+    return f"{name:>10}: {seconds / number * 1000:8.3f} ms"
+
+
+def main():
+    print(
+        f"orjson: {response_parser.orjson is not None}, "
+        f"yaml loader: {response_parser.YAML_LOADER.__name__}"
+    )
+    for size_kb in SIZES_KB:
+        for kind, text in make_responses(size_kb).items():
+            print(f"{size_kb} KB {kind} ({len(text)} chars)")
+            if kind == "json blocks":
+                functions = [("loop", get_all_json_in_loop), ("iter", get_all_json)]
+            elif kind.startswith("yaml"):
+                functions = [
+                    ("legacy", legacy_get_yaml),
+                    ("current", lambda text: get_yaml_from_response(AIResponse(_response=text))),
+                ]
+            else:
+                functions = [
+                    ("legacy", legacy_get_json),
+                    ("current", lambda text: get_json_from_response(AIResponse(_response=text))),
+                ]
+            for name, function in functions:
+                print(run(name, function, text))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+"""
+Throughput of SaveWorker against a local stub of the Flow Prompt logs API
+by batch size, with and without references to prompts and context values sent before,
+and of the pipeline alone with local JSONL and SQLite sinks.
+
+    python benchmarks/save_worker_benchmark.py
+"""
+import gzip
+import json
+import os
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import monotonic
+
+from flow_prompt.responses import AIResponse
+from flow_prompt.services.content_refs import ContentIndex
+from flow_prompt.services.flow_prompt import FlowPromptService
+from flow_prompt.services.SaveWorker import SaveWorker
+from flow_prompt.services.sinks import JSONLSink, SQLiteSink
+
+COUNT_OF_TASKS = 2000
+BATCH_SIZES = [1, 10, 100]
+PROMPT_DATA = {
+    "prompt_id": "benchmark",
+    "chats": [{"role": "system", "content": "You're a helpful assistant. " * 20}],
+}
+DOCUMENTS = [f"Document {i}. " + "Lorem ipsum dolor sit amet. " * 100 for i in range(10)]
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    received = 0
+    received_bytes = 0
+    received_json_bytes = 0
+    lock = threading.Lock()
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        if self.headers.get("Content-Encoding") == "gzip":
+            body = gzip.decompress(body)
+        count = len(json.loads(body).get("logs", []))
+        with self.lock:
+            StubHandler.received += count
+            StubHandler.received_bytes += int(self.headers["Content-Length"])
+            StubHandler.received_json_bytes += len(body)
+        self.send_response(200)
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+def add_tasks(worker: SaveWorker):
+    for i in range(COUNT_OF_TASKS):
+        worker.add_task(
+            "token",
+            PROMPT_DATA,
+            {"question": f"Question number {i}", "document": DOCUMENTS[i % len(DOCUMENTS)]},
+            AIResponse(content=f"Answer number {i}", id=f"benchmark#{i}"),
+        )
+
+
+def run(server_url: str, batch_size: int, content_refs: bool):
+    FlowPromptService.url = server_url
+    StubHandler.received = StubHandler.received_bytes = StubHandler.received_json_bytes = 0
+    worker = SaveWorker(max_batch_size=batch_size, max_batch_interval=0.1)
+    worker.content_index = ContentIndex() if content_refs else None
+    started_at = monotonic()
+    add_tasks(worker)
+    worker.queue.join()
+    seconds = monotonic() - started_at
+    worker.close()
+    assert StubHandler.received == COUNT_OF_TASKS
+    print(
+        f"batch size {batch_size:>4}, content refs {'on ' if content_refs else 'off'}: "
+        f"{COUNT_OF_TASKS / seconds:8.0f} logs/s, "
+        f"{StubHandler.received_bytes / COUNT_OF_TASKS:6.0f} bytes/log sent, "
+        f"{StubHandler.received_json_bytes / COUNT_OF_TASKS:6.0f} bytes/log of JSON"
+    )
+
+
+def run_offline(directory: str, name: str, sink_class):
+    sink = sink_class(os.path.join(directory, name))
+    worker = SaveWorker(max_batch_size=100, max_batch_interval=0.1, sink=sink)
+    started_at = monotonic()
+    add_tasks(worker)
+    worker.queue.join()
+    seconds = monotonic() - started_at
+    worker.close()
+    sink.close()
+    print(f"{sink_class.__name__:>10} sink: {COUNT_OF_TASKS / seconds:8.0f} logs/s")
+
+
+def main():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    server_url = f"http://127.0.0.1:{server.server_port}/"
+    try:
+        for batch_size in BATCH_SIZES:
+            for content_refs in (False, True):
+                run(server_url, batch_size, content_refs)
+    finally:
+        server.shutdown()
+    with tempfile.TemporaryDirectory() as directory:
+        run_offline(directory, "logs.jsonl", JSONLSink)
+        run_offline(directory, "logs.sqlite3", SQLiteSink)
+
+
+if __name__ == "__main__":
+    main()
@@ -22,6 +22,10 @@ class AIModel:
     support_functions: bool = False
     _price_per_prompt_1k_tokens: Decimal = None
     _price_per_sample_1k_tokens: Decimal = None
+    # price of prompt tokens read from / written to the provider's cache
+    # relative to the price of regular prompt tokens
+    cache_read_price_ratio: Decimal = Decimal(1)
+    cache_write_price_ratio: Decimal = Decimal(1)
 
     @property
     def name(self) -> str:
@@ -34,8 +38,32 @@ class AIModel:
     def _decimal(self, value) -> Decimal:
         return Decimal(value).quantize(Decimal(".00001"))
     
-    def get_prompt_price(self, count_tokens: int) -> Decimal:
-        return self._decimal(self.price_per_prompt_1k_tokens * Decimal(count_tokens) / 1000)
+    def get_prompt_price(
+        self,
+        count_tokens: int,
+        cache_read_tokens: int = 0,
+        cache_creation_tokens: int = 0,
+    ) -> Decimal:
+        billed_tokens = self.get_billed_prompt_tokens(
+            count_tokens, cache_read_tokens, cache_creation_tokens
+        )
+        return self._decimal(self.price_per_prompt_1k_tokens * billed_tokens / 1000)
+
+    def get_billed_prompt_tokens(
+        self,
+        count_tokens: int,
+        cache_read_tokens: int = 0,
+        cache_creation_tokens: int = 0,
+    ) -> Decimal:
+        """Count of prompt tokens weighted by the prices of cached tokens"""
+        not_cached_tokens = max(
+            count_tokens - cache_read_tokens - cache_creation_tokens, 0
+        )
+        return (
+            Decimal(not_cached_tokens)
+            + Decimal(cache_read_tokens) * self.cache_read_price_ratio
+            + Decimal(cache_creation_tokens) * self.cache_write_price_ratio
+        )
     
     def get_sample_price(self, prompt_sample, count_tokens: int) -> Decimal:
         return self._decimal(self.price_per_sample_1k_tokens * Decimal(count_tokens) / 1000)
@@ -50,5 +78,21 @@ class AIModel:
     def call(self, *args, **kwargs) -> AIResponse:
         raise NotImplementedError
 
+    def get_batch_request(
+        self, custom_id: str, messages: t.List[dict], max_tokens: int, **kwargs
+    ) -> dict:
+        raise NotImplementedError(f"Batch is not supported for {self.provider}")
+
+    def submit_batch(self, requests_path: str, client_secrets: dict = {}) -> str:
+        raise NotImplementedError(f"Batch is not supported for {self.provider}")
+
+    def is_batch_finished(self, batch_id: str, client_secrets: dict = {}) -> bool:
+        raise NotImplementedError(f"Batch is not supported for {self.provider}")
+
+    def get_batch_results(
+        self, batch_id: str, client_secrets: dict = {}
+    ) -> t.Iterator[t.Tuple[str, AIResponse]]:
+        raise NotImplementedError(f"Batch is not supported for {self.provider}")
+
     def get_metrics_data(self):
         return {}
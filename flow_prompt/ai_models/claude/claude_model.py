@@ -1,4 +1,5 @@
 from flow_prompt.ai_models.ai_model import AI_MODELS_PROVIDER, AIModel
+import json
 import logging
 
 from flow_prompt.ai_models.constants import C_200K
@@ -12,11 +13,21 @@ from dataclasses import dataclass
 from flow_prompt.ai_models.claude.responses import ClaudeAIReponse
 from flow_prompt.ai_models.claude.constants import HAIKU, SONNET, OPUS
 from flow_prompt.ai_models.utils import get_common_args
+from flow_prompt.ai_models.openai.responses import (
+    FINISH_REASON_ERROR,
+    FINISH_REASON_STRUCTURE_COMPLETE,
+)
 
 from openai.types.chat import ChatCompletionMessage as Message
 from flow_prompt.responses import Prompt
-from flow_prompt.exceptions import RetryableCustomError, ConnectionLostError
+from flow_prompt.cancellation import CancellationToken
+from flow_prompt.exceptions import (
+    CallCancelledError,
+    RetryableCustomError,
+)
+from flow_prompt.streaming import StreamHandler
 import anthropic
+import httpx
 
 logger = logging.getLogger(__name__)
 
@@ -28,6 +39,16 @@ class FamilyModel(Enum):
     opus = "Claude 3 Opus"
 
 
+BATCHES_URL = "/v1/messages/batches"
+BATCHES_BETA_HEADERS = {"anthropic-beta": "message-batches-2024-09-24"}
+BATCH_ENDED_STATUS = "ended"
+BATCH_SUCCEEDED_RESULT = "succeeded"
+
+PROMPT_CACHING_BETA_HEADERS = {"anthropic-beta": "prompt-caching-2024-07-31"}
+CACHE_READ_PRICE_RATIO = Decimal("0.1")
+CACHE_WRITE_PRICE_RATIO = Decimal("1.25")
+
+
 DEFAULT_PRICING = {
     "price_per_prompt_1k_tokens": Decimal(0.003),
     "price_per_sample_1k_tokens": Decimal(0.015),
@@ -61,6 +82,11 @@ class ClaudeAIModel(AIModel):
     api_key: str = None
     provider: AI_MODELS_PROVIDER = AI_MODELS_PROVIDER.CLAUDE
     family: str = None
+    # mark static leading messages of the prompt with cache_control, opt-in
+    # as leading system messages are sent as the system prompt instead of user turns
+    prompt_caching: bool = False
+    cache_read_price_ratio: Decimal = CACHE_READ_PRICE_RATIO
+    cache_write_price_ratio: Decimal = CACHE_WRITE_PRICE_RATIO
 
     def __post_init__(self):
         if HAIKU in self.model:
@@ -96,48 +122,129 @@ class ClaudeAIModel(AIModel):
         return result
 
 
-    def call(self, messages: t.List[dict], max_tokens: int, client_secrets: dict = {}, **kwargs) -> AIResponse:
+    def get_request_args(
+        self, messages: t.List[dict], static_prefix_count: int = 0
+    ) -> t.Dict[str, t.Any]:
+        """
+        Leading system messages of the static prefix are sent as the system prompt,
+        the last static block is marked with cache_control, so Anthropic doesn't
+        process the prefix again on every call.
+        At least one message is left to be sent as a user turn.
+        """
+        static_prefix_count = min(static_prefix_count, len(messages) - 1)
+        if not self.prompt_caching or static_prefix_count <= 0:
+            return {"messages": self.uny_all_messages_with_same_role(messages)}
+        system_count = 0
+        while (
+            system_count < static_prefix_count
+            and messages[system_count].get("role") == "system"
+        ):
+            system_count += 1
+        request_args = {
+            "messages": self.get_content_blocks(
+                messages[system_count:], static_prefix_count - system_count
+            ),
+            "extra_headers": PROMPT_CACHING_BETA_HEADERS,
+        }
+        if system_count:
+            system_block = {
+                "type": "text",
+                "text": "\n".join(m["content"] for m in messages[:system_count]),
+            }
+            if system_count == static_prefix_count:
+                system_block["cache_control"] = {"type": "ephemeral"}
+            request_args["system"] = [system_block]
+        return request_args
+
+    def get_content_blocks(
+        self, messages: t.List[dict], static_count: int
+    ) -> t.List[dict]:
+        """Messages with text blocks, consecutive ones of the same role are merged"""
+        result = []
+        for i, message in enumerate(messages):
+            role = "user" if message.get("role") == "system" else message.get("role")
+            block = {"type": "text", "text": message["content"]}
+            if i == static_count - 1:
+                block["cache_control"] = {"type": "ephemeral"}
+            if result and result[-1]["role"] == role:
+                result[-1]["content"].append(block)
+            else:
+                result.append({"role": role, "content": [block]})
+        return result
+
+    def call(
+        self,
+        messages: t.List[dict],
+        max_tokens: int,
+        client_secrets: dict = {},
+        cancellation_token: CancellationToken = None,
+        static_prefix_count: int = 0,
+        stream_handler: StreamHandler = None,
+        **kwargs,
+    ) -> AIResponse:
         common_args = get_common_args(max_tokens)
         kwargs = {
             **common_args,
             **self.get_params(),
             **kwargs,
         }
-        messages = self.uny_all_messages_with_same_role(messages)
+        request_args = self.get_request_args(messages, static_prefix_count)
+        messages = request_args["messages"]
 
         logger.debug(
             f"Calling {messages} with max_tokens {max_tokens} and kwargs {kwargs}"
         )
         client = self.get_client(client_secrets)
 
-        stream_function = kwargs.get("stream_function")
-        check_connection = kwargs.get("check_connection")
-        stream_params = kwargs.get("stream_params")
+        if stream_handler is None:
+            stream_handler = StreamHandler(
+                stream_function=kwargs.get("stream_function"),
+                check_connection=kwargs.get("check_connection"),
+                stream_params=kwargs.get("stream_params"),
+                cancellation_token=cancellation_token,
+            )
 
-        content = ""
+        callback_id = None
+        if cancellation_token:
+            cancellation_token.raise_if_cancelled()
+            # retries of the client would outlive the deadline, the call is retried by attempts
+            client = client.with_options(max_retries=0)
+            callback_id = cancellation_token.register(client.close)
+            if cancellation_token.deadline is not None:
+                request_args["timeout"] = cancellation_token.remaining()
 
         try:
             if kwargs.get("stream"):
                 with client.messages.stream(
-                    model=self.model, max_tokens=max_tokens, messages=messages
+                    model=self.model, max_tokens=max_tokens, **request_args,
                 ) as stream:
-                    idx = 0
                     for text in stream.text_stream:
-                        if idx % 5 == 0:
-                            if not check_connection(**stream_params):
-                                raise ConnectionLostError("Connection was lost!")
-
-                        stream_function(text, **stream_params)
-                        content += text
-                        idx += 1
+                        stream_handler.on_text(text)
+                        if stream_handler.is_stopped:
+                            break
+                    stream_handler.flush()
+                    if stream_handler.is_stopped:
+                        # leaving the context manager closes the response
+                        response = stream.current_message_snapshot
+                        response.stop_reason = FINISH_REASON_STRUCTURE_COMPLETE
+                        # output tokens of the snapshot aren't final,
+                        # completion tokens are counted from the received content
+                        output_tokens = None
+                    else:
+                        response = stream.get_final_message()
+                        output_tokens = response.usage.output_tokens
+                content = stream_handler.content
+                stream_handler.on_usage(response.usage.input_tokens, output_tokens)
             else:
                 response = client.messages.create(
-                    model=self.model, max_tokens=max_tokens, messages=messages
+                    model=self.model, max_tokens=max_tokens, **request_args,
                 )
                 content = response.content[0].text
-            return ClaudeAIReponse(
+            usage = response.usage
+            result = ClaudeAIReponse(
                 message=Message(content=content, role="assistant"),
                 content=content,
+                finish_reason=response.stop_reason,
                 prompt=Prompt(
                     messages=kwargs.get("messages"),
                     functions=kwargs.get("tools"),
@@ -146,9 +253,87 @@ class ClaudeAIModel(AIModel):
                     top_p=kwargs.get("top_p"),
                 ),
             )
+            result.metrics.cache_read_tokens = getattr(
+                usage, "cache_read_input_tokens", None
+            )
+            result.metrics.cache_creation_tokens = getattr(
+                usage, "cache_creation_input_tokens", None
+            )
+            return result
+        except CallCancelledError:
+            raise
         except Exception as e:
             logger.exception("[CLAUDEAI] failed to handle chat stream", exc_info=e)
             raise RetryableCustomError(f"Claude AI call failed!")
+        finally:
+            stream_handler.close()
+            if callback_id is not None:
+                cancellation_token.unregister(callback_id)
+
+    def get_batch_request(
+        self, custom_id: str, messages: t.List[dict], max_tokens: int, **kwargs
+    ) -> dict:
+        return {
+            "custom_id": custom_id,
+            "params": {
+                "model": self.model,
+                "max_tokens": max_tokens,
+                "messages": self.uny_all_messages_with_same_role(messages),
+            },
+        }
+
+    def submit_batch(self, requests_path: str, client_secrets: dict = {}) -> str:
+        with open(requests_path) as requests_file:
+            requests = [json.loads(line) for line in requests_file if line.strip()]
+        batch = self.get_client(client_secrets).post(
+            BATCHES_URL,
+            body={"requests": requests},
+            cast_to=object,
+            options={"headers": BATCHES_BETA_HEADERS},
+        )
+        return batch["id"]
+
+    def is_batch_finished(self, batch_id: str, client_secrets: dict = {}) -> bool:
+        batch = self.get_client(client_secrets).get(
+            f"{BATCHES_URL}/{batch_id}",
+            cast_to=object,
+            options={"headers": BATCHES_BETA_HEADERS},
+        )
+        logger.debug(f"Batch {batch_id} status: {batch['processing_status']}")
+        return batch["processing_status"] == BATCH_ENDED_STATUS
+
+    def get_batch_results(
+        self, batch_id: str, client_secrets: dict = {}
+    ) -> t.Iterator[t.Tuple[str, ClaudeAIReponse]]:
+        results = self.get_client(client_secrets).get(
+            f"{BATCHES_URL}/{batch_id}/results",
+            cast_to=httpx.Response,
+            options={"headers": BATCHES_BETA_HEADERS},
+        )
+        for line in results.iter_lines():
+            if not line.strip():
+                continue
+            data = json.loads(line)
+            result = data.get("result") or {}
+            if result.get("type") != BATCH_SUCCEEDED_RESULT:
+                logger.error(f"Batch request {data['custom_id']} failed: {data}")
+                yield data["custom_id"], ClaudeAIReponse(
+                    finish_reason=FINISH_REASON_ERROR,
+                    message=Message(content="", role="assistant"),
+                    original_result=data,
+                )
+                continue
+            content = "".join(
+                block.get("text", "")
+                for block in result["message"]["content"]
+                if block.get("type") == "text"
+            )
+            yield data["custom_id"], ClaudeAIReponse(
+                finish_reason=result["message"].get("stop_reason"),
+                message=Message(content=content, role="assistant"),
+                content=content,
+                original_result=result["message"],
+            )
 
     def name(self) -> str:
         return self.model
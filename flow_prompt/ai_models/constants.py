@@ -1,3 +1,4 @@
+from decimal import Decimal
 
 C_4K = 4096
 C_8K = 8192
@@ -7,3 +8,6 @@ C_32K = 32768
 C_128K = 128_000
 C_200K = 200_000
 C_1M = 1_000_000
+
+# Batch endpoints of providers are 50% cheaper
+BATCH_PRICE_RATIO = Decimal("0.5")
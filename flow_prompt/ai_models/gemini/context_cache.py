@@ -0,0 +1,108 @@
+import datetime
+import hashlib
+import logging
+import threading
+import typing as t
+from collections import OrderedDict
+from dataclasses import dataclass
+from time import monotonic
+
+from google.generativeai import caching
+
+from flow_prompt import settings
+
+logger = logging.getLogger(__name__)
+
+MAX_FAILED_KEYS = 1000
+
+
+@dataclass
+class _CachedContext:
+    cached_content: caching.CachedContent
+    expires_at: float
+
+
+class GeminiContextCache:
+    """
+    Uploads static contents to Gemini cached content once per api key and reuses it
+    while it's alive. Cached content is prolonged when it's used close to the expiration.
+    Contents which couldn't be cached aren't retried for retry_after seconds.
+    Requests to Gemini hold only the lock of their contents.
+    """
+
+    def __init__(
+        self,
+        ttl: int = settings.GEMINI_CONTEXT_CACHE_TTL_SECONDS,
+        refresh_before: int = settings.GEMINI_CONTEXT_CACHE_REFRESH_SECONDS,
+        retry_after: int = settings.GEMINI_CONTEXT_CACHE_RETRY_SECONDS,
+    ):
+        self.ttl = ttl
+        self.refresh_before = refresh_before
+        self.retry_after = retry_after
+        self._lock = threading.Lock()
+        self._key_locks: t.Dict[str, threading.Lock] = {}
+        self._contexts: t.Dict[str, _CachedContext] = {}
+        # key -> time to retry caching, the oldest failures are forgotten first
+        self._failed_keys: "OrderedDict[str, float]" = OrderedDict()
+
+    def get(
+        self, model: str, contents: str, api_key: str = None
+    ) -> t.Optional[caching.CachedContent]:
+        # cached content belongs to the project of the api key
+        key = hashlib.sha256(f"{api_key}\n{model}\n{contents}".encode()).hexdigest()
+        with self._lock:
+            retry_at = self._failed_keys.get(key)
+            if retry_at is not None:
+                if retry_at > monotonic():
+                    return None
+                del self._failed_keys[key]
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+        with key_lock:
+            with self._lock:
+                context = self._contexts.get(key)
+            try:
+                if context is None or context.expires_at <= monotonic():
+                    context = self._create(model, contents)
+                elif context.expires_at - monotonic() < self.refresh_before:
+                    self._refresh(context)
+            except Exception as e:
+                logger.warning(f"Couldn't cache context for {model}: {e}")
+                with self._lock:
+                    self._contexts.pop(key, None)
+                    self._key_locks.pop(key, None)
+                    self._add_failed(key)
+                return None
+            with self._lock:
+                self._contexts[key] = context
+                self._delete_expired()
+            return context.cached_content
+
+    def _add_failed(self, key: str):
+        self._failed_keys[key] = monotonic() + self.retry_after
+        self._failed_keys.move_to_end(key)
+        while len(self._failed_keys) > MAX_FAILED_KEYS:
+            self._failed_keys.popitem(last=False)
+
+    def _create(self, model: str, contents: str) -> _CachedContext:
+        logger.debug(f"Creating cached content for {model}")
+        cached_content = caching.CachedContent.create(
+            model=model,
+            contents=[contents],
+            ttl=datetime.timedelta(seconds=self.ttl),
+        )
+        return _CachedContext(
+            cached_content=cached_content, expires_at=monotonic() + self.ttl
+        )
+
+    def _refresh(self, context: _CachedContext):
+        logger.debug(f"Prolonging cached content {context.cached_content.name}")
+        context.cached_content.update(ttl=datetime.timedelta(seconds=self.ttl))
+        context.expires_at = monotonic() + self.ttl
+
+    def _delete_expired(self):
+        now = monotonic()
+        for key in [k for k, c in self._contexts.items() if c.expires_at <= now]:
+            del self._contexts[key]
+        for key, lock in list(self._key_locks.items()):
+            if key not in self._contexts and not lock.locked():
+                del self._key_locks[key]
@@ -9,12 +9,20 @@ from enum import Enum
 import typing as t
 from dataclasses import dataclass
 
+from flow_prompt import settings
+from flow_prompt.ai_models.gemini.context_cache import GeminiContextCache
 from flow_prompt.ai_models.gemini.responses import GeminiAIResponse
 
+from flow_prompt.ai_models.openai.responses import FINISH_REASON_STRUCTURE_COMPLETE
 from flow_prompt.ai_models.utils import get_common_args
 from openai.types.chat import ChatCompletionMessage as Message
 from flow_prompt.responses import Prompt
-from flow_prompt.exceptions import RetryableCustomError, ConnectionLostError
+from flow_prompt.cancellation import CancellationToken
+from flow_prompt.exceptions import (
+    CallCancelledError,
+    RetryableCustomError,
+)
+from flow_prompt.streaming import StreamHandler
 import google.generativeai as genai
 
 
@@ -25,6 +33,19 @@ FLASH = "gemini-1.5-flash"
 PRO = "gemini-1.5-pro"
 PRO_1_0 = "gemini-1.0-pro"
 
+CACHE_READ_PRICE_RATIO = Decimal("0.25")
+# rough estimation to skip contents which are too small to be cached
+CHARS_PER_TOKEN = 4
+
+DEFAULT_CONTEXT_CACHE = GeminiContextCache()
+
+
+def close_stream(response: t.Any):
+    """Cancels the gRPC stream of generate_content, the SDK doesn't expose it"""
+    cancel = getattr(getattr(response, "_iterator", None), "cancel", None)
+    if cancel is not None:
+        cancel()
+
 
 
 class FamilyModel(Enum):
@@ -75,6 +96,11 @@ class GeminiAIModel(AIModel):
     gemini_model: genai.GenerativeModel = None
     provider: AI_MODELS_PROVIDER = AI_MODELS_PROVIDER.GEMINI
     family: str = None
+    # upload static leading messages of the prompt as Gemini cached content,
+    # its hourly storage cost isn't included in the prices of the calls
+    context_caching: bool = False
+    context_cache: GeminiContextCache = None
+    cache_read_price_ratio: Decimal = CACHE_READ_PRICE_RATIO
 
     def __post_init__(self):
         self.model = self.model.lower()
@@ -89,10 +115,42 @@ class GeminiAIModel(AIModel):
                 f"Unknown family for {self.model}. Please add it obviously. Setting as Gemini 1.5 Flash"
             )
             self.family = FamilyModel.flash.value
+        if self.context_cache is None:
+            self.context_cache = DEFAULT_CONTEXT_CACHE
+
+    def get_cached_content(
+        self, messages: t.List[dict], static_prefix_count: int, api_key: str = None
+    ) -> t.Optional[genai.caching.CachedContent]:
+        if not self.context_caching or static_prefix_count <= 0:
+            return None
+        contents = "\n\n".join(m["content"] for m in messages[:static_prefix_count])
+        if len(contents) < settings.GEMINI_CONTEXT_CACHE_MIN_TOKENS * CHARS_PER_TOKEN:
+            return None
+        return self.context_cache.get(f"models/{self.model}", contents, api_key)
 
-    def call(self, messages: t.List[dict], max_tokens: int, client_secrets: dict = {}, **kwargs) -> AIResponse:
+    def call(
+        self,
+        messages: t.List[dict],
+        max_tokens: int,
+        client_secrets: dict = {},
+        cancellation_token: CancellationToken = None,
+        static_prefix_count: int = 0,
+        stream_handler: StreamHandler = None,
+        **kwargs,
+    ) -> AIResponse:
         genai.configure(api_key=client_secrets["api_key"])
-        self.gemini_model = genai.GenerativeModel(self.model)
+        # at least one message is sent with the request
+        static_prefix_count = min(static_prefix_count, len(messages) - 1)
+        cached_content = self.get_cached_content(
+            messages, static_prefix_count, client_secrets["api_key"]
+        )
+        # the model is local, calls of the same AI model may run concurrently
+        if cached_content is not None:
+            gemini_model = genai.GenerativeModel.from_cached_content(cached_content)
+            prompt_messages = messages[static_prefix_count:]
+        else:
+            gemini_model = genai.GenerativeModel(self.model)
+            prompt_messages = messages
         common_args = get_common_args(max_tokens)
         kwargs = {
             **{
@@ -109,34 +167,59 @@ class GeminiAIModel(AIModel):
             f"Calling {messages} with max_tokens {max_tokens} and kwargs {kwargs}"
         )
 
-        stream_function = kwargs.get("stream_function")
-        check_connection = kwargs.get("check_connection")
-        stream_params = kwargs.get("stream_params")
+        if stream_handler is None:
+            stream_handler = StreamHandler(
+                stream_function=kwargs.get("stream_function"),
+                check_connection=kwargs.get("check_connection"),
+                stream_params=kwargs.get("stream_params"),
+                cancellation_token=cancellation_token,
+            )
 
         # Parse only prompt content due to gemini call specifics
-        prompt = '\n\n'.join([obj["content"] for obj in messages])
+        prompt = '\n\n'.join([obj["content"] for obj in prompt_messages])
 
-        content = ""
+        request_options = {}
+        if cancellation_token:
+            cancellation_token.raise_if_cancelled()
+            if cancellation_token.deadline is not None:
+                request_options["timeout"] = cancellation_token.remaining()
 
+        finish_reason = ""
+        callback_id = None
         try:
             if not kwargs.get('stream'):
-                response = self.gemini_model.generate_content(prompt, stream=False)
+                response = gemini_model.generate_content(
+                    prompt, stream=False, request_options=request_options
+                )
                 content = response.text
             else:
-                response = self.gemini_model.generate_content(prompt, stream=True)
-                idx = 0
+                response = gemini_model.generate_content(
+                    prompt, stream=True, request_options=request_options
+                )
+                if cancellation_token:
+                    # unblocks the wait for the next chunk
+                    callback_id = cancellation_token.register(
+                        lambda: close_stream(response)
+                    )
                 for chunk in response:
-                    if idx % 5 == 0:
-                        idx = 0
-                        if not check_connection(**stream_params):
-                            raise ConnectionLostError("Connection was lost!")
-                    stream_function(chunk.text, **stream_params)
-                    content += chunk.text
-                    idx += 1
-
-            return GeminiAIResponse(
+                    stream_handler.on_text(chunk.text)
+                    if stream_handler.is_stopped:
+                        close_stream(response)
+                        finish_reason = FINISH_REASON_STRUCTURE_COMPLETE
+                        break
+                stream_handler.flush()
+                content = stream_handler.content
+                usage_metadata = getattr(response, "usage_metadata", None)
+                if usage_metadata is not None:
+                    stream_handler.on_usage(
+                        usage_metadata.prompt_token_count,
+                        usage_metadata.candidates_token_count,
+                    )
+
+            result = GeminiAIResponse(
                 message=Message(content=content, role="assistant"),
                 content=content,
+                finish_reason=finish_reason,
                 prompt=Prompt(
                     messages=kwargs.get("messages"),
                     functions=kwargs.get("tools"),
@@ -145,10 +228,21 @@ class GeminiAIModel(AIModel):
                     top_p=kwargs.get("top_p"),
                 ),
             )
+            if cached_content is not None:
+                result.metrics.cache_read_tokens = (
+                    response.usage_metadata.cached_content_token_count
+                )
+            return result
 
+        except CallCancelledError:
+            raise
         except Exception as e:
             logger.exception("[GEMINIAI] failed to handle chat stream", exc_info=e)
             raise RetryableCustomError(f"Gemini AI call failed!")
+        finally:
+            stream_handler.close()
+            if callback_id is not None:
+                cancellation_token.unregister(callback_id)
 
     def name(self) -> str:
         return self.model
@@ -166,13 +260,21 @@ class GeminiAIModel(AIModel):
         }
     
 
-    def get_prompt_price(self, count_tokens: int) -> Decimal:
+    def get_prompt_price(
+        self,
+        count_tokens: int,
+        cache_read_tokens: int = 0,
+        cache_creation_tokens: int = 0,
+    ) -> Decimal:
+        billed_tokens = self.get_billed_prompt_tokens(
+            count_tokens, cache_read_tokens, cache_creation_tokens
+        )
         for key in sorted(GEMINI_AI_PRICING[self.family].keys()):
             if count_tokens < key:
-                logger.info(f"Prompt price for {count_tokens} tokens is {GEMINI_AI_PRICING[self.family][key]['price_per_prompt_1k_tokens'] * Decimal(count_tokens) / 1000}")
-                return self._decimal(GEMINI_AI_PRICING[self.family][key]["price_per_prompt_1k_tokens"] * Decimal(count_tokens) / 1000)
+                logger.info(f"Prompt price for {count_tokens} tokens is {GEMINI_AI_PRICING[self.family][key]['price_per_prompt_1k_tokens'] * billed_tokens / 1000}")
+                return self._decimal(GEMINI_AI_PRICING[self.family][key]["price_per_prompt_1k_tokens"] * billed_tokens / 1000)
         
-        return self._decimal(self.price_per_prompt_1k_tokens * Decimal(count_tokens) / 1000)
+        return self._decimal(self.price_per_prompt_1k_tokens * billed_tokens / 1000)
     
     def get_sample_price(self, prompt_sample, count_tokens: int) -> Decimal:
         for key in sorted(GEMINI_AI_PRICING[self.family].keys()):
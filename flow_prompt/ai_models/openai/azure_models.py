@@ -18,6 +18,8 @@ class AzureAIModel(OpenAIModel):
     deployment_id: t.Optional[str]
     provider: AI_MODELS_PROVIDER = AI_MODELS_PROVIDER.AZURE
     model: t.Optional[str] = None
+    # stream_options are rejected by API versions before 2024-09-01-preview
+    stream_usage: bool = False
 
     def __str__(self) -> str:
         return f"{self.realm}-{self.deployment_id}-{self.family}"
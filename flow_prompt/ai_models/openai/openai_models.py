@@ -1,3 +1,4 @@
+import json
 import logging
 import typing as t
 from dataclasses import dataclass
@@ -8,17 +9,28 @@ from openai import OpenAI
 
 from flow_prompt.ai_models.ai_model import AI_MODELS_PROVIDER, AIModel
 from flow_prompt.ai_models.constants import C_128K, C_16K, C_32K, C_4K
-from flow_prompt.ai_models.openai.responses import OpenAIResponse
+from flow_prompt.ai_models.openai.responses import (
+    FINISH_REASON_ERROR,
+    FINISH_REASON_STRUCTURE_COMPLETE,
+    OpenAIResponse,
+)
 from flow_prompt.ai_models.utils import get_common_args
-from flow_prompt.exceptions import ConnectionLostError
+from flow_prompt.cancellation import CancellationToken
 
 from openai.types.chat import ChatCompletionMessage as Message
+from openai.types.chat import ChatCompletionMessageToolCall as ToolCall
+from openai.types.chat.chat_completion_chunk import ChoiceDeltaToolCall
 from flow_prompt.responses import Prompt
+from flow_prompt.streaming import StreamHandler
 
 from .utils import raise_openai_exception
 
 M_DAVINCI = "davinci"
 
+BATCH_ENDPOINT = "/v1/chat/completions"
+BATCH_COMPLETION_WINDOW = "24h"
+BATCH_FINISHED_STATUSES = ("completed", "failed", "expired", "cancelled")
+
 logger = logging.getLogger(__name__)
 
 
@@ -93,6 +105,8 @@ class OpenAIModel(AIModel):
     provider: AI_MODELS_PROVIDER = AI_MODELS_PROVIDER.OPENAI
     family: str = None
     max_sample_budget: int = C_4K
+    # streamed responses end with a chunk of token usage
+    stream_usage: bool = True
 
     def __str__(self) -> str:
         return f"openai-{self.model}-{self.family}"
@@ -151,8 +165,12 @@ class OpenAIModel(AIModel):
         check_connection: t.Callable = None,
         stream_params: dict = {},
         client_secrets: dict = {},
+        cancellation_token: CancellationToken = None,
+        static_prefix_count: int = 0,
+        stream_handler: StreamHandler = None,
         **kwargs,
     ) -> OpenAIResponse:
+        # OpenAI caches long prompt prefixes automatically, static_prefix_count isn't needed
         logger.debug(
             f"Calling {messages} with max_tokens {max_tokens} and kwargs {kwargs}"
         )
@@ -169,6 +187,8 @@ class OpenAIModel(AIModel):
                 check_connection=check_connection,
                 stream_params=stream_params,
                 client_secrets=client_secrets,
+                cancellation_token=cancellation_token,
+                stream_handler=stream_handler,
                 **kwargs,
             )
         raise NotImplementedError(f"Openai family {self.family} is not implemented")
@@ -188,6 +208,8 @@ class OpenAIModel(AIModel):
         check_connection: t.Callable = None,
         stream_params: dict = {},
         client_secrets: dict = {},
+        cancellation_token: CancellationToken = None,
+        stream_handler: StreamHandler = None,
         **kwargs,
     ) -> OpenAIResponse:
         max_tokens = min(max_tokens, self.max_tokens, self.max_sample_budget)
@@ -202,17 +224,32 @@ class OpenAIModel(AIModel):
         }
         if functions:
             kwargs["tools"] = functions
+        if kwargs.get("stream") and self.stream_usage:
+            kwargs.setdefault("stream_options", {"include_usage": True})
+        callback_id = None
         try:
             client = self.get_client(client_secrets)
+            if cancellation_token:
+                cancellation_token.raise_if_cancelled()
+                # retries of the client would outlive the deadline, the call is retried by attempts
+                client = client.with_options(max_retries=0)
+                callback_id = cancellation_token.register(client.close)
+                if cancellation_token.deadline is not None:
+                    kwargs["timeout"] = cancellation_token.remaining()
             result = client.chat.completions.create(
                 **kwargs,
             )
 
             if kwargs.get("stream"):
+                if stream_handler is None:
+                    stream_handler = StreamHandler(
+                        stream_function=stream_function,
+                        check_connection=check_connection,
+                        stream_params=stream_params,
+                        cancellation_token=cancellation_token,
+                    )
                 return OpenAIStreamResponse(
-                    stream_function=stream_function,
-                    check_connection=check_connection,
-                    stream_params=stream_params,
+                    stream_handler=stream_handler,
                     original_result=result,
                     prompt=Prompt(
                         messages=kwargs.get("messages"),
@@ -239,33 +276,135 @@ class OpenAIModel(AIModel):
         except Exception as e:
             logger.exception("[OPENAI] failed to handle chat stream", exc_info=e)
             raise_openai_exception(e)
+        finally:
+            if stream_handler is not None:
+                stream_handler.close()
+            if callback_id is not None:
+                cancellation_token.unregister(callback_id)
+
+    def get_batch_request(
+        self, custom_id: str, messages: t.List[dict], max_tokens: int, **kwargs
+    ) -> dict:
+        max_tokens = min(max_tokens, self.max_tokens, self.max_sample_budget)
+        body = {
+            **{
+                "messages": messages,
+            },
+            **get_common_args(max_tokens),
+            **self.get_params(),
+            **kwargs,
+        }
+        body.pop("stream", None)
+        return {
+            "custom_id": custom_id,
+            "method": "POST",
+            "url": BATCH_ENDPOINT,
+            "body": body,
+        }
+
+    def submit_batch(self, requests_path: str, client_secrets: dict = {}) -> str:
+        client = self.get_client(client_secrets)
+        with open(requests_path, "rb") as requests_file:
+            batch_file = client.files.create(file=requests_file, purpose="batch")
+        batch = client.batches.create(
+            input_file_id=batch_file.id,
+            endpoint=BATCH_ENDPOINT,
+            completion_window=BATCH_COMPLETION_WINDOW,
+        )
+        return batch.id
+
+    def is_batch_finished(self, batch_id: str, client_secrets: dict = {}) -> bool:
+        batch = self.get_client(client_secrets).batches.retrieve(batch_id)
+        logger.debug(f"Batch {batch_id} status: {batch.status}")
+        return batch.status in BATCH_FINISHED_STATUSES
+
+    def get_batch_results(
+        self, batch_id: str, client_secrets: dict = {}
+    ) -> t.Iterator[t.Tuple[str, OpenAIResponse]]:
+        client = self.get_client(client_secrets)
+        batch = client.batches.retrieve(batch_id)
+        for file_id in (batch.output_file_id, batch.error_file_id):
+            if not file_id:
+                continue
+            for line in client.files.content(file_id).iter_lines():
+                if not line.strip():
+                    continue
+                data = json.loads(line)
+                response = data.get("response") or {}
+                body = response.get("body") or {}
+                if response.get("status_code") != 200 or not body.get("choices"):
+                    logger.error(f"Batch request {data['custom_id']} failed: {data}")
+                    yield data["custom_id"], OpenAIResponse(
+                        finish_reason=FINISH_REASON_ERROR,
+                        message=Message(content="", role="assistant"),
+                        original_result=data,
+                    )
+                    continue
+                choice = body["choices"][0]
+                message = Message.model_validate(choice["message"])
+                yield data["custom_id"], OpenAIResponse(
+                    finish_reason=choice.get("finish_reason"),
+                    message=message,
+                    content=message.content,
+                    original_result=body,
+                )
 
 
 @dataclass(kw_only=True)
 class OpenAIStreamResponse(OpenAIResponse):
-    stream_function: t.Callable
-    check_connection: t.Callable
-    stream_params: dict
-
-    def process_message(self, text: str, idx: int):
-        if idx % 5 == 0:
-            if not self.check_connection(**self.stream_params):
-                raise ConnectionLostError("Connection was lost!")
-        if not text:
-            return
-        self.stream_function(text, **self.stream_params)
+    stream_handler: StreamHandler
 
     def stream(self):
-        content = ""
-        for i, data in enumerate(self.original_result):
+        tool_calls = {}
+        for data in self.original_result:
+            if data.usage:
+                self.stream_handler.on_usage(
+                    data.usage.prompt_tokens, data.usage.completion_tokens
+                )
             if not data.choices:
                 continue
             choice = data.choices[0]
+            if choice.finish_reason:
+                self.finish_reason = choice.finish_reason
             if choice.delta:
-                content += choice.delta.content or ""
-                self.process_message(choice.delta.content, i)
+                self.stream_handler.on_text(choice.delta.content)
+                for tool_call in choice.delta.tool_calls or []:
+                    self.add_tool_call_delta(tool_calls, tool_call)
+            if self.stream_handler.is_stopped:
+                self.original_result.close()
+                self.finish_reason = FINISH_REASON_STRUCTURE_COMPLETE
+                break
+        self.stream_handler.flush()
+        self.content = self.stream_handler.content
         self.message = Message(
-            content=content,
+            content=self.content,
             role="assistant",
+            tool_calls=[
+                ToolCall(
+                    id=tool_call["id"],
+                    type="function",
+                    function={
+                        "name": tool_call["name"],
+                        "arguments": "".join(tool_call["arguments"]),
+                    },
+                )
+                for _, tool_call in sorted(tool_calls.items())
+            ]
+            or None,
         )
         return self
+
+    def add_tool_call_delta(self, tool_calls: dict, delta: ChoiceDeltaToolCall):
+        function = delta.function
+        name = function.name if function else None
+        arguments = function.arguments if function else None
+        tool_call = tool_calls.setdefault(
+            delta.index, {"id": None, "name": None, "arguments": []}
+        )
+        tool_call["id"] = delta.id or tool_call["id"]
+        tool_call["name"] = name or tool_call["name"]
+        if arguments:
+            tool_call["arguments"].append(arguments)
+        self.stream_handler.on_tool_call(
+            delta.index, id=delta.id, name=name, arguments=arguments
+        )
@@ -12,6 +12,8 @@ FINISH_REASON_LENGTH = "length"
 FINISH_REASON_ERROR = "error"
 FINISH_REASON_FINISH = "stop"
 FINISH_REASON_TOOL_CALLS = "tool_calls"
+# the stream was closed as soon as the structured answer was complete
+FINISH_REASON_STRUCTURE_COMPLETE = "structure_complete"
 
 logger = logging.getLogger(__name__)
 
@@ -3,6 +3,7 @@ import requests
 
 import openai
 
+from flow_prompt.exceptions import CallCancelledError
 from flow_prompt.ai_models.openai.exceptions import (
     OpenAIAuthenticationError,
     OpenAIBadRequestError,
@@ -23,6 +24,9 @@ logger = logging.getLogger(__name__)
 def raise_openai_exception(
     exc: Exception,
 ) -> None:
+    if isinstance(exc, CallCancelledError):
+        raise exc
+
     if isinstance(exc, requests.exceptions.ChunkedEncodingError):
         raise OpenAIChunkedEncodingError()
 
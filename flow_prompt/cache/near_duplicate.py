@@ -0,0 +1,177 @@
+import hashlib
+import json
+import logging
+import random
+import re
+import threading
+import typing as t
+from collections import OrderedDict
+from copy import deepcopy
+from dataclasses import dataclass
+from time import monotonic
+
+from flow_prompt import settings
+from flow_prompt.ai_models.openai.responses import FINISH_REASON_ERROR
+from flow_prompt.responses import AIResponse
+
+logger = logging.getLogger(__name__)
+
+REUSED_FROM_NEAR_DUPLICATE = "near_duplicate"
+
+MERSENNE_PRIME = (1 << 61) - 1
+MAX_HASH = (1 << 32) - 1
+SHINGLE_SIZE = 3
+WORDS_RE = re.compile(r"\w+")
+
+
+@dataclass
+class _Entry:
+    scope: str
+    signature: t.Tuple[int, ...]
+    response: AIResponse
+    expires_at: float
+
+
+class NearDuplicateCache:
+    """
+    Opt-in cache which reuses a response for a prompt that is almost the same as
+    an already answered one, e.g. differs only in whitespace, a timestamp or an id.
+    Similarity of the resolved messages is estimated locally with MinHash signatures
+    of word shingles, candidates are found with an LSH index of signature bands.
+    Only prompts from prompt_ids are looked up, the index keeps at most max_size
+    responses and evicts the least recently used ones.
+    """
+
+    def __init__(
+        self,
+        prompt_ids: t.Iterable[str],
+        threshold: float = settings.NEAR_DUPLICATE_THRESHOLD,
+        max_size: int = settings.RESPONSE_CACHE_MAX_SIZE,
+        ttl: float = settings.RESPONSE_CACHE_TTL_SECONDS,
+        num_perm: int = 64,
+        bands: int = 16,
+    ):
+        if num_perm % bands:
+            raise ValueError("num_perm should be divisible by bands")
+        self.prompt_ids = set(prompt_ids)
+        self.threshold = threshold
+        self.max_size = max_size
+        self.ttl = ttl
+        self.bands = bands
+        self.rows = num_perm // bands
+        # fixed seed keeps signatures comparable between instances
+        generator = random.Random(1)
+        self._permutations = [
+            (generator.randint(1, MERSENNE_PRIME - 1), generator.randint(0, MERSENNE_PRIME - 1))
+            for _ in range(num_perm)
+        ]
+        self._lock = threading.Lock()
+        self._next_id = 0
+        self._entries: OrderedDict[int, _Entry] = OrderedDict()
+        self._buckets: t.Dict[t.Tuple[str, int, t.Tuple[int, ...]], t.Set[int]] = {}
+
+    def is_allowed(self, prompt_id: str) -> bool:
+        return prompt_id in self.prompt_ids
+
+    def get_signature(self, messages: t.List[dict]) -> t.Tuple[int, ...]:
+        words = WORDS_RE.findall(messages_to_text(messages).lower())
+        shingles = {
+            " ".join(words[i : i + SHINGLE_SIZE])
+            for i in range(max(len(words) - SHINGLE_SIZE + 1, 1))
+        }
+        hashes = [
+            int.from_bytes(hashlib.blake2b(s.encode(), digest_size=4).digest(), "big")
+            for s in shingles
+        ]
+        return tuple(
+            min((a * h + b) % MERSENNE_PRIME for h in hashes) & MAX_HASH
+            for a, b in self._permutations
+        )
+
+    def get(
+        self,
+        scope: str,
+        messages: t.List[dict],
+        signature: t.Optional[t.Tuple[int, ...]] = None,
+    ) -> t.Optional[AIResponse]:
+        """signature of the messages is computed if it's not passed"""
+        if signature is None:
+            signature = self.get_signature(messages)
+        now = monotonic()
+        with self._lock:
+            candidates = set()
+            for band_key in self._get_band_keys(scope, signature):
+                candidates.update(self._buckets.get(band_key, ()))
+            best_id, best_similarity = None, 0.0
+            for entry_id in candidates:
+                entry = self._entries[entry_id]
+                if entry.expires_at <= now:
+                    self._delete(entry_id)
+                    continue
+                similarity = get_similarity(signature, entry.signature)
+                if similarity >= self.threshold and similarity > best_similarity:
+                    best_id, best_similarity = entry_id, similarity
+            if best_id is None:
+                return None
+            self._entries.move_to_end(best_id)
+            response = self._entries[best_id].response
+        logger.debug(f"Found near duplicate response with similarity {best_similarity}")
+        return deepcopy(response)
+
+    def set(
+        self,
+        scope: str,
+        messages: t.List[dict],
+        response: AIResponse,
+        signature: t.Optional[t.Tuple[int, ...]] = None,
+    ):
+        """
+        signature of the messages is computed if it's not passed, pass the one computed
+        before the call as AI models may change the messages
+        """
+        if response.finish_reason == FINISH_REASON_ERROR or not response.content:
+            return
+        if signature is None:
+            signature = self.get_signature(messages)
+        entry = _Entry(
+            scope=scope,
+            signature=signature,
+            response=deepcopy(response),
+            expires_at=monotonic() + self.ttl,
+        )
+        with self._lock:
+            self._next_id += 1
+            self._entries[self._next_id] = entry
+            for band_key in self._get_band_keys(scope, entry.signature):
+                self._buckets.setdefault(band_key, set()).add(self._next_id)
+            while len(self._entries) > self.max_size:
+                self._delete(next(iter(self._entries)))
+
+    def _get_band_keys(self, scope: str, signature: t.Tuple[int, ...]):
+        for band in range(self.bands):
+            yield scope, band, signature[band * self.rows : (band + 1) * self.rows]
+
+    def _delete(self, entry_id: int):
+        entry = self._entries.pop(entry_id)
+        for band_key in self._get_band_keys(entry.scope, entry.signature):
+            bucket = self._buckets.get(band_key)
+            if bucket is None:
+                continue
+            bucket.discard(entry_id)
+            if not bucket:
+                del self._buckets[band_key]
+
+
+def messages_to_text(messages: t.List[dict]) -> str:
+    lines = []
+    for message in messages:
+        content = message.get("content")
+        if not isinstance(content, str):
+            content = json.dumps(content)
+        lines.append(f"{message.get('role')}: {content}")
+    return "\n".join(lines)
+
+
+def get_similarity(first: t.Tuple[int, ...], second: t.Tuple[int, ...]) -> float:
+    """Estimated Jaccard similarity of the shingles"""
+    return sum(a == b for a, b in zip(first, second)) / len(first)
@@ -0,0 +1,158 @@
+import json
+import logging
+import sqlite3
+import threading
+import typing as t
+from collections import OrderedDict
+from copy import deepcopy
+from dataclasses import asdict
+from time import monotonic, time
+
+from openai.types.chat import ChatCompletionMessage as Message
+
+from flow_prompt import settings
+from flow_prompt.ai_models.claude.responses import ClaudeAIReponse
+from flow_prompt.ai_models.gemini.responses import GeminiAIResponse
+from flow_prompt.ai_models.openai.responses import FINISH_REASON_ERROR, OpenAIResponse
+from flow_prompt.responses import AIResponse, Prompt
+from flow_prompt.utils import DecimalEncoder
+
+logger = logging.getLogger(__name__)
+
+REUSED_FROM_CACHE = "cache"
+
+RESPONSE_CLASSES = {
+    cls.__name__: cls for cls in (OpenAIResponse, ClaudeAIReponse, GeminiAIResponse)
+}
+
+
+class ResponseCache:
+    """
+    Cache of AI model responses consulted by FlowPrompt.call for deterministic calls.
+    Key is a hash of the resolved messages, the AI model and the params.
+    """
+
+    def get(self, key: str) -> t.Optional[AIResponse]:
+        raise NotImplementedError
+
+    def set(self, key: str, response: AIResponse):
+        raise NotImplementedError
+
+    def is_cacheable(self, response: AIResponse) -> bool:
+        return response.finish_reason != FINISH_REASON_ERROR and bool(
+            response.content
+        )
+
+
+class MemoryResponseCache(ResponseCache):
+    """LRU cache with expiration of records in ttl seconds"""
+
+    def __init__(
+        self,
+        max_size: int = settings.RESPONSE_CACHE_MAX_SIZE,
+        ttl: float = settings.RESPONSE_CACHE_TTL_SECONDS,
+    ):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._records: OrderedDict[str, t.Tuple[float, AIResponse]] = OrderedDict()
+
+    def get(self, key: str) -> t.Optional[AIResponse]:
+        with self._lock:
+            record = self._records.get(key)
+            if not record:
+                return None
+            expires_at, response = record
+            if expires_at <= monotonic():
+                del self._records[key]
+                return None
+            self._records.move_to_end(key)
+        return deepcopy(response)
+
+    def set(self, key: str, response: AIResponse):
+        if not self.is_cacheable(response):
+            return
+        response = deepcopy(response)
+        with self._lock:
+            self._records[key] = (monotonic() + self.ttl, response)
+            self._records.move_to_end(key)
+            while len(self._records) > self.max_size:
+                self._records.popitem(last=False)
+
+
+class SQLiteResponseCache(ResponseCache):
+    """
+    Local persistent cache, responses are stored as json without raw results of providers.
+    Can be shared between processes.
+    """
+
+    def __init__(
+        self,
+        path: str = settings.RESPONSE_CACHE_PATH,
+        ttl: float = settings.RESPONSE_CACHE_TTL_SECONDS,
+    ):
+        self.path = path
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._connection:
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS responses "
+                "(key TEXT PRIMARY KEY, response TEXT NOT NULL, expires_at REAL NOT NULL)"
+            )
+        self.delete_expired()
+
+    def get(self, key: str) -> t.Optional[AIResponse]:
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT response FROM responses WHERE key = ? AND expires_at > ?",
+                (key, time()),
+            ).fetchone()
+        if not row:
+            return None
+        try:
+            return load_response(json.loads(row[0]))
+        except Exception as e:
+            logger.warning(f"Couldn't load cached response {key}: {e}")
+            return None
+
+    def set(self, key: str, response: AIResponse):
+        if not self.is_cacheable(response):
+            return
+        data = json.dumps(dump_response(response), cls=DecimalEncoder)
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO responses (key, response, expires_at) VALUES (?, ?, ?)",
+                (key, data, time() + self.ttl),
+            )
+
+    def delete_expired(self):
+        with self._lock, self._connection:
+            self._connection.execute(
+                "DELETE FROM responses WHERE expires_at <= ?", (time(),)
+            )
+
+    def close(self):
+        self._connection.close()
+
+
+def dump_response(response: AIResponse) -> dict:
+    message = getattr(response, "message", None)
+    return {
+        "class": type(response).__name__,
+        "content": response.content,
+        "finish_reason": response.finish_reason,
+        "message": message.model_dump() if message else None,
+        "prompt": asdict(response.prompt),
+    }
+
+
+def load_response(data: dict) -> AIResponse:
+    response_class = RESPONSE_CLASSES.get(data["class"], OpenAIResponse)
+    message = data.get("message") or {"content": data["content"], "role": "assistant"}
+    return response_class(
+        content=data["content"],
+        finish_reason=data["finish_reason"],
+        message=Message.model_validate(message),
+        prompt=Prompt(**data["prompt"]),
+    )
@@ -0,0 +1,87 @@
+import logging
+import threading
+import typing as t
+from copy import deepcopy
+
+from flow_prompt.cancellation import CancellationToken
+from flow_prompt.exceptions import CallCancelledError, ConnectionLostError
+from flow_prompt.responses import AIResponse
+
+logger = logging.getLogger(__name__)
+
+WAIT_INTERVAL_SECONDS = 0.1
+REUSED_FROM_SINGLE_FLIGHT = "single_flight"
+# errors of the leader's own call, not of the provider
+LEADER_ERRORS = (CallCancelledError, ConnectionLostError)
+
+
+class _InFlightCall:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result: AIResponse = None
+        self.error: Exception = None
+        self.waiters = 0
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent identical calls. The first caller with a key calls the AI model,
+    the others wait for it and receive a copy of its response or its error.
+    If the leader's call is cancelled, the waiters call again and one of them leads.
+    Can be shared between FlowPrompt instances.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls: t.Dict[str, _InFlightCall] = {}
+
+    def do(
+        self,
+        key: str,
+        function: t.Callable[[], AIResponse],
+        cancellation_token: CancellationToken = None,
+    ) -> AIResponse:
+        while True:
+            with self._lock:
+                call = self._calls.get(key)
+                is_leader = call is None
+                if is_leader:
+                    call = _InFlightCall()
+                    self._calls[key] = call
+                else:
+                    call.waiters += 1
+            if is_leader:
+                return self._lead(key, call, function)
+
+            logger.debug(f"Waiting for in-flight call {key}")
+            while not call.done.wait(WAIT_INTERVAL_SECONDS):
+                if cancellation_token:
+                    cancellation_token.raise_if_cancelled()
+            if call.error:
+                raise call.error
+            if call.result is None:
+                logger.debug(f"In-flight call {key} was cancelled, calling again")
+                continue
+            result = deepcopy(call.result)
+            result.metrics.reused_from = REUSED_FROM_SINGLE_FLIGHT
+            return result
+
+    def _lead(
+        self, key: str, call: _InFlightCall, function: t.Callable[[], AIResponse]
+    ) -> AIResponse:
+        result = None
+        try:
+            result = function()
+            return result
+        except LEADER_ERRORS:
+            raise
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            if call.waiters and result is not None:
+                # the leader's response is changed by the caller, waiters get a snapshot
+                call.result = deepcopy(result)
+            call.done.set()
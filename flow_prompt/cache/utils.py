@@ -0,0 +1,43 @@
+import hashlib
+import json
+import typing as t
+
+from flow_prompt.ai_models.ai_model import AIModel
+from flow_prompt.utils import DecimalEncoder
+
+
+def is_deterministic_call(params: t.Dict[str, t.Any]) -> bool:
+    # streamed answers are delivered to the caller's connection, can't be shared
+    return not params.get("stream") and not params.get("temperature")
+
+
+def get_call_key(
+    messages: t.List[dict], ai_model: AIModel, params: t.Dict[str, t.Any]
+) -> str:
+    return _get_hash(
+        {
+            "messages": messages,
+            "provider": ai_model.provider.value,
+            "ai_model": ai_model.get_metrics_data(),
+            "params": params,
+        }
+    )
+
+
+def get_scope_key(
+    prompt_id: str, ai_model: AIModel, params: t.Dict[str, t.Any]
+) -> str:
+    # responses are similar only for the same prompt, model and params
+    return _get_hash(
+        {
+            "prompt_id": prompt_id,
+            "provider": ai_model.provider.value,
+            "ai_model": ai_model.get_metrics_data(),
+            "params": params,
+        }
+    )
+
+
+def _get_hash(data: dict) -> str:
+    dumped = json.dumps(data, sort_keys=True, cls=DecimalEncoder, default=str)
+    return hashlib.sha256(dumped.encode()).hexdigest()
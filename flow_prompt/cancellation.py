@@ -0,0 +1,100 @@
+import logging
+import threading
+import typing as t
+from time import monotonic
+
+from flow_prompt.exceptions import CallCancelledError, DeadlineExceededError
+
+logger = logging.getLogger(__name__)
+
+
+class CancellationToken:
+    """
+    Token to abort an in-flight FlowPrompt.call from another thread.
+    AI models register callbacks (closing the HTTP client or the stream) which are
+    executed as soon as the token is cancelled.
+    A token can have a deadline, after which it's considered expired.
+    """
+
+    def __init__(
+        self,
+        timeout: t.Optional[float] = None,
+        parent: t.Optional["CancellationToken"] = None,
+    ):
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks: t.Dict[int, t.Callable] = {}
+        self._next_callback_id = 0
+        self._error: t.Optional[Exception] = None
+        self.deadline = monotonic() + timeout if timeout is not None else None
+        self.parent = parent
+        self._parent_callback_id = None
+        if parent:
+            if parent.deadline is not None and (
+                self.deadline is None or parent.deadline < self.deadline
+            ):
+                self.deadline = parent.deadline
+            self._parent_callback_id = parent.register(self.cancel)
+
+    @property
+    def is_cancelled(self) -> bool:
+        return self._event.is_set()
+
+    @property
+    def is_expired(self) -> bool:
+        return self.deadline is not None and monotonic() >= self.deadline
+
+    def remaining(self) -> t.Optional[float]:
+        if self.deadline is None:
+            return None
+        return max(self.deadline - monotonic(), 0.0)
+
+    def cancel(self, error: t.Optional[Exception] = None):
+        """error is raised by raise_if_cancelled instead of CallCancelledError"""
+        with self._lock:
+            if self._event.is_set():
+                return
+            self._error = error
+            self._event.set()
+            callbacks = list(self._callbacks.values())
+            self._callbacks.clear()
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                logger.debug(f"Cancellation callback failed: {e}")
+
+    def register(self, callback: t.Callable) -> int:
+        """
+        Registers callback to be called on cancel, if the token is already cancelled
+        callback is called immediately. Returns id to unregister the callback.
+        """
+        with self._lock:
+            self._next_callback_id += 1
+            callback_id = self._next_callback_id
+            if not self._event.is_set():
+                self._callbacks[callback_id] = callback
+                return callback_id
+        callback()
+        return callback_id
+
+    def unregister(self, callback_id: int):
+        with self._lock:
+            self._callbacks.pop(callback_id, None)
+
+    def raise_if_cancelled(self):
+        if self._event.is_set():
+            if self._error is not None:
+                raise self._error
+            if self.is_expired:
+                raise DeadlineExceededError("Deadline of the call is exceeded")
+            raise CallCancelledError("Call was cancelled")
+        if self.is_expired:
+            self.cancel()
+            raise DeadlineExceededError("Deadline of the call is exceeded")
+
+    def release(self):
+        """Detaches the token from the parent token"""
+        if self.parent and self._parent_callback_id is not None:
+            self.parent.unregister(self._parent_callback_id)
+            self._parent_callback_id = None
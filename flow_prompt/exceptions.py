@@ -38,4 +38,16 @@ class NotParsedResponseException(FlowPromptError):
     pass
 
 class APITokenNotProvided(FlowPromptError):
-    pass
\ No newline at end of file
+    pass
+
+
+class CallCancelledError(FlowPromptError):
+    pass
+
+
+class DeadlineExceededError(CallCancelledError):
+    pass
+
+
+class OutputValidationError(RetryableCustomError):
+    """Response doesn't match the output schema of the prompt"""
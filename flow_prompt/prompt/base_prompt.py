@@ -42,6 +42,7 @@ class BasePrompt:
         label: t.Optional[str] = None,
         presentation: t.Optional[str] = None,
         last_words: t.Optional[str] = None,
+        cacheable: bool = False,
     ):
         if not isinstance(content, str):
             logger.warning(f"content is not string: {content}, assignig str of it")
@@ -63,6 +64,7 @@ class BasePrompt:
             label=label,
             presentation=presentation,
             last_words=last_words,
+            cacheable=cacheable,
         )
         self.chats.append(chat_value)
         self.priorities[priority].append(chat_value)
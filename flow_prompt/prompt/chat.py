@@ -1,4 +1,5 @@
 import logging
+import re
 import typing as t
 import uuid
 from dataclasses import dataclass
@@ -8,6 +9,8 @@ from flow_prompt.utils import resolve
 
 logger = logging.getLogger(__name__)
 
+PLACEHOLDER_RE = re.compile(r"\{[^{}\s]+\}")
+
 
 @dataclass
 class ValuesCost:
@@ -70,10 +73,21 @@ class ChatsEntity:
     last_words: t.Optional[str] = None
     ref_name: t.Optional[str] = None
     ref_value: t.Optional[str] = None
+    # content with placeholders which rarely changes, e.g. a set of documents
+    cacheable: bool = False
 
     def __post_init__(self):
         self._uuid = uuid.uuid4().hex
 
+    @property
+    def is_static(self) -> bool:
+        """Content is the same for every context, so it can be cached by providers"""
+        return not self.is_multiple and not PLACEHOLDER_RE.search(self.content or "")
+
+    @property
+    def is_cacheable(self) -> bool:
+        return self.cacheable or self.is_static
+
     def resolve(self, context: t.Dict[str, t.Any]) -> t.List[ChatMessage]:
         result = []
         content = self.content
@@ -147,6 +161,8 @@ class ChatsEntity:
         for k, v in list(data.items()):
             if v is None:
                 del data[k]
+        if self.cacheable:
+            data["cacheable"] = True
         return data
 
     @classmethod
@@ -169,4 +185,5 @@ class ChatsEntity:
             last_words=data.get("last_words"),
             ref_name=data.get("ref_name"),
             ref_value=data.get("ref_value"),
+            cacheable=data.get("cacheable", False),
         )
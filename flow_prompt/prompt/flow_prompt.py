@@ -2,23 +2,52 @@ import logging
 import typing as t
 from dataclasses import dataclass
 from decimal import Decimal
+from functools import partial
+import os
 import requests
+import tempfile
 import time
+import weakref
 from flow_prompt.settings import FLOW_PROMPT_API_URI
 from flow_prompt import Secrets, settings
 from flow_prompt.ai_models.ai_model import AI_MODELS_PROVIDER
 from flow_prompt.ai_models.attempt_to_call import AttemptToCall
 from flow_prompt.ai_models.behaviour import AIModelsBehaviour, PromptAttempts
+from flow_prompt.ai_models.constants import BATCH_PRICE_RATIO
+from flow_prompt.ai_models.openai.responses import FINISH_REASON_ERROR
+from flow_prompt.cache.near_duplicate import (
+    REUSED_FROM_NEAR_DUPLICATE,
+    NearDuplicateCache,
+)
+from flow_prompt.cache.response_cache import REUSED_FROM_CACHE, ResponseCache
+from flow_prompt.cache.single_flight import SingleFlight
+from flow_prompt.cache.utils import (
+    get_call_key,
+    get_scope_key,
+    is_deterministic_call,
+)
+from flow_prompt.cancellation import CancellationToken
 from flow_prompt.exceptions import (
+    CallCancelledError,
     FlowPromptIsnotFoundError,
     RetryableCustomError
 )
-from flow_prompt.services.SaveWorker import SaveWorker
+from flow_prompt.services.SaveWorker import SaveWorker, acquire_worker, release_worker
 from flow_prompt.prompt.pipe_prompt import PipePrompt
 from flow_prompt.prompt.user_prompt import UserPrompt
-from flow_prompt.responses import AIResponse
+from flow_prompt.response_parsers.schema_validator import call_and_validate, is_valid
+from flow_prompt.response_parsers.stream_parser import StreamParser, get_root_type
+from flow_prompt.responses import AIResponse, LeanAIResponse
 from flow_prompt.services.flow_prompt import FlowPromptService
-from flow_prompt.utils import current_timestamp_ms
+from flow_prompt.services.sampling import SamplingPolicy
+from flow_prompt.streaming import (
+    FlushPolicy,
+    StreamEvent,
+    StreamHandler,
+    aiterate_events,
+    iterate_events,
+)
+from flow_prompt.utils import DecimalEncoder, current_timestamp_ms
 import json
 
 logger = logging.getLogger(__name__)
@@ -32,6 +61,19 @@ class FlowPrompt:
     gemini_key: str = None
     azure_keys: t.Dict[str, str] = None
     secrets: Secrets = None
+    # coalesces concurrent identical deterministic calls, can be shared between instances
+    single_flight: SingleFlight = None
+    # cache of responses for deterministic calls, MemoryResponseCache or SQLiteResponseCache
+    response_cache: ResponseCache = None
+    # opt-in reuse of responses for almost identical prompts from its allow-list
+    near_duplicate_cache: NearDuplicateCache = None
+    # return slotted LeanAIResponse without SDK objects, the raw payload only if keep_original_result
+    lean_responses: bool = settings.LEAN_RESPONSES
+    keep_original_result: bool = False
+    # sends interactions to Flow Prompt, the worker shared by the process is used by default
+    worker: SaveWorker = None
+    # decides which interactions are logged, all of them by default
+    sampling_policy: SamplingPolicy = None
 
     clients = {}
 
@@ -78,7 +120,14 @@ class FlowPrompt:
             self.clients[AI_MODELS_PROVIDER.CLAUDE] = {'api_key': self.claude_key}
         if self.gemini_key:
             self.clients[AI_MODELS_PROVIDER.GEMINI] = {'api_key': self.gemini_key}
-        self.worker = SaveWorker()
+        if self.sampling_policy is None:
+            self.sampling_policy = SamplingPolicy()
+        self._release_worker = None
+        if self.worker is None:
+            self.worker = acquire_worker()
+            # the shared worker is released by close or when the instance is collected
+            self._release_worker = weakref.finalize(self, release_worker, self.worker)
+            self._release_worker.atexit = False
 
     
     def create_test(self, 
@@ -121,18 +170,190 @@ class FlowPrompt:
         stream_function: t.Callable = None,
         check_connection: t.Callable = None,
         stream_params: dict = {},
+        timeout: float = None,
+        cancellation_token: CancellationToken = None,
+        flush_policy: FlushPolicy = None,
+        parser_class: t.Type[StreamParser] = None,
+        stop_when_complete: bool = False,
     ) -> AIResponse:
         
         """
         Call flow prompt with context and behaviour
+        timeout - overall time budget in seconds for all attempts,
+        each attempt gets only the remaining time
+        cancellation_token - token to abort the call from another thread
+        flush_policy - how streamed deltas are coalesced before stream_function
+        parser_class - incremental parser of the streamed answer (JSONStreamParser, YAMLStreamParser),
+        it expects the root type of output_schema if the schema declares an object or an array
+        stop_when_complete - the call is streamed and the provider stream is closed as soon as
+        parser_class has the whole structure, finish_reason is FINISH_REASON_STRUCTURE_COMPLETE
         """
         
         logger.debug(f"Calling {prompt_id}")
+        if stop_when_complete:
+            if parser_class is None:
+                raise ValueError("stop_when_complete requires parser_class")
+            params = {**params, "stream": True}
+        token = CancellationToken(timeout=timeout, parent=cancellation_token)
+        try:
+            return self._call(
+                prompt_id,
+                context,
+                behaviour,
+                params=params,
+                version=version,
+                count_of_retries=count_of_retries,
+                test_data=test_data,
+                stream_function=stream_function,
+                check_connection=check_connection,
+                stream_params=stream_params,
+                token=token,
+                flush_policy=flush_policy,
+                parser_class=parser_class,
+                stop_when_complete=stop_when_complete,
+            )
+        finally:
+            token.release()
+
+    def stream(
+        self,
+        prompt_id: str,
+        context: t.Dict[str, str],
+        behaviour: AIModelsBehaviour,
+        params: t.Dict[str, t.Any] = {},
+        version: str = None,
+        count_of_retries: int = None,
+        test_data: dict = {},
+        timeout: float = None,
+        cancellation_token: CancellationToken = None,
+        max_buffered_events: int = settings.STREAM_MAX_BUFFERED_EVENTS,
+        flush_policy: FlushPolicy = None,
+        parser_class: t.Type[StreamParser] = None,
+        stop_when_complete: bool = False,
+    ) -> t.Iterator[StreamEvent]:
+        """
+        Streams the call as typed events: TextDelta, ToolCallDelta, Usage,
+        and FinalResponse with the AIResponse as the last event.
+        With parser_class (JSONStreamParser or YAMLStreamParser) completed top-level
+        fields and list items of the answer are emitted as ParsedValue events,
+        with stop_when_complete the stream is closed when the whole structure is received.
+        The AI model is called in a background thread which waits while
+        max_buffered_events are not consumed. Closing the generator cancels the call.
+        """
+        logger.debug(f"Streaming {prompt_id}")
+        token = CancellationToken(timeout=timeout, parent=cancellation_token)
+        run = self._get_stream_run(
+            prompt_id,
+            context,
+            behaviour,
+            params=params,
+            version=version,
+            count_of_retries=count_of_retries,
+            test_data=test_data,
+            token=token,
+            flush_policy=flush_policy,
+            parser_class=parser_class,
+            stop_when_complete=stop_when_complete,
+        )
+        return iterate_events(run, token, max_buffered_events)
+
+    async def astream(
+        self,
+        prompt_id: str,
+        context: t.Dict[str, str],
+        behaviour: AIModelsBehaviour,
+        params: t.Dict[str, t.Any] = {},
+        version: str = None,
+        count_of_retries: int = None,
+        test_data: dict = {},
+        timeout: float = None,
+        cancellation_token: CancellationToken = None,
+        max_buffered_events: int = settings.STREAM_MAX_BUFFERED_EVENTS,
+        flush_policy: FlushPolicy = None,
+        parser_class: t.Type[StreamParser] = None,
+        stop_when_complete: bool = False,
+    ) -> t.AsyncIterator[StreamEvent]:
+        """Async version of stream"""
+        logger.debug(f"Streaming {prompt_id}")
+        token = CancellationToken(timeout=timeout, parent=cancellation_token)
+        run = self._get_stream_run(
+            prompt_id,
+            context,
+            behaviour,
+            params=params,
+            version=version,
+            count_of_retries=count_of_retries,
+            test_data=test_data,
+            token=token,
+            flush_policy=flush_policy,
+            parser_class=parser_class,
+            stop_when_complete=stop_when_complete,
+        )
+        async for event in aiterate_events(run, token, max_buffered_events):
+            yield event
+
+    def _get_stream_run(
+        self,
+        prompt_id: str,
+        context: t.Dict[str, str],
+        behaviour: AIModelsBehaviour,
+        params: t.Dict[str, t.Any],
+        version: str,
+        count_of_retries: int,
+        test_data: dict,
+        token: CancellationToken,
+        flush_policy: FlushPolicy,
+        parser_class: t.Type[StreamParser],
+        stop_when_complete: bool,
+    ) -> t.Callable[[t.Callable[[StreamEvent], None]], AIResponse]:
+        def run(on_event: t.Callable[[StreamEvent], None]) -> AIResponse:
+            try:
+                return self._call(
+                    prompt_id,
+                    context,
+                    behaviour,
+                    params={**params, "stream": True},
+                    version=version,
+                    count_of_retries=count_of_retries,
+                    test_data=test_data,
+                    stream_function=None,
+                    check_connection=None,
+                    stream_params={},
+                    token=token,
+                    on_event=on_event,
+                    flush_policy=flush_policy,
+                    parser_class=parser_class,
+                    stop_when_complete=stop_when_complete,
+                )
+            finally:
+                token.release()
+
+        return run
+
+    def _call(
+        self,
+        prompt_id: str,
+        context: t.Dict[str, str],
+        behaviour: AIModelsBehaviour,
+        params: t.Dict[str, t.Any],
+        version: str,
+        count_of_retries: int,
+        test_data: dict,
+        stream_function: t.Callable,
+        check_connection: t.Callable,
+        stream_params: dict,
+        token: CancellationToken,
+        on_event: t.Callable[[StreamEvent], None] = None,
+        flush_policy: FlushPolicy = None,
+        parser_class: t.Type[StreamParser] = None,
+        stop_when_complete: bool = False,
+    ) -> AIResponse:
         start_time = current_timestamp_ms()
         pipe_prompt = self.get_pipe_prompt(prompt_id, version)
         prompt_attempts = PromptAttempts(behaviour, count_of_retries=count_of_retries)
 
         while prompt_attempts.initialize_attempt():
+            token.raise_if_cancelled()
             current_attempt = prompt_attempts.current_attempt
             user_prompt = pipe_prompt.create_prompt(current_attempt)
             calling_messages = user_prompt.resolve(context)
@@ -141,53 +362,333 @@ class FlowPrompt:
             Create CI/CD when calling first time
             """
             try:
-                result = current_attempt.ai_model.call(
-                    calling_messages.get_messages(),
-                    calling_messages.max_sample_budget,
+                messages = calling_messages.get_messages()
+                stream_handler = StreamHandler(
                     stream_function=stream_function,
                     check_connection=check_connection,
                     stream_params=stream_params,
+                    on_event=on_event,
+                    cancellation_token=token,
+                    flush_policy=flush_policy,
+                    parser=(
+                        parser_class(root_type=get_root_type(pipe_prompt.output_schema))
+                        if parser_class
+                        else None
+                    ),
+                    stop_when_complete=stop_when_complete,
+                )
+                call_ai_model = partial(
+                    current_attempt.ai_model.call,
+                    messages,
+                    calling_messages.max_sample_budget,
+                    stream_handler=stream_handler,
                     client_secrets=self.clients[current_attempt.ai_model.provider],
+                    cancellation_token=token,
+                    static_prefix_count=calling_messages.static_prefix_count,
                     **params,
                 )
-
-                sample_budget = self.calculate_budget_for_text(
-                    user_prompt, result.get_message_str()
+                validate = (
+                    pipe_prompt.validate_output
+                    if pipe_prompt.output_schema is not None
+                    else None
                 )
-                result.metrics.price_of_call = self.get_price(
+                try:
+                    result = self._get_response(
+                        call_ai_model,
+                        messages,
+                        pipe_prompt.id,
+                        current_attempt,
+                        params,
+                        token,
+                        validate=validate,
+                    )
+                    stream_handler.finish()
+                finally:
+                    stream_handler.close()
+
+                self._set_metrics(
+                    result,
                     current_attempt,
-                    sample_budget,
+                    user_prompt,
                     calling_messages.prompt_budget,
+                    start_time,
                 )
-                result.metrics.sample_tokens_used = sample_budget
-                result.metrics.prompt_tokens_used = calling_messages.prompt_budget
-                result.metrics.ai_model_details = (
-                    current_attempt.ai_model.get_metrics_data()
+                stream_handler.update_metrics(
+                    result.metrics, result.metrics.sample_tokens_used
+                )
+                result = self._get_returned_response(result)
+                self._save_interaction(
+                    pipe_prompt,
+                    context,
+                    result,
+                    test_data,
+                    attempt_number=current_attempt.attempt_number,
                 )
-                result.metrics.latency = current_timestamp_ms() - start_time
-
-                if settings.USE_API_SERVICE and self.api_token:
-                    timestamp = int(time.time() * 1000)
-                    result.id = f"{prompt_id}#{timestamp}"
-                    
-                    self.worker.add_task(
-                        self.api_token,
-                        pipe_prompt.service_dump(),
-                        context,
-                        result,
-                        test_data
-                    )
                 return result
             except RetryableCustomError as e:
                 logger.error(
                     f"Attempt failed: {prompt_attempts.current_attempt} with retryable error: {e}"
                 )
+                token.raise_if_cancelled()
+                self._save_failed_attempt(
+                    pipe_prompt, context, test_data, current_attempt, start_time
+                )
             except Exception as e:
                 logger.exception(
                     f"Attempt failed: {prompt_attempts.current_attempt} with non-retryable error: {e}"
                 )
+                token.raise_if_cancelled()
+                if not isinstance(e, CallCancelledError):
+                    self._save_failed_attempt(
+                        pipe_prompt, context, test_data, current_attempt, start_time
+                    )
                 raise e
 
+    def _get_response(
+        self,
+        call_ai_model: t.Callable[[], AIResponse],
+        messages: t.List[dict],
+        prompt_id: str,
+        attempt: AttemptToCall,
+        params: t.Dict[str, t.Any],
+        token: CancellationToken,
+        validate: t.Callable[[AIResponse], None] = None,
+    ) -> AIResponse:
+        """
+        Calls AI model through the response caches and the single flight if they are set.
+        validate raises OutputValidationError for invalid responses, they aren't cached
+        and cached responses which are not valid anymore are not reused.
+        """
+        if validate is not None:
+            call_ai_model = partial(call_and_validate, call_ai_model, validate)
+        near_duplicate_cache = self.near_duplicate_cache
+        if near_duplicate_cache is not None and not near_duplicate_cache.is_allowed(
+            prompt_id
+        ):
+            near_duplicate_cache = None
+        if not is_deterministic_call(params) or (
+            self.single_flight is None
+            and self.response_cache is None
+            and near_duplicate_cache is None
+        ):
+            return call_ai_model()
+        key = get_call_key(messages, attempt.ai_model, params)
+        if self.response_cache is not None:
+            result = self.response_cache.get(key)
+            if result and is_valid(result, validate):
+                logger.debug(f"Response {key} is taken from cache")
+                result.metrics.reused_from = REUSED_FROM_CACHE
+                return result
+        if near_duplicate_cache is not None:
+            scope = get_scope_key(prompt_id, attempt.ai_model, params)
+            # AI models may change the messages, the signature is taken before the call
+            signature = near_duplicate_cache.get_signature(messages)
+            result = near_duplicate_cache.get(scope, messages, signature)
+            if result and is_valid(result, validate):
+                logger.debug(f"Response for {prompt_id} is taken from near duplicate")
+                result.metrics.reused_from = REUSED_FROM_NEAR_DUPLICATE
+                return result
+        if self.single_flight is not None:
+            result = self.single_flight.do(key, call_ai_model, token)
+        else:
+            result = call_ai_model()
+        if result.metrics.reused_from:
+            return result
+        if self.response_cache is not None:
+            self.response_cache.set(key, result)
+        if near_duplicate_cache is not None:
+            near_duplicate_cache.set(scope, messages, result, signature)
+        return result
+
+    def submit_batch(
+        self,
+        prompt_id: str,
+        contexts: t.List[t.Dict[str, str]],
+        behaviour: AIModelsBehaviour,
+        params: t.Dict[str, t.Any] = {},
+        version: str = None,
+        poll_interval: float = settings.BATCH_POLL_INTERVAL_SECONDS,
+        timeout: float = None,
+        requests_path: str = None,
+    ) -> t.List[AIResponse]:
+        """
+        Call flow prompt for each context through the batch endpoint of the provider.
+        Requests are written to the JSONL file (temporary if requests_path is not set),
+        the batch is submitted and polled until it's finished.
+        Returns responses in the order of contexts, failed requests have FINISH_REASON_ERROR
+        """
+        logger.debug(f"Submitting batch of {len(contexts)} contexts for {prompt_id}")
+        start_time = current_timestamp_ms()
+        token = CancellationToken(timeout=timeout)
+        pipe_prompt = self.get_pipe_prompt(prompt_id, version)
+        attempt = PromptAttempts(behaviour).initialize_attempt()
+        ai_model = attempt.ai_model
+        client_secrets = self.clients[ai_model.provider]
+        user_prompt = pipe_prompt.create_prompt(attempt)
+
+        is_temp_file = not requests_path
+        if is_temp_file:
+            with tempfile.NamedTemporaryFile(suffix=".jsonl", delete=False) as f:
+                requests_path = f.name
+        budgets = {}
+        try:
+            with open(requests_path, "w") as requests_file:
+                for i, context in enumerate(contexts):
+                    calling_messages = user_prompt.resolve(context)
+                    custom_id = f"request-{i}"
+                    request = ai_model.get_batch_request(
+                        custom_id,
+                        calling_messages.get_messages(),
+                        calling_messages.max_sample_budget,
+                        **params,
+                    )
+                    requests_file.write(json.dumps(request, cls=DecimalEncoder) + "\n")
+                    budgets[custom_id] = (
+                        i,
+                        calling_messages.prompt_budget,
+                        calling_messages.max_sample_budget,
+                    )
+            batch_id = ai_model.submit_batch(requests_path, client_secrets)
+        finally:
+            if is_temp_file:
+                os.remove(requests_path)
+        logger.info(f"Submitted batch {batch_id} with {len(contexts)} requests")
+
+        while not ai_model.is_batch_finished(batch_id, client_secrets):
+            token.raise_if_cancelled()
+            remaining = token.remaining()
+            # the timeout is raised when it passes, not after the next poll
+            time.sleep(poll_interval if remaining is None else min(poll_interval, remaining))
+
+        responses: t.List[AIResponse] = [None] * len(contexts)
+        for custom_id, result in ai_model.get_batch_results(batch_id, client_secrets):
+            if custom_id not in budgets:
+                logger.warning(f"Unknown request {custom_id} in batch {batch_id}")
+                continue
+            i, prompt_budget, max_sample_budget = budgets[custom_id]
+            result.prompt.max_tokens = max_sample_budget
+            if result.finish_reason == FINISH_REASON_ERROR:
+                result.metrics.ai_model_details = ai_model.get_metrics_data()
+                result = self._get_returned_response(result)
+                # errors are tail interactions of the sampling policy
+                self._save_interaction(pipe_prompt, contexts[i], result)
+            else:
+                self._set_metrics(
+                    result, attempt, user_prompt, prompt_budget, start_time, is_batch=True
+                )
+                result = self._get_returned_response(result)
+                self._save_interaction(pipe_prompt, contexts[i], result)
+            responses[i] = result
+        for i, response in enumerate(responses):
+            if response is None:
+                logger.error(f"Request {i} is missing in results of batch {batch_id}")
+                responses[i] = self._get_returned_response(
+                    AIResponse(finish_reason=FINISH_REASON_ERROR)
+                )
+        return responses
+
+    def _set_metrics(
+        self,
+        result: AIResponse,
+        attempt: AttemptToCall,
+        user_prompt: UserPrompt,
+        prompt_budget: int,
+        start_time: int,
+        is_batch: bool = False,
+    ):
+        sample_budget = self.calculate_budget_for_text(
+            user_prompt, result.get_message_str()
+        )
+        if result.metrics.reused_from:
+            result.metrics.price_of_call = Decimal(0)
+        else:
+            result.metrics.price_of_call = self.get_price(
+                attempt,
+                sample_budget,
+                prompt_budget,
+                is_batch=is_batch,
+                cache_read_tokens=result.metrics.cache_read_tokens or 0,
+                cache_creation_tokens=result.metrics.cache_creation_tokens or 0,
+            )
+        result.metrics.sample_tokens_used = sample_budget
+        result.metrics.prompt_tokens_used = prompt_budget
+        result.metrics.ai_model_details = attempt.ai_model.get_metrics_data()
+        result.metrics.latency = current_timestamp_ms() - start_time
+
+    def _get_returned_response(
+        self, result: AIResponse
+    ) -> t.Union[AIResponse, LeanAIResponse]:
+        if not self.lean_responses:
+            return result
+        return LeanAIResponse.from_response(
+            result, keep_original_result=self.keep_original_result
+        )
+
+    def _save_failed_attempt(
+        self,
+        pipe_prompt: PipePrompt,
+        context: t.Dict[str, str],
+        test_data: dict,
+        attempt: AttemptToCall,
+        start_time: int,
+    ):
+        """Failed attempt is logged as an error response if the sampling policy keeps it"""
+        result = AIResponse(finish_reason=FINISH_REASON_ERROR)
+        result.metrics.ai_model_details = attempt.ai_model.get_metrics_data()
+        result.metrics.latency = current_timestamp_ms() - start_time
+        try:
+            self._save_interaction(
+                pipe_prompt,
+                context,
+                result,
+                test_data,
+                attempt_number=attempt.attempt_number,
+            )
+        except Exception as e:
+            logger.exception(f"Failed to save failed attempt: {e}")
+
+    def _save_interaction(
+        self,
+        pipe_prompt: PipePrompt,
+        context: t.Dict[str, str],
+        result: AIResponse,
+        test_data: dict = {},
+        attempt_number: int = 1,
+    ):
+        if not (settings.USE_API_SERVICE and self.api_token):
+            return
+        # sampled out interactions aren't serialized at all
+        if not self.sampling_policy.is_kept(pipe_prompt.id, result, attempt_number, test_data):
+            return
+        timestamp = int(time.time() * 1000)
+        result.id = f"{pipe_prompt.id}#{timestamp}"
+
+        self.worker.add_task(
+            self.api_token,
+            pipe_prompt.service_dump(),
+            context,
+            result,
+            test_data
+        )
+
+    def flush(self, timeout: float = None) -> bool:
+        """
+        Sends saved interactions without waiting for the batch to fill up,
+        returns False if they aren't sent in timeout seconds
+        """
+        return self.worker.flush(timeout)
+
+    def close(self, timeout: float = None) -> bool:
+        """
+        Flushes saved interactions and releases the shared worker,
+        it keeps running for other instances and is closed on interpreter exit.
+        Passed worker is only flushed, it's closed by its owner.
+        """
+        is_flushed = self.worker.flush(timeout)
+        if self._release_worker is not None:
+            self._release_worker()
+        return is_flushed
+
     def add_ideal_answer(
         self,
         response_id: str,
@@ -298,6 +799,20 @@ class FlowPrompt:
         return len(user_prompt.encoding.encode(text))
 
     def get_price(
-        self, attempt: AttemptToCall, sample_budget: int, prompt_budget: int
+        self,
+        attempt: AttemptToCall,
+        sample_budget: int,
+        prompt_budget: int,
+        is_batch: bool = False,
+        cache_read_tokens: int = 0,
+        cache_creation_tokens: int = 0,
     ) -> Decimal:
-        return attempt.ai_model.get_prompt_price(prompt_budget) + attempt.ai_model.get_sample_price(prompt_budget, sample_budget)
\ No newline at end of file
+        prompt_price = attempt.ai_model.get_prompt_price(
+            prompt_budget,
+            cache_read_tokens=cache_read_tokens,
+            cache_creation_tokens=cache_creation_tokens,
+        )
+        price = prompt_price + attempt.ai_model.get_sample_price(prompt_budget, sample_budget)
+        if is_batch:
+            price = attempt.ai_model._decimal(price * BATCH_PRICE_RATIO)
+        return price
\ No newline at end of file
@@ -1,12 +1,18 @@
 import logging
 from copy import deepcopy
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 
 from flow_prompt import settings
 from flow_prompt.ai_models.attempt_to_call import AttemptToCall
 from flow_prompt.prompt.base_prompt import BasePrompt
 from flow_prompt.prompt.chat import ChatsEntity
 from flow_prompt.prompt.user_prompt import UserPrompt
+from flow_prompt.response_parsers.schema_validator import (
+    Validator,
+    get_validator,
+    validate_response,
+)
+from flow_prompt.responses import AIResponse
 from flow_prompt.settings import PIPE_PROMPTS
 
 logger = logging.getLogger(__name__)
@@ -18,6 +24,8 @@ class PipePrompt(BasePrompt):
     PipePrompt is a class that represents a pipe of chats that will be used to generate a prompt.
     You can add chats with different priorities to the pipe thinking just about the order of chats.
     When you initialize a Prompt, chats will be sorted by priority and then by order of adding.
+    If output_schema (JSON schema) is set, JSON of every response is validated with it
+    and the call is retried with the next attempt if it doesn't match.
     """
 
     id: str = None
@@ -25,14 +33,27 @@ class PipePrompt(BasePrompt):
     min_sample_tokens: int = settings.DEFAULT_SAMPLE_MIN_BUDGET
     reserved_tokens_budget_for_sampling: int = None
     version: str = None
+    output_schema: dict = None
+    _output_validator: Validator = field(
+        default=None, init=False, repr=False, compare=False
+    )
 
     def __post_init__(self):
         if not self.id:
             raise ValueError("PipePrompt id is required")
         if self.max_tokens:
             self.max_tokens = int(self.max_tokens)
+        if self.output_schema is not None:
+            self._output_validator = get_validator(self.output_schema)
         self._save_in_local_storage()
 
+    def __setattr__(self, name, value):
+        if name == "output_schema":
+            # an invalid schema raises ValueError when it's set, before any call
+            validator = None if value is None else get_validator(value)
+            super().__setattr__("_output_validator", validator)
+        super().__setattr__(name, value)
+
     def _save_in_local_storage(self):
         PIPE_PROMPTS[self.id] = self
 
@@ -41,6 +62,16 @@ class PipePrompt(BasePrompt):
             return min(self.max_tokens, ai_attempt.model_max_tokens())
         return ai_attempt.model_max_tokens()
 
+    def get_output_validator(self) -> Validator:
+        """Output schema is compiled when it's set"""
+        if self._output_validator is None:
+            self._output_validator = get_validator(self.output_schema)
+        return self._output_validator
+
+    def validate_output(self, response: AIResponse):
+        """Sets parsed_content of the response, raises OutputValidationError"""
+        validate_response(response, self.get_output_validator())
+
     def create_prompt(self, ai_attempt: AttemptToCall) -> UserPrompt:
         logger.debug(
             f"Creating prompt for {ai_attempt.ai_model} with {ai_attempt.attempt_number} attempt"
@@ -56,7 +87,7 @@ class PipePrompt(BasePrompt):
         )
 
     def dump(self) -> dict:
-        return {
+        dump = {
             "id": self.id,
             "max_tokens": self.max_tokens,
             "min_sample_tokens": self.min_sample_tokens,
@@ -67,6 +98,9 @@ class PipePrompt(BasePrompt):
             },
             "pipe": self.pipe,
         }
+        if self.output_schema is not None:
+            dump["output_schema"] = self.output_schema
+        return dump
 
     def service_dump(self) -> dict:
         dump = {
@@ -77,6 +111,8 @@ class PipePrompt(BasePrompt):
             "chats": [chat_value.dump() for chat_value in self.chats],
             "version": self.version,
         }
+        if self.output_schema is not None:
+            dump["output_schema"] = self.output_schema
         return dump
 
     @classmethod
@@ -89,6 +125,7 @@ class PipePrompt(BasePrompt):
                 "reserved_tokens_budget_for_sampling"
             ),
             version=data.get("version"),
+            output_schema=data.get("output_schema"),
         )
         for chat_value in data["chats"]:
             prompt.add(**chat_value)
@@ -110,6 +147,7 @@ class PipePrompt(BasePrompt):
             ),
             priorities=priorities,
             pipe=data["pipe"],
+            output_schema=data.get("output_schema"),
         )
 
     def copy(self, prompt_id: str):
@@ -35,6 +35,9 @@ class CallingMessages:
     left_budget: int = 0
     references: t.Dict[str, t.List[str]] = None
     max_sample_budget: int = 0
+    # count of leading messages without placeholders or marked as cacheable,
+    # providers can cache them between calls
+    static_prefix_count: int = 0
 
     @property
     def calling_messages(self) -> t.List[t.Dict[str, str]]:
@@ -132,6 +135,7 @@ class UserPrompt(BasePrompt):
         flat_list: t.List[ChatMessage] = [
             item for sublist in final_pipe_with_order for item in sublist if item
         ]
+        static_prefix_count = self.get_static_prefix_count(pipe)
         max_sample_budget = left_budget = state.left_budget + self.min_sample_tokens
         if self.reserved_tokens_budget_for_sampling:
             max_sample_budget = min(
@@ -143,8 +147,22 @@ class UserPrompt(BasePrompt):
             prompt_budget=prompt_budget,
             left_budget=left_budget,
             max_sample_budget=max_sample_budget,
+            static_prefix_count=static_prefix_count,
         )
 
+    def get_static_prefix_count(self, pipe: t.Dict[str, t.List[ChatMessage]]) -> int:
+        chats = {
+            chat_value._uuid: chat_value
+            for chat_values in self.priorities.values()
+            for chat_value in chat_values
+        }
+        count = 0
+        for chat_id in self.pipe:
+            if not chats[chat_id].is_cacheable:
+                break
+            count += len([m for m in pipe.get(chat_id, []) if not m.is_empty()])
+        return count
+
     def add_values_while_fits(
         self,
         values: list[ChatMessage],
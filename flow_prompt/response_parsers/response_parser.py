@@ -1,21 +1,34 @@
 from dataclasses import dataclass
+import ast
 import json
 import logging
+import re
+import typing as t
 
 import yaml
 
 from flow_prompt.exceptions import NotParsedResponseException
 from flow_prompt.responses import AIResponse
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 logger = logging.getLogger(__name__)
 
+# libyaml bindings are several times faster, pure python loader is used without them
+YAML_LOADER = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
 
-@dataclass
-class Tag:
-    start_tag: str
-    end_tag: str
-    include_tag: bool
-    is_right_find_end_ind: bool = False
+FENCE = "```"
+FENCE_RE = re.compile(r"```([\w+-]*)")
+# escaped chars are matched as a whole, so escaped quotes don't end strings
+BRACES_TOKEN_RE = re.compile(r'\\.|["{}]', re.DOTALL)
+
+FENCED_BLOCK = "fenced"
+BRACES_BLOCK = "braces"
+JSON_LANGUAGE = "json"
+YAML_LANGUAGES = ("yaml", "yml")
 
 
 @dataclass
@@ -26,72 +39,195 @@ class TaggedContent:
     parsed_content: any = None
 
 
+@dataclass
+class Block:
+    """
+    Fenced block (```json ... ```) or balanced {...} found in the response,
+    start_ind and end_ind are bounds of the content without the fence
+    """
+
+    kind: str
+    language: str
+    start_ind: int
+    end_ind: int
+
+
 def get_yaml_from_response(response: AIResponse):
-    content, start_ind, end_ind = _get_format_from_response(
-        response, [Tag("```yaml", "```", 0, 0), Tag("```", "```", 0, 0)]
-    )
+    text = response.response
+    block = None
+    for candidate in iter_blocks(text):
+        if candidate.kind != FENCED_BLOCK:
+            continue
+        if candidate.language in YAML_LANGUAGES:
+            block = candidate
+            break
+        block = block or candidate
+    if block is None:
+        return None
+    content = text[block.start_ind : block.end_ind].strip()
     parsed_content = None
     if content:
         try:
-            parsed_content = yaml.safe_load(content)
+            parsed_content = load_yaml(content)
         except Exception as e:
             logger.exception(f"Couldn't parse yaml:\n{content}")
         return TaggedContent(
             content=content,
             parsed_content=parsed_content,
-            start_ind=start_ind,
-            end_ind=end_ind,
+            start_ind=block.start_ind,
+            end_ind=block.end_ind,
         )
 
 
 def get_json_from_response(response: AIResponse, start_from: int = 0) -> TaggedContent:
-    content, start_ind, end_ind = _get_format_from_response(
-        response,
-        [Tag("```json", "\n```", 0), Tag("```json", "```", 0), Tag("{", "}", 1)],
-        start_from=start_from,
-    )
-    if content:
+    """
+    Content of the first ```json block or the first balanced {...} is parsed as JSON,
+    python literals (single quotes, True, None) are accepted as well
+    """
+    text = response.response
+    block = None
+    for candidate in iter_blocks(text, start_from):
+        if candidate.kind == FENCED_BLOCK and candidate.language == JSON_LANGUAGE:
+            block = candidate
+            break
+        if candidate.kind == BRACES_BLOCK and block is None:
+            block = candidate
+    if block is None:
+        return None
+    return _get_json_content(text, block)
+
+
+def iter_json_from_response(
+    response: AIResponse, start_from: int = 0
+) -> t.Iterator[TaggedContent]:
+    """
+    Yields every ```json block and top-level balanced {...} outside of them in order,
+    walking the text once. Braces which are not JSON (e.g. in prose) are skipped,
+    invalid ```json block raises NotParsedResponseException like get_json_from_response.
+    """
+    text = response.response
+    json_fence_end = -1
+    for block in iter_blocks(text, start_from):
+        if block.kind == FENCED_BLOCK:
+            if block.language != JSON_LANGUAGE:
+                continue
+            json_fence_end = block.end_ind
+        elif block.start_ind < json_fence_end:
+            continue
         try:
-            json_response = eval(content)
-            return TaggedContent(
-                content=content,
-                parsed_content=json_response,
-                start_ind=start_ind,
-                end_ind=end_ind,
-            )
-        except Exception as e:
-            try:
-                json_response = json.loads(content)
-                return TaggedContent(
-                    content=content,
-                    parsed_content=json_response,
-                    start_ind=start_ind,
-                    end_ind=end_ind,
-                )
-            except Exception as e:
-                logger.exception(f"Couldn't parse json:\n{content}")
-                raise NotParsedResponseException()
-
-
-def _get_format_from_response(
-    response: AIResponse, tags: list[Tag], start_from: int = 0
-):
-    start_ind, end_ind = 0, -1
-    content = response.response[start_from:]
-    for t in tags:
-        start_ind = content.find(t.start_tag)
-        if t.is_right_find_end_ind:
-            end_ind = content.rfind(t.end_tag, start_ind + len(t.start_tag))
+            tagged_content = _get_json_content(text, block)
+        except NotParsedResponseException:
+            if block.kind == FENCED_BLOCK:
+                raise
+            continue
+        if tagged_content is not None:
+            yield tagged_content
+
+
+def iter_tagged_content(
+    response: AIResponse, languages: t.Iterable[str] = None, start_from: int = 0
+) -> t.Iterator[TaggedContent]:
+    """Yields content of fenced blocks in order, only of languages if they are passed"""
+    text = response.response
+    languages = None if languages is None else {lang.lower() for lang in languages}
+    for block in iter_blocks(text, start_from):
+        if block.kind != FENCED_BLOCK:
+            continue
+        if languages is not None and block.language not in languages:
+            continue
+        yield TaggedContent(
+            content=text[block.start_ind : block.end_ind].strip(),
+            start_ind=block.start_ind,
+            end_ind=block.end_ind,
+        )
+
+
+def _get_json_content(text: str, block: Block) -> t.Optional[TaggedContent]:
+    end_ind = block.end_ind
+    if block.kind == FENCED_BLOCK and text[end_ind - 1 : end_ind] == "\n":
+        end_ind -= 1
+    content = text[block.start_ind : end_ind].strip()
+    if not content:
+        return None
+    try:
+        json_response = load_json(content)
+    except Exception:
+        if block.kind == FENCED_BLOCK:
+            logger.exception(f"Couldn't parse json:\n{content}")
+        else:
+            logger.debug(f"Couldn't parse json:\n{content}")
+        raise NotParsedResponseException()
+    return TaggedContent(
+        content=content,
+        parsed_content=json_response,
+        start_ind=block.start_ind,
+        end_ind=end_ind,
+    )
+
+
+def load_json(content: str) -> t.Any:
+    """Uses orjson if it's installed, falls back to python literals for dicts like {'key': True}"""
+    try:
+        if orjson is not None:
+            return orjson.loads(content)
+        return json.loads(content)
+    except ValueError:
+        return ast.literal_eval(content)
+
+
+def load_yaml(content: str) -> t.Any:
+    return yaml.load(content, Loader=YAML_LOADER)
+
+
+def iter_blocks(text: str, start_from: int = 0) -> t.Iterator[Block]:
+    """
+    Finds fenced blocks and balanced {...} in a single pass over the text,
+    braces inside fenced blocks are returned after the block itself.
+    Not closed fence lasts till the end of the text.
+    """
+    pos = start_from
+    while pos < len(text):
+        fence = text.find(FENCE, pos)
+        yield from _iter_braces(text, pos, len(text) if fence == -1 else fence)
+        if fence == -1:
+            return
+        match = FENCE_RE.match(text, fence)
+        close = text.find(FENCE, match.end())
+        end_ind = len(text) if close == -1 else close
+        yield Block(FENCED_BLOCK, match.group(1).lower(), match.end(), end_ind)
+        yield from _iter_braces(text, match.end(), end_ind)
+        if close == -1:
+            return
+        pos = close + len(FENCE)
+
+
+def _iter_braces(text: str, pos: int, end: int) -> t.Iterator[Block]:
+    while True:
+        start = text.find("{", pos, end)
+        if start == -1:
+            return
+        close = find_closing_brace(text, start, end)
+        if close is None:
+            return
+        yield Block(BRACES_BLOCK, "", start, close + 1)
+        pos = close + 1
+
+
+def find_closing_brace(text: str, start: int, end: int = None) -> t.Optional[int]:
+    """Index of the brace closing the one at start, braces in JSON strings are skipped"""
+    depth = 0
+    in_string = False
+    for match in BRACES_TOKEN_RE.finditer(text, start, len(text) if end is None else end):
+        token = match.group()
+        if token == '"':
+            in_string = not in_string
+        elif in_string or token[0] == "\\":
+            continue
+        elif token == "{":
+            depth += 1
         else:
-            end_ind = content.find(t.end_tag, start_ind + len(t.start_tag))
-        if start_ind != -1:
-            try:
-                if t.include_tag:
-                    end_ind += len(t.end_tag)
-                else:
-                    start_ind += len(t.start_tag)
-                response_tagged = content[start_ind:end_ind].strip()
-                return response_tagged, start_from + start_ind, start_from + end_ind
-            except Exception as e:
-                logger.exception(f"Couldn't parse json:\n{content}")
-    return None, 0, -1
+            depth -= 1
+            if depth == 0:
+                return match.start()
+    return None
+
@@ -0,0 +1,299 @@
+import json
+import logging
+import re
+import typing as t
+from functools import lru_cache
+
+from flow_prompt import settings
+from flow_prompt.exceptions import NotParsedResponseException, OutputValidationError
+from flow_prompt.response_parsers.response_parser import get_json_from_response
+from flow_prompt.responses import AIResponse
+
+logger = logging.getLogger(__name__)
+
+Validator = t.Callable[[t.Any], None]
+Check = t.Callable[[t.Any, str], None]
+
+ROOT_PATH = "$"
+TYPES = {
+    "object": lambda value: isinstance(value, dict),
+    "array": lambda value: isinstance(value, list),
+    "string": lambda value: isinstance(value, str),
+    "boolean": lambda value: isinstance(value, bool),
+    "null": lambda value: value is None,
+    "number": lambda value: isinstance(value, (int, float)) and not isinstance(value, bool),
+    "integer": lambda value: (
+        isinstance(value, int) and not isinstance(value, bool)
+        or isinstance(value, float) and value.is_integer()
+    ),
+}
+NUMBER_KEYWORDS = {
+    "minimum": lambda value, limit: value >= limit,
+    "maximum": lambda value, limit: value <= limit,
+    "exclusiveMinimum": lambda value, limit: value > limit,
+    "exclusiveMaximum": lambda value, limit: value < limit,
+}
+SUPPORTED_KEYWORDS = {
+    "type",
+    "enum",
+    "const",
+    "properties",
+    "required",
+    "additionalProperties",
+    "items",
+    "minItems",
+    "maxItems",
+    "minLength",
+    "maxLength",
+    "pattern",
+    *NUMBER_KEYWORDS,
+    "anyOf",
+    "oneOf",
+    "allOf",
+}
+# annotations don't change validation
+IGNORED_KEYWORDS = {
+    "$schema",
+    "$id",
+    "$comment",
+    "title",
+    "description",
+    "format",
+    "default",
+    "examples",
+    "deprecated",
+    "readOnly",
+    "writeOnly",
+    "contentEncoding",
+    "contentMediaType",
+}
+
+
+def get_validator(schema: dict) -> Validator:
+    """Compiled validator of the JSON schema, validators are cached by the schema"""
+    return _get_validator(json.dumps(schema, sort_keys=True))
+
+
+@lru_cache(maxsize=settings.SCHEMA_VALIDATORS_CACHE_SIZE)
+def _get_validator(schema_key: str) -> Validator:
+    return compile_schema(json.loads(schema_key))
+
+
+def compile_schema(schema: dict) -> Validator:
+    """
+    Compiles a JSON schema into a validator which raises OutputValidationError.
+    Supported keywords: type, enum, const, properties, required, additionalProperties,
+    items, minItems, maxItems, minLength, maxLength, pattern, minimum, maximum,
+    exclusiveMinimum, exclusiveMaximum, anyOf, oneOf, allOf.
+    Annotations (title, description, format, ...) are ignored,
+    any other keyword or an unknown type raises ValueError, so the schema isn't partially checked.
+    """
+    check = _compile(schema)
+
+    def validate(value: t.Any):
+        check(value, ROOT_PATH)
+
+    return validate
+
+
+def validate_response(response: AIResponse, validator: Validator):
+    """Sets JSON of the response to parsed_content if it's valid"""
+    try:
+        tagged_content = get_json_from_response(response)
+    except NotParsedResponseException:
+        raise OutputValidationError("Response contains invalid JSON")
+    if tagged_content is None:
+        raise OutputValidationError("Response doesn't contain JSON")
+    validator(tagged_content.parsed_content)
+    response.parsed_content = tagged_content.parsed_content
+
+
+def _compile(schema: t.Union[dict, bool]) -> Check:
+    if schema is True or schema == {}:
+        return _accept
+    if schema is False:
+        return _reject
+    if not isinstance(schema, dict):
+        raise ValueError(f"JSON schema must be an object or a boolean, got {schema!r}")
+    for keyword in schema:
+        if keyword not in SUPPORTED_KEYWORDS and keyword not in IGNORED_KEYWORDS:
+            raise ValueError(f"JSON schema keyword {keyword} is not supported")
+    checks: t.List[Check] = []
+    if "type" in schema:
+        checks.append(_compile_type(schema["type"]))
+    if "enum" in schema:
+        checks.append(_compile_enum(schema["enum"]))
+    if "const" in schema:
+        checks.append(_compile_enum([schema["const"]]))
+    if "properties" in schema or "required" in schema or "additionalProperties" in schema:
+        checks.append(_compile_object(schema))
+    if "items" in schema or "minItems" in schema or "maxItems" in schema:
+        checks.append(_compile_array(schema))
+    if "minLength" in schema or "maxLength" in schema or "pattern" in schema:
+        checks.append(_compile_string(schema))
+    if any(keyword in schema for keyword in NUMBER_KEYWORDS):
+        checks.append(_compile_number(schema))
+    for keyword in ("anyOf", "oneOf", "allOf"):
+        if keyword in schema:
+            checks.append(_compile_combination(keyword, schema[keyword]))
+    if len(checks) == 1:
+        return checks[0]
+
+    def check(value, path):
+        for item_check in checks:
+            item_check(value, path)
+
+    return check
+
+
+def _accept(value, path):
+    pass
+
+
+def _reject(value, path):
+    raise OutputValidationError(f"{path}: no value is allowed")
+
+
+def _compile_type(schema_type: t.Union[str, t.List[str]]) -> Check:
+    names = [schema_type] if isinstance(schema_type, str) else list(schema_type)
+    for name in names:
+        if name not in TYPES:
+            raise ValueError(f"JSON schema type {name!r} is not supported")
+    type_checks = [TYPES[name] for name in names]
+
+    def check(value, path):
+        if not any(type_check(value) for type_check in type_checks):
+            raise OutputValidationError(
+                f"{path}: expected {' or '.join(names)}, got {type(value).__name__}"
+            )
+
+    return check
+
+
+def _compile_enum(values: t.List[t.Any]) -> Check:
+    def check(value, path):
+        # 1 == True in python, so types are compared as well
+        if not any(value == v and type(value) is type(v) for v in values):
+            raise OutputValidationError(f"{path}: {value!r} is not one of {values!r}")
+
+    return check
+
+
+def _compile_object(schema: dict) -> Check:
+    properties = {
+        name: _compile(property_schema)
+        for name, property_schema in schema.get("properties", {}).items()
+    }
+    required = schema.get("required", [])
+    additional = schema.get("additionalProperties", True)
+    additional_check = None if additional is True else _compile(additional)
+
+    def check(value, path):
+        if not isinstance(value, dict):
+            return
+        for name in required:
+            if name not in value:
+                raise OutputValidationError(f"{path}: {name} is required")
+        for name, item in value.items():
+            property_check = properties.get(name, additional_check)
+            if property_check is not None:
+                property_check(item, f"{path}.{name}")
+
+    return check
+
+
+def _compile_array(schema: dict) -> Check:
+    items = schema.get("items")
+    if isinstance(items, list):
+        raise ValueError("JSON schema items as a list (tuple validation) is not supported")
+    item_check = None if items is None else _compile(items)
+    min_items = schema.get("minItems")
+    max_items = schema.get("maxItems")
+
+    def check(value, path):
+        if not isinstance(value, list):
+            return
+        if min_items is not None and len(value) < min_items:
+            raise OutputValidationError(f"{path}: expected at least {min_items} items")
+        if max_items is not None and len(value) > max_items:
+            raise OutputValidationError(f"{path}: expected at most {max_items} items")
+        if item_check is not None:
+            for i, item in enumerate(value):
+                item_check(item, f"{path}[{i}]")
+
+    return check
+
+
+def _compile_string(schema: dict) -> Check:
+    min_length = schema.get("minLength")
+    max_length = schema.get("maxLength")
+    pattern = re.compile(schema["pattern"]) if "pattern" in schema else None
+
+    def check(value, path):
+        if not isinstance(value, str):
+            return
+        if min_length is not None and len(value) < min_length:
+            raise OutputValidationError(f"{path}: shorter than {min_length}")
+        if max_length is not None and len(value) > max_length:
+            raise OutputValidationError(f"{path}: longer than {max_length}")
+        if pattern is not None and not pattern.search(value):
+            raise OutputValidationError(f"{path}: doesn't match {pattern.pattern}")
+
+    return check
+
+
+def _compile_number(schema: dict) -> Check:
+    limits = [
+        (keyword, compare, schema[keyword])
+        for keyword, compare in NUMBER_KEYWORDS.items()
+        if keyword in schema
+    ]
+
+    def check(value, path):
+        if not TYPES["number"](value):
+            return
+        for keyword, compare, limit in limits:
+            if not compare(value, limit):
+                raise OutputValidationError(f"{path}: {keyword} is {limit}, got {value}")
+
+    return check
+
+
+def _compile_combination(keyword: str, schemas: t.List[dict]) -> Check:
+    checks = [_compile(schema) for schema in schemas]
+
+    def check(value, path):
+        errors = []
+        for item_check in checks:
+            try:
+                item_check(value, path)
+            except OutputValidationError as e:
+                errors.append(str(e))
+        passed = len(checks) - len(errors)
+        if keyword == "allOf" and errors:
+            raise OutputValidationError(errors[0])
+        if keyword == "anyOf" and not passed:
+            raise OutputValidationError(f"{path}: doesn't match anyOf: {'; '.join(errors)}")
+        if keyword == "oneOf" and passed != 1:
+            raise OutputValidationError(f"{path}: matches {passed} schemas of oneOf")
+
+    return check
+
+
+def call_and_validate(
+    call: t.Callable[[], AIResponse], validate: t.Callable[[AIResponse], None]
+) -> AIResponse:
+    response = call()
+    validate(response)
+    return response
+
+
+def is_valid(response: AIResponse, validate: t.Callable[[AIResponse], None] = None) -> bool:
+    if validate is None:
+        return True
+    try:
+        validate(response)
+        return True
+    except OutputValidationError as e:
+        logger.debug(f"Response is not valid: {e}")
+        return False
@@ -0,0 +1,330 @@
+import json
+import logging
+import typing as t
+from dataclasses import dataclass
+
+import yaml
+
+from flow_prompt.response_parsers.response_parser import load_json, load_yaml
+from flow_prompt.streaming import StreamEvent
+
+logger = logging.getLogger(__name__)
+
+EXPECT_KEY = "expect_key"
+IN_KEY = "in_key"
+EXPECT_COLON = "expect_colon"
+EXPECT_VALUE = "expect_value"
+IN_VALUE = "in_value"
+
+FENCE = "```"
+ROOT_TYPES = {"object": "{", "array": "["}
+
+
+@dataclass
+class ParsedValue(StreamEvent):
+    """Completed top-level field of an object (key is str) or item of a list (key is index)"""
+
+    key: t.Union[str, int]
+    value: t.Any
+
+
+@dataclass
+class ParsedValuesReset(StreamEvent):
+    """
+    ParsedValue events received since the last reset came from text which
+    turned out not to be the answer's structure, they must be discarded
+    """
+
+
+class StreamParser:
+    """
+    Consumes streamed text and returns top-level values as soon as they are complete.
+    root_type ("object" or "array") is the expected type of the structure,
+    any is accepted if it's None.
+    """
+
+    is_complete: bool = False
+
+    def __init__(self, root_type: t.Optional[str] = None):
+        if root_type is not None and root_type not in ROOT_TYPES:
+            raise ValueError(f"Root type must be one of {list(ROOT_TYPES)}, got {root_type}")
+        self.root_type = root_type
+
+    def feed(self, text: str) -> t.List[StreamEvent]:
+        raise NotImplementedError
+
+    def finish(self) -> t.List[StreamEvent]:
+        """Called at the end of the stream, returns values completed by it"""
+        return []
+
+    @property
+    def result(self) -> t.Any:
+        raise NotImplementedError
+
+
+def get_root_type(schema: t.Optional[dict]) -> t.Optional[str]:
+    """Root type of the structure described by the JSON schema, if it's an object or an array"""
+    schema_type = (schema or {}).get("type")
+    return schema_type if schema_type in ROOT_TYPES else None
+
+
+class InvalidCandidate(Exception):
+    """Bracket which started the candidate doesn't start JSON, e.g. {name} in prose"""
+
+
+class JSONStreamParser(StreamParser):
+    """
+    Incremental parser of a JSON object or list, text before the first bracket
+    and after the closing bracket is ignored. Brackets in prose before the JSON
+    (e.g. "answer for {user}:") are skipped: once a candidate turns out to be invalid,
+    scanning goes on from the next char after its bracket. A fence can't be a part
+    of a candidate, so JSON in a ```json fence is found after the prose before it.
+    With root_type only brackets of that type start a candidate, so "see [1]"
+    in prose doesn't complete the parser which waits for an object.
+    Values of a candidate are returned as they close; if the candidate turns out to be invalid
+    after some of them were returned by previous feeds, ParsedValuesReset is returned.
+    """
+
+    def __init__(self, root_type: t.Optional[str] = None):
+        super().__init__(root_type)
+        self.is_complete = False
+        self._result = None
+        self._reset()
+
+    def _reset(self):
+        self._container = None
+        self._depth = 0
+        self._state = None
+        self._in_string = False
+        self._escape = False
+        self._chars: t.List[str] = []
+        self._key_chars: t.List[str] = []
+        self._value_chars: t.List[str] = []
+        self._key = None
+        self._index = 0
+        self._values_count = 0
+        self._returned_values_count = 0
+
+    @property
+    def result(self) -> t.Any:
+        return self._result
+
+    def feed(self, text: str) -> t.List[StreamEvent]:
+        parsed = []
+        while text and not self.is_complete:
+            text = self._feed_chars(text, parsed)
+        self._returned_values_count = self._values_count
+        return parsed
+
+    def _feed_chars(self, text: str, parsed: t.List[StreamEvent]) -> str:
+        """Returns text to be fed again if the current candidate is invalid"""
+        for i, char in enumerate(text):
+            if self.is_complete:
+                break
+            if self._container is None:
+                self._feed_outside(char)
+                continue
+            self._chars.append(char)
+            try:
+                if self._in_string:
+                    self._feed_string(char)
+                elif self._depth > 1:
+                    self._feed_nested(char)
+                else:
+                    value = self._feed_top_level(char)
+                    if value is not None:
+                        parsed.append(value)
+                        self._values_count += 1
+            except InvalidCandidate:
+                restart = "".join(self._chars[1:]) + text[i + 1 :]
+                logger.debug("Streamed text isn't JSON, looking for the next bracket")
+                # values of the candidate fed with this text aren't returned yet
+                del parsed[len(parsed) - (self._values_count - self._returned_values_count) :]
+                if self._returned_values_count:
+                    parsed.append(ParsedValuesReset())
+                self._reset()
+                return restart
+        return ""
+
+    def _feed_outside(self, char: str):
+        if char in "{[" and (self.root_type is None or char == ROOT_TYPES[self.root_type]):
+            self._container = char
+            self._depth = 1
+            self._state = EXPECT_KEY if char == "{" else EXPECT_VALUE
+            self._chars.append(char)
+
+    def _feed_string(self, char: str):
+        collector = self._key_chars if self._state == IN_KEY else self._value_chars
+        collector.append(char)
+        if self._escape:
+            self._escape = False
+        elif char == "\\":
+            self._escape = True
+        elif char == '"':
+            self._in_string = False
+            if self._state == IN_KEY:
+                try:
+                    self._key = json.loads("".join(self._key_chars))
+                except ValueError:
+                    raise InvalidCandidate()
+                self._state = EXPECT_COLON
+
+    def _feed_nested(self, char: str):
+        if char == "`":
+            # fences aren't valid JSON outside strings
+            raise InvalidCandidate()
+        self._value_chars.append(char)
+        if char == '"':
+            self._in_string = True
+        elif char in "{[":
+            self._depth += 1
+        elif char in "}]":
+            self._depth -= 1
+
+    def _feed_top_level(self, char: str) -> t.Optional[ParsedValue]:
+        closing = "}" if self._container == "{" else "]"
+        if self._state == EXPECT_KEY:
+            if char == '"':
+                self._key_chars = [char]
+                self._in_string = True
+                self._state = IN_KEY
+            elif char == closing:
+                self._complete()
+            elif not char.isspace() and char != ",":
+                raise InvalidCandidate()
+        elif self._state == EXPECT_COLON:
+            if char == ":":
+                self._state = EXPECT_VALUE
+            elif not char.isspace():
+                raise InvalidCandidate()
+        elif self._state == EXPECT_VALUE:
+            if char == closing:
+                self._complete()
+            elif not char.isspace() and char != ",":
+                self._value_chars = []
+                self._state = IN_VALUE
+                self._feed_nested(char)
+        elif self._state == IN_VALUE:
+            if char == "," or char == closing:
+                value = self._get_value()
+                if char == closing:
+                    self._complete()
+                else:
+                    self._state = EXPECT_KEY if self._container == "{" else EXPECT_VALUE
+                return value
+            self._feed_nested(char)
+        return None
+
+    def _get_value(self) -> ParsedValue:
+        raw_value = "".join(self._value_chars).strip()
+        try:
+            value = load_json(raw_value)
+        except Exception:
+            logger.debug(f"Couldn't parse streamed value: {raw_value}")
+            raise InvalidCandidate()
+        if self._container == "{":
+            return ParsedValue(key=self._key, value=value)
+        self._index += 1
+        return ParsedValue(key=self._index - 1, value=value)
+
+    def _complete(self):
+        try:
+            self._result = load_json("".join(self._chars))
+        except Exception:
+            logger.debug("Couldn't parse streamed json")
+            raise InvalidCandidate()
+        self._depth = 0
+        self.is_complete = True
+
+
+class YAMLStreamParser(StreamParser):
+    """
+    Incremental parser of YAML fenced with ``` (```yaml).
+    A top-level entry is complete when the next one starts at the beginning of a line
+    or when the closing fence is received, the last one is also complete at the end
+    of the stream (finish) if the closing fence is missing. With root_type entries of the other type
+    (list items when an object is expected and vice versa) are skipped.
+    """
+
+    def __init__(self, root_type: t.Optional[str] = None):
+        super().__init__(root_type)
+        self.is_complete = False
+        self._is_started = False
+        self._line: t.List[str] = []
+        self._entry_lines: t.List[str] = []
+        self._index = 0
+        self._result = None
+
+    @property
+    def result(self) -> t.Any:
+        return self._result
+
+    def feed(self, text: str) -> t.List[ParsedValue]:
+        parsed = []
+        lines = text.split("\n")
+        for i, part in enumerate(lines):
+            if self.is_complete:
+                break
+            if part and not self._line and self._is_started:
+                # the first char of a line shows if the previous entry is complete
+                parsed.extend(self._feed_line_start(part[0]))
+            if part:
+                self._line.append(part)
+            if i < len(lines) - 1:
+                line = "".join(self._line)
+                self._line = []
+                parsed.extend(self._feed_line(line))
+        return parsed
+
+    def finish(self) -> t.List[ParsedValue]:
+        if self.is_complete or not self._is_started:
+            return []
+        line = "".join(self._line)
+        self._line = []
+        # the stream may end with a part of the closing fence
+        if line.strip() and not FENCE.startswith(line.strip()):
+            self._entry_lines.append(line)
+        self.is_complete = True
+        return self._flush_entry()
+
+    def _feed_line_start(self, char: str) -> t.List[ParsedValue]:
+        if char.isspace() or char == "#":
+            return []
+        is_list = bool(self._entry_lines) and self._entry_lines[0].startswith("-")
+        if char == "-" and not is_list:
+            # list can be a value of the key without indentation
+            return []
+        return self._flush_entry()
+
+    def _feed_line(self, line: str) -> t.List[ParsedValue]:
+        if not self._is_started:
+            self._is_started = line.strip().startswith(FENCE)
+            return []
+        if line.strip().startswith(FENCE):
+            parsed = self._flush_entry()
+            self.is_complete = True
+            return parsed
+        self._entry_lines.append(line)
+        return []
+
+    def _flush_entry(self) -> t.List[ParsedValue]:
+        if not self._entry_lines:
+            return []
+        entry = "\n".join(self._entry_lines)
+        self._entry_lines = []
+        try:
+            value = load_yaml(entry)
+        except yaml.YAMLError:
+            logger.debug(f"Couldn't parse streamed yaml entry:\n{entry}")
+            return []
+        if isinstance(value, dict) and self.root_type != "array":
+            self._result = {**(self._result or {}), **value}
+            return [ParsedValue(key=k, value=v) for k, v in value.items()]
+        if isinstance(value, list) and self.root_type != "object":
+            self._result = (self._result or []) + value
+            parsed = [
+                ParsedValue(key=self._index + i, value=v) for i, v in enumerate(value)
+            ]
+            self._index += len(value)
+            return parsed
+        return []
@@ -1,7 +1,7 @@
 from decimal import Decimal
 import json
 import logging
-from dataclasses import dataclass, field
+from dataclasses import asdict, dataclass, field
 import typing as t
 
 logger = logging.getLogger(__name__)
@@ -23,6 +23,18 @@ class Metrics:
     prompt_tokens_used: int = None
     ai_model_details: dict = None
     latency: int = None
+    # prompt tokens read from / written to the provider's prompt cache
+    cache_read_tokens: int = None
+    cache_creation_tokens: int = None
+    # streaming performance, times in ms
+    time_to_first_token: float = None
+    inter_chunk_gap_p50: float = None
+    inter_chunk_gap_p99: float = None
+    tokens_per_second: float = None
+    stream_function_time: float = None
+    check_connection_time: float = None
+    # set if the response wasn't received from the AI model for this call
+    reused_from: str = None
 
 
 @dataclass(kw_only=True)
@@ -34,6 +46,8 @@ class AIResponse:
     prompt: Prompt = field(default_factory=Prompt)
     metrics: Metrics = field(default_factory=Metrics)
     id: str = ""
+    # JSON of the response validated with the output schema of the prompt
+    parsed_content: t.Any = None
 
     @property
     def response(self) -> str:
@@ -41,3 +55,84 @@ class AIResponse:
 
     def get_message_str(self) -> str:
         return json.loads(self.response)
+
+
+@dataclass(slots=True)
+class LeanToolCall:
+    id: str
+    name: str
+    arguments: str = ""
+    type: str = "function"
+
+
+@dataclass(kw_only=True, slots=True)
+class LeanAIResponse:
+    """
+    Slotted response without SDK objects: content, finish reason, tool calls and metrics
+    with the token usage. The raw provider payload is kept in original_result only on request.
+    """
+
+    content: str = ""
+    finish_reason: str = ""
+    tool_calls: t.Optional[t.List[LeanToolCall]] = None
+    prompt: Prompt = field(default_factory=Prompt)
+    metrics: Metrics = field(default_factory=Metrics)
+    id: str = ""
+    parsed_content: t.Any = None
+    original_result: object = None
+
+    @classmethod
+    def from_response(
+        cls, response: AIResponse, keep_original_result: bool = False
+    ) -> "LeanAIResponse":
+        message = getattr(response, "message", None)
+        tool_calls = None
+        if message is not None and getattr(message, "tool_calls", None):
+            tool_calls = [
+                LeanToolCall(
+                    id=tool_call.id,
+                    name=tool_call.function.name,
+                    arguments=tool_call.function.arguments or "",
+                    type=tool_call.type,
+                )
+                for tool_call in message.tool_calls
+            ]
+        return cls(
+            content=response.content or getattr(message, "content", None) or "",
+            finish_reason=response.finish_reason,
+            tool_calls=tool_calls,
+            prompt=response.prompt,
+            metrics=response.metrics,
+            id=response.id,
+            parsed_content=response.parsed_content,
+            original_result=response.original_result if keep_original_result else None,
+        )
+
+    @property
+    def response(self) -> str:
+        return self.content
+
+    def is_function(self) -> bool:
+        return bool(self.tool_calls)
+
+    def get_function_name(self, tool_call: LeanToolCall) -> t.Optional[str]:
+        return tool_call.name
+
+    def get_function_args(self, tool_call: LeanToolCall) -> t.Dict[str, t.Any]:
+        try:
+            return json.loads(tool_call.arguments)
+        except json.JSONDecodeError as e:
+            logger.debug("Failed to parse function arguments", exc_info=e)
+            return {}
+
+    def get_message_str(self) -> str:
+        return json.dumps(
+            {
+                "content": self.content,
+                "role": "assistant",
+                "tool_calls": [asdict(tool_call) for tool_call in self.tool_calls]
+                if self.tool_calls
+                else None,
+            },
+            indent=2,
+        )
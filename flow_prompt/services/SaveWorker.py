@@ -1,19 +1,284 @@
-import threading
+import atexit
+import json
+import logging
+import os
 import queue
+import threading
 import typing as t
-from time import sleep
+import weakref
+from dataclasses import dataclass, field, replace
+from enum import Enum
+from time import monotonic
+
+import requests
+
+from flow_prompt import settings
 from flow_prompt.prompt.user_prompt import CallingMessages
 from flow_prompt.responses import AIResponse
-
+from flow_prompt.services.content_refs import ContentIndex
 from flow_prompt.services.flow_prompt import FlowPromptService
+from flow_prompt.services.sinks import LogSink, get_default_sink, get_token_fingerprint
+from flow_prompt.services.spool import Spool, get_spool
+from flow_prompt.utils import DecimalEncoder
+
+logger = logging.getLogger(__name__)
+
+# idle sender threads check if the worker is closed or the spool should be replayed this often
+IDLE_POLL_SECONDS = 0.5
+
+
+class OverflowPolicy(Enum):
+    DROP_OLDEST = "drop_oldest"
+    DROP_NEWEST = "drop_newest"
+    BLOCK = "block"
+
+
+@dataclass
+class SaveWorkerStats:
+    """
+    Counters of tasks: accepted to the queue, sent, dropped on overflow, failed to send
+    and written to the spool
+    """
+
+    enqueued: int = 0
+    sent: int = 0
+    dropped: int = 0
+    failed: int = 0
+    spooled: int = 0
+
+
+@dataclass
+class Batch:
+    """Serialized logs and tests of one api token"""
+
+    logs: t.List[bytes] = field(default_factory=list)
+    tests: t.List[bytes] = field(default_factory=list)
+    # hashes of contents sent with the logs for the first time
+    hashes: t.Set[str] = field(default_factory=set)
+    # hashes of contents the logs refer to and log data without the refs by index of the log,
+    # the logs are sent in full if the refs are rejected
+    ref_hashes: t.Set[str] = field(default_factory=set)
+    full_logs: t.Dict[int, dict] = field(default_factory=dict)
+
+    def dump(self, api_token: str) -> bytes:
+        """
+        Spool record of the batch, serialized logs are joined without parsing.
+        The record has the fingerprint of the api token, not the token itself.
+        """
+        return b"".join(
+            [
+                b'{"token_fingerprint":',
+                dumps(get_token_fingerprint(api_token)),
+                b',"logs":[',
+                b",".join(self.logs),
+                b'],"tests":[',
+                b",".join(self.tests),
+                b"]}",
+            ]
+        )
+
+    def without_refs(self) -> "Batch":
+        """Logs referring to contents by hash are replaced with their full data"""
+        if not self.full_logs:
+            return self
+        logs = [
+            dumps(self.full_logs[i]) if i in self.full_logs else log
+            for i, log in enumerate(self.logs)
+        ]
+        return Batch(logs=logs, tests=self.tests, hashes=self.hashes)
+
+    def split(self) -> t.List["Batch"]:
+        """Logs and tests as separate batches, so a failure of one isn't retried with the other"""
+        parts = []
+        if self.logs:
+            parts.append(
+                Batch(
+                    logs=self.logs,
+                    hashes=self.hashes,
+                    ref_hashes=self.ref_hashes,
+                    full_logs=self.full_logs,
+                )
+            )
+        if self.tests:
+            parts.append(Batch(tests=self.tests))
+        return parts
+
+    @classmethod
+    def load(cls, record: bytes) -> t.Tuple[str, "Batch"]:
+        """Fingerprint of the api token and the batch"""
+        data = json.loads(record)
+        return data["token_fingerprint"], cls(
+            logs=[dumps(log) for log in data["logs"]],
+            tests=[dumps(test) for test in data["tests"]],
+        )
 
 
 class SaveWorker:
-    def __init__(self):
-        self.queue = queue.Queue()
-        self.thread = threading.Thread(target=self.worker)
-        self.thread.daemon = True  # Daemon thread exits when main program exits
-        self.thread.start()
+    """
+    Sends interactions to Flow Prompt in the background.
+    Tasks are collected into batches until max_batch_size tasks or max_batch_bytes
+    of serialized logs are collected or max_batch_interval seconds passed since the first task,
+    then logs and tests of every api token are sent with one gzipped request each.
+    The queue holds max_queue_size tasks at most, overflow_policy decides which task is dropped
+    when it's full. Batches are sent by `threads` sender threads sharing the queue.
+    With a spool, tasks which would be dropped and batches which failed to be sent
+    are written to disk instead and sent again in order after the next successful batch
+    or every spool_retry_interval seconds.
+    Queued tasks are sent on interpreter exit within exit_timeout seconds,
+    use flush or close to send them earlier.
+    Batches are saved to the sink, Flow Prompt by default (settings.LOG_SINKS).
+    With a content index, logs refer to prompts and large context values sent before by hash,
+    they are sent in full again if the refs are rejected. It's used if
+    settings.SAVE_WORKER_CONTENT_REFS is set and the sink supports it.
+    """
+
+    def __init__(
+        self,
+        max_batch_size: int = settings.SAVE_WORKER_MAX_BATCH_SIZE,
+        max_batch_bytes: int = settings.SAVE_WORKER_MAX_BATCH_BYTES,
+        max_batch_interval: float = settings.SAVE_WORKER_MAX_BATCH_INTERVAL_SECONDS,
+        max_queue_size: int = settings.SAVE_WORKER_MAX_QUEUE_SIZE,
+        overflow_policy: t.Union[OverflowPolicy, str] = settings.SAVE_WORKER_OVERFLOW_POLICY,
+        block_timeout: float = settings.SAVE_WORKER_BLOCK_TIMEOUT_SECONDS,
+        threads: int = settings.SAVE_WORKER_THREADS,
+        spool: Spool = None,
+        spool_retry_interval: float = settings.SAVE_WORKER_SPOOL_RETRY_SECONDS,
+        exit_timeout: float = settings.SAVE_WORKER_EXIT_TIMEOUT_SECONDS,
+        content_index: ContentIndex = None,
+        sink: LogSink = None,
+    ):
+        self.max_batch_size = max_batch_size
+        self.max_batch_bytes = max_batch_bytes
+        self.max_batch_interval = max_batch_interval
+        self.overflow_policy = OverflowPolicy(overflow_policy)
+        self.block_timeout = block_timeout
+        self.queue = queue.Queue(maxsize=max_queue_size)
+        if spool is None and settings.SAVE_WORKER_SPOOL_PATH:
+            spool = get_spool(settings.SAVE_WORKER_SPOOL_PATH)
+        self.spool = spool
+        self.spool_retry_interval = spool_retry_interval
+        # the sink created by the worker is closed with it
+        self._owns_sink = sink is None
+        self.sink = get_default_sink() if sink is None else sink
+        if (
+            content_index is None
+            and settings.SAVE_WORKER_CONTENT_REFS
+            and self.sink.supports_content_refs
+        ):
+            content_index = ContentIndex()
+        self.content_index = content_index
+        self._replay_lock = threading.Lock()
+        self._replay_at = 0.0
+        # spooled batches are sent with the api token of tasks having its fingerprint
+        self._api_tokens: t.Dict[str, str] = {}
+        self._stats = SaveWorkerStats()
+        self._stats_lock = threading.Lock()
+        self.exit_timeout = exit_timeout
+        self.is_closed = False
+        self._flushes = 0
+        self.threads_count = max(threads, 1)
+        self._start_threads()
+        atexit.register(self._close_at_exit)
+        _workers.add(self)
+
+    def _start_threads(self):
+        self.threads = [
+            # Daemon threads exit when main program exits
+            threading.Thread(target=self.worker, daemon=True)
+            for _ in range(self.threads_count)
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def _restart_after_fork(self):
+        """
+        Only the forking thread exists in the child, locks may be held by dead threads.
+        Tasks of the parent are left to the parent and the spool isn't shared with it.
+        """
+        self.queue = queue.Queue(maxsize=self.queue.maxsize)
+        self.spool = None
+        if self._owns_sink:
+            # connections and files of the parent aren't shared
+            self.sink = get_default_sink()
+        if self.content_index is not None:
+            self.content_index = ContentIndex(
+                self.content_index.max_size, self.content_index.min_bytes
+            )
+        self._replay_lock = threading.Lock()
+        self._stats = SaveWorkerStats()
+        self._stats_lock = threading.Lock()
+        self._flushes = 0
+        if not self.is_closed:
+            self._start_threads()
+
+    def flush(self, timeout: float = None) -> bool:
+        """
+        Sends queued tasks without waiting for batches to fill up,
+        returns False if they are not sent in timeout seconds
+        """
+        if not any(thread.is_alive() for thread in self.threads):
+            return not self.queue.unfinished_tasks
+        with self._stats_lock:
+            self._flushes += 1
+        try:
+            self._wake_up()
+            deadline = None if timeout is None else monotonic() + timeout
+            with self.queue.all_tasks_done:
+                while self.queue.unfinished_tasks:
+                    remaining = None if deadline is None else deadline - monotonic()
+                    if remaining is not None and remaining <= 0:
+                        return False
+                    self.queue.all_tasks_done.wait(remaining)
+            return True
+        finally:
+            with self._stats_lock:
+                self._flushes -= 1
+
+    def close(self, timeout: float = None) -> bool:
+        """
+        Later tasks are dropped, sender threads send queued tasks and exit.
+        Waits for them timeout seconds at most, returns False if tasks aren't sent in time.
+        """
+        deadline = None if timeout is None else monotonic() + timeout
+        self.is_closed = True
+        is_flushed = self.flush(timeout)
+        for thread in self.threads:
+            thread.join(None if deadline is None else max(deadline - monotonic(), 0))
+        if not any(thread.is_alive() for thread in self.threads):
+            atexit.unregister(self._close_at_exit)
+            if self._owns_sink:
+                self.sink.close()
+        return is_flushed
+
+    def _close_at_exit(self):
+        if not self.close(self.exit_timeout):
+            logger.warning(
+                f"{self.queue.unfinished_tasks} interactions weren't saved before exit"
+            )
+
+    def _wake_up(self):
+        """Sender threads waiting for tasks or for a batch to fill up get None"""
+        for _ in filter(threading.Thread.is_alive, self.threads):
+            try:
+                self.queue.put_nowait(None)
+            except queue.Full:
+                # threads aren't waiting for tasks
+                return
+
+    @property
+    def is_flushing(self) -> bool:
+        return self._flushes > 0 or self.is_closed
+
+    @property
+    def stats(self) -> SaveWorkerStats:
+        """Snapshot of the counters"""
+        with self._stats_lock:
+            return replace(self._stats)
+
+    def _count(self, **counters: int):
+        with self._stats_lock:
+            for name, value in counters.items():
+                setattr(self._stats, name, getattr(self._stats, name) + value)
 
     def save_user_interaction_async(
         self,
@@ -27,22 +292,195 @@ class SaveWorker:
         )
 
     def worker(self):
+        while not (self.is_closed and self.queue.empty()):
+            try:
+                self.process()
+            except Exception as e:
+                logger.exception(f"Unexpected error in the save worker: {e}")
+
+    def process(self):
+        try:
+            count, batches = self.get_batches(timeout=IDLE_POLL_SECONDS)
+        except queue.Empty:
+            if self.is_replay_due():
+                self.replay()
+            return
+        is_sent = True
+        try:
+            for api_token, batch in batches.items():
+                is_sent = self.send_or_spill(api_token, batch) and is_sent
+        finally:
+            for _ in range(count):
+                self.queue.task_done()
+        if is_sent and batches:
+            self.replay()
+
+    def is_replay_due(self) -> bool:
+        return (
+            not self.is_closed
+            and self.spool is not None
+            and monotonic() >= self._replay_at
+            and not self.spool.is_empty()
+        )
+
+    def get_batches(self, timeout: float = None) -> t.Tuple[int, t.Dict[str, Batch]]:
+        """
+        Waits for the first task and collects batches, returns count of taken tasks.
+        Raises queue.Empty if no task came in timeout seconds.
+        """
+        batches: t.Dict[str, Batch] = {}
+        count, size = 0, 0
+        task = self.queue.get(timeout=timeout)
+        deadline = monotonic() + self.max_batch_interval
         while True:
-            task = self.queue.get()
-            if task is None:
-                sleep(1)
-                continue
-            api_token, prompt_data, context, response, test_data = task
-            
-            FlowPromptService.save_user_interaction(
-                api_token, prompt_data, context, response
+            count += 1
+            try:
+                size += self.add_to_batches(batches, task)
+            except Exception as e:
+                self._count(failed=1)
+                logger.exception(f"Failed to serialize interaction: {e}")
+            remaining = deadline - monotonic()
+            if (
+                # None wakes up the thread to send the batch at once
+                task is None
+                or count >= self.max_batch_size
+                or size >= self.max_batch_bytes
+                or remaining <= 0
+            ):
+                return count, batches
+            try:
+                if self.is_flushing:
+                    task = self.queue.get_nowait()
+                else:
+                    task = self.queue.get(timeout=remaining)
+            except queue.Empty:
+                return count, batches
+
+    def add_to_batches(self, batches: t.Dict[str, Batch], task: tuple) -> int:
+        """Serializes the task into the batch of its api token, returns the size in bytes"""
+        if task is None:
+            return 0
+        api_token, prompt_data, context, response, test_data = task
+        log_data = FlowPromptService.get_log_data(prompt_data, context, response)
+        full_log_data = log_data
+        hashes: t.Set[str] = set()
+        ref_hashes: t.Set[str] = set()
+        if self.content_index is not None:
+            log_data = self.content_index.replace_with_refs(
+                api_token, log_data, hashes, ref_hashes
             )
-            
-            FlowPromptService.create_test_with_ideal_answer(
-                api_token, prompt_data, context, test_data
+        log = dumps(log_data)
+        test = FlowPromptService.get_test_data(prompt_data, context, test_data)
+        test = None if test is None else dumps(test)
+        batch = batches.setdefault(api_token, Batch())
+        batch.hashes.update(hashes)
+        if ref_hashes:
+            batch.ref_hashes.update(ref_hashes)
+            batch.full_logs[len(batch.logs)] = full_log_data
+        batch.logs.append(log)
+        if test is None:
+            return len(log)
+        batch.tests.append(test)
+        return len(log) + len(test)
+
+    def send(self, api_token: str, batch: Batch):
+        self.sink.save(api_token, batch.logs, batch.tests)
+
+    def send_or_spill(self, api_token: str, batch: Batch) -> bool:
+        if batch.logs and batch.tests:
+            # logs accepted before the tests failed aren't spooled or sent again
+            is_sent = True
+            for part in batch.split():
+                is_sent = self.send_or_spill(api_token, part) and is_sent
+            return is_sent
+        try:
+            self.send(api_token, batch)
+            self._count(sent=len(batch.logs))
+            if self.content_index is not None:
+                self.content_index.add(api_token, batch.hashes)
+            return True
+        except requests.HTTPError as e:
+            if is_client_error(e) and batch.full_logs:
+                logger.warning(
+                    f"Logs referring to sent contents are rejected, sending them in full: {e}"
+                )
+                self.content_index.remove(api_token, batch.ref_hashes)
+                return self.send_or_spill(api_token, batch.without_refs())
+            if not is_client_error(e) or len(batch.logs) + len(batch.tests) <= 1:
+                return self.spill_failed(api_token, batch, e)
+            logger.warning(
+                f"Batch of {len(batch.logs)} interactions and {len(batch.tests)} tests "
+                f"is rejected: {e}"
             )
-            
-            self.queue.task_done()
+            return self.send_each(api_token, batch)
+        except Exception as e:
+            return self.spill_failed(api_token, batch, e)
+
+    def send_each(self, api_token: str, batch: Batch) -> bool:
+        """Sends logs and tests of the rejected batch one by one, so only invalid ones are lost"""
+        is_sent = True
+        for log in batch.logs:
+            is_sent = self.send_or_spill(api_token, Batch(logs=[log])) and is_sent
+        for test in batch.tests:
+            is_sent = self.send_or_spill(api_token, Batch(tests=[test])) and is_sent
+        return is_sent
+
+    def spill_failed(self, api_token: str, batch: Batch, e: Exception) -> bool:
+        # rejected requests won't succeed later, so they aren't spooled
+        what = f"{len(batch.logs)} interactions and {len(batch.tests)} tests"
+        if not is_client_error(e) and self.spill(api_token, batch):
+            logger.warning(f"Failed to save {what}, spooled: {e}")
+        else:
+            self._count(failed=len(batch.logs))
+            logger.exception(f"Failed to save {what}: {e}")
+        return False
+
+    def spill(self, api_token: str, batch: Batch) -> bool:
+        """Writes the batch to the spool, returns False if there is no spool or it's full"""
+        if self.spool is None:
+            return False
+        try:
+            # refs may be forgotten by the time the batch is replayed
+            is_spooled = self.spool.append(batch.without_refs().dump(api_token))
+        except Exception as e:
+            logger.exception(f"Failed to write interactions to the spool: {e}")
+            return False
+        if is_spooled:
+            self._count(spooled=len(batch.logs))
+        return is_spooled
+
+    def replay(self, blocking: bool = False):
+        """
+        Sends spooled batches in order until the spool is empty or sending fails,
+        returns at once if batches are replayed by another thread unless blocking is set
+        """
+        if self.spool is None or not self._replay_lock.acquire(blocking=blocking):
+            return
+        self._replay_at = monotonic() + self.spool_retry_interval
+        try:
+            while True:
+                record = self.spool.read()
+                if record is None:
+                    return
+                position, payload = record
+                try:
+                    fingerprint, batch = Batch.load(payload)
+                except Exception as e:
+                    logger.exception(f"Failed to load spooled interactions: {e}")
+                    self.spool.ack(position)
+                    continue
+                api_token = self._api_tokens.get(fingerprint)
+                if api_token is None:
+                    # replayed once a task with the token is added
+                    logger.debug("Api token of spooled interactions isn't known yet")
+                    return
+                self.send(api_token, batch)
+                self.spool.ack(position)
+                self._count(sent=len(batch.logs))
+        except Exception as e:
+            logger.warning(f"Failed to send spooled interactions: {e}")
+        finally:
+            self._replay_lock.release()
 
     def add_task(
         self,
@@ -52,4 +490,101 @@ class SaveWorker:
         response: AIResponse,
         test_data: t.Optional[dict] = None,
     ):
-        self.queue.put((api_token, prompt_data, context, response, test_data))
+        self._api_tokens[get_token_fingerprint(api_token)] = api_token
+        self.put((api_token, prompt_data, context, response, test_data))
+
+    def put(self, task: tuple):
+        """Puts the task to the queue, drops a task by the overflow policy if the queue is full"""
+        if self.is_closed:
+            self._count(dropped=1)
+            logger.warning("Save worker is closed, interaction is dropped")
+            return
+        if self.overflow_policy == OverflowPolicy.DROP_OLDEST:
+            while True:
+                try:
+                    self.queue.put_nowait(task)
+                    break
+                except queue.Full:
+                    self._drop_oldest()
+        else:
+            try:
+                if self.overflow_policy == OverflowPolicy.BLOCK:
+                    self.queue.put(task, timeout=self.block_timeout)
+                else:
+                    self.queue.put_nowait(task)
+            except queue.Full:
+                self._drop(task)
+                return
+        self._count(enqueued=1)
+
+    def _drop_oldest(self):
+        try:
+            task = self.queue.get_nowait()
+        except queue.Empty:
+            return
+        try:
+            if task is not None:
+                self._drop(task)
+        finally:
+            self.queue.task_done()
+
+    def _drop(self, task: tuple):
+        """Spills the task to the spool if it's possible"""
+        if self.spool is not None:
+            batches: t.Dict[str, Batch] = {}
+            try:
+                self.add_to_batches(batches, task)
+            except Exception as e:
+                logger.exception(f"Failed to serialize interaction: {e}")
+            if batches and all(self.spill(*item) for item in batches.items()):
+                return
+        self._count(dropped=1)
+        logger.debug("Save queue is full, interaction is dropped")
+
+
+_workers: "weakref.WeakSet[SaveWorker]" = weakref.WeakSet()
+_shared_worker: t.Optional[SaveWorker] = None
+_shared_worker_lock = threading.Lock()
+
+
+def acquire_worker() -> SaveWorker:
+    """
+    Worker shared by the process, it's created on the first call.
+    It's a process-wide singleton closed on interpreter exit, so short-lived users
+    don't start threads and lose the content index each time.
+    """
+    global _shared_worker
+    with _shared_worker_lock:
+        if _shared_worker is None or _shared_worker.is_closed:
+            _shared_worker = SaveWorker()
+        return _shared_worker
+
+
+def release_worker(worker: SaveWorker):
+    """The worker sends queued tasks at once, it keeps running for other users"""
+    worker._wake_up()
+
+
+def _after_fork_in_child():
+    global _shared_worker_lock
+    _shared_worker_lock = threading.Lock()
+    for worker in list(_workers):
+        worker._restart_after_fork()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
+
+
+def is_client_error(e: Exception) -> bool:
+    response = getattr(e, "response", None)
+    return (
+        isinstance(e, requests.HTTPError)
+        and response is not None
+        and 400 <= response.status_code < 500
+        and response.status_code not in (408, 429)
+    )
+
+
+def dumps(data: dict) -> bytes:
+    return json.dumps(data, cls=DecimalEncoder).encode()
@@ -0,0 +1,140 @@
+import hashlib
+import json
+import threading
+import typing as t
+from collections import OrderedDict
+
+from flow_prompt import settings
+from flow_prompt.utils import DecimalEncoder
+
+MAX_PROMPT_HASHES = 1000
+
+
+class ContentIndex:
+    """
+    Hashes of prompts and context values already uploaded to Flow Prompt with every api token.
+    Logs refer to them by hash instead of sending them again, the oldest hashes are evicted.
+    """
+
+    def __init__(
+        self,
+        max_size: int = settings.SAVE_WORKER_CONTENT_INDEX_SIZE,
+        min_bytes: int = settings.SAVE_WORKER_CONTENT_REF_MIN_BYTES,
+    ):
+        self.max_size = max_size
+        self.min_bytes = min_bytes
+        self._lock = threading.Lock()
+        self._hashes: OrderedDict[t.Tuple[str, str], None] = OrderedDict()
+        # (prompt_id, version) -> (prompt, hash) of the last prompt hashed with them
+        self._prompt_hashes: OrderedDict[t.Tuple[str, str], t.Tuple[dict, str]] = (
+            OrderedDict()
+        )
+
+    def is_uploaded(self, api_token: str, content_hash: str) -> bool:
+        key = (api_token, content_hash)
+        with self._lock:
+            if key not in self._hashes:
+                return False
+            self._hashes.move_to_end(key)
+            return True
+
+    def add(self, api_token: str, hashes: t.Iterable[str]):
+        """Hashes are added once the log with their content is sent"""
+        with self._lock:
+            for content_hash in hashes:
+                self._hashes[(api_token, content_hash)] = None
+                self._hashes.move_to_end((api_token, content_hash))
+            while len(self._hashes) > self.max_size:
+                self._hashes.popitem(last=False)
+
+    def remove(self, api_token: str, hashes: t.Iterable[str]):
+        """Hashes are removed if the refs to them are rejected"""
+        with self._lock:
+            for content_hash in hashes:
+                self._hashes.pop((api_token, content_hash), None)
+
+    def replace_with_refs(
+        self,
+        api_token: str,
+        log_data: dict,
+        new_hashes: t.Set[str],
+        ref_hashes: t.Optional[t.Set[str]] = None,
+    ) -> dict:
+        """
+        Prompt is replaced with {prompt_id, version, hash} and context values
+        of min_bytes and more are moved from context to context_refs {key: hash}
+        if they are uploaded, their hashes are added to ref_hashes.
+        Otherwise they are sent with their hashes, which are added to new_hashes.
+        """
+        if ref_hashes is None:
+            ref_hashes = set()
+        log_data = dict(log_data)
+        prompt = log_data["prompt"]
+        prompt_hash = self.get_prompt_hash(prompt)
+        if self.is_uploaded(api_token, prompt_hash):
+            log_data["prompt"] = {
+                "prompt_id": prompt.get("prompt_id"),
+                "version": prompt.get("version"),
+                "hash": prompt_hash,
+            }
+            ref_hashes.add(prompt_hash)
+        else:
+            log_data["prompt"] = {**prompt, "hash": prompt_hash}
+            new_hashes.add(prompt_hash)
+        context, context_refs, context_hashes = {}, {}, {}
+        for key, value in (log_data["context"] or {}).items():
+            value_hash = self.get_value_hash(value)
+            if value_hash is None:
+                context[key] = value
+            elif self.is_uploaded(api_token, value_hash):
+                context_refs[key] = value_hash
+                ref_hashes.add(value_hash)
+            else:
+                context[key] = value
+                context_hashes[key] = value_hash
+                new_hashes.add(value_hash)
+        log_data["context"] = context
+        if context_refs:
+            log_data["context_refs"] = context_refs
+        if context_hashes:
+            log_data["context_hashes"] = context_hashes
+        return log_data
+
+    def get_prompt_hash(self, prompt: dict) -> str:
+        """
+        Prompts are hashed once per prompt_id and version,
+        comparing with the prompt hashed before is cheaper than dumping it
+        """
+        key = (prompt.get("prompt_id"), prompt.get("version"))
+        with self._lock:
+            cached = self._prompt_hashes.get(key)
+        if cached is not None and cached[0] == prompt:
+            return cached[1]
+        prompt_hash = get_content_hash(prompt)
+        with self._lock:
+            self._prompt_hashes[key] = (prompt, prompt_hash)
+            self._prompt_hashes.move_to_end(key)
+            while len(self._prompt_hashes) > MAX_PROMPT_HASHES:
+                self._prompt_hashes.popitem(last=False)
+        return prompt_hash
+
+    def get_value_hash(self, value: t.Any) -> t.Optional[str]:
+        """Hash of the value if it's large enough to be sent by reference"""
+        if isinstance(value, str):
+            if len(value) < self.min_bytes:
+                return None
+            return hashlib.sha256(value.encode()).hexdigest()
+        if not isinstance(value, (dict, list)):
+            return None
+        content = dumps_sorted(value)
+        if len(content) < self.min_bytes:
+            return None
+        return hashlib.sha256(content).hexdigest()
+
+
+def get_content_hash(data: t.Any) -> str:
+    return hashlib.sha256(dumps_sorted(data)).hexdigest()
+
+
+def dumps_sorted(data: t.Any) -> bytes:
+    return json.dumps(data, cls=DecimalEncoder, sort_keys=True).encode()
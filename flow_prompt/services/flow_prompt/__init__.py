@@ -1,3 +1,4 @@
+import gzip
 import json
 import logging
 import typing as t
@@ -127,14 +128,7 @@ class FlowPromptService:
     ):
         url = f"{cls.url}lib/logs"
         headers = {"Authorization": f"Token {api_token}"}
-        data = {
-            "context": context,
-            "prompt": prompt_data,
-            "response": {"content": response.content},
-            "metrics": asdict(response.metrics),
-            "request": asdict(response.prompt),
-            'timestamp': response.id.split('#')[1]
-        }
+        data = cls.get_log_data(prompt_data, context, response)
         
         logger.debug(f"Request to {url} with data: {data}")
         json_data = json.dumps(data, cls=DecimalEncoder)
@@ -145,6 +139,82 @@ class FlowPromptService:
         else:
             logger.error(response)
           
+    @staticmethod
+    def get_log_data(
+        prompt_data: t.Dict[str, t.Any],
+        context: t.Dict[str, t.Any],
+        response: AIResponse,
+    ) -> dict:
+        return {
+            "context": context,
+            "prompt": prompt_data,
+            "response": {"content": response.content},
+            "metrics": asdict(response.metrics),
+            "request": asdict(response.prompt),
+            'timestamp': response.id.split('#')[1]
+        }
+
+    @staticmethod
+    def get_test_data(
+        prompt_data: t.Dict[str, t.Any],
+        context: t.Dict[str, t.Any],
+        test_data: dict,
+    ) -> t.Optional[dict]:
+        ideal_answer = (test_data or {}).get('ideal_answer', None)
+        if not ideal_answer:
+            return None
+        behavior_name = test_data.get('behavior_name') or test_data.get('behaviour_name')
+        return {
+            "context": context,
+            "prompt": prompt_data,
+            "ideal_answer": ideal_answer,
+            "behavior_name": behavior_name
+        }
+
+    @classmethod
+    def save_user_interactions(cls, api_token: str, logs: t.List[bytes]):
+        """Sends serialized logs in one gzipped request, raises on failure"""
+        cls._post_bulk(f"{cls.url}lib/logs/bulk", api_token, b'{"logs": [', logs)
+
+    @classmethod
+    def create_tests_with_ideal_answer(cls, api_token: str, tests: t.List[bytes]):
+        """Sends serialized tests in one gzipped request, raises on failure"""
+        cls._post_bulk(f"{cls.url}lib/tests/bulk", api_token, b'{"tests": [', tests)
+
+    @classmethod
+    def save_serialized_interaction(cls, api_token: str, log: bytes):
+        """Sends a serialized log to the per-item endpoint, raises on failure"""
+        cls._post_item(f"{cls.url}lib/logs", api_token, log)
+
+    @classmethod
+    def create_serialized_test(cls, api_token: str, test: bytes):
+        """Sends a serialized test to the per-item endpoint, raises on failure"""
+        cls._post_item(f"{cls.url}lib/tests", api_token, test)
+
+    @staticmethod
+    def _post_item(url: str, api_token: str, body: bytes):
+        headers = {
+            "Authorization": f"Token {api_token}",
+            "Content-Type": "application/json",
+        }
+        logger.debug(f"Request to {url} with {len(body)} bytes")
+        response = requests.post(url, headers=headers, data=body)
+        response.raise_for_status()
+
+    @staticmethod
+    def _post_bulk(url: str, api_token: str, prefix: bytes, items: t.List[bytes]):
+        body = prefix + b",".join(items) + b"]}"
+        headers = {
+            "Authorization": f"Token {api_token}",
+            "Content-Type": "application/json",
+        }
+        if settings.SAVE_WORKER_GZIP:
+            body = gzip.compress(body, compresslevel=settings.SAVE_WORKER_GZIP_LEVEL)
+            headers["Content-Encoding"] = "gzip"
+        logger.debug(f"Request to {url} with {len(items)} items, {len(body)} bytes")
+        response = requests.post(url, headers=headers, data=body)
+        response.raise_for_status()
+
     @classmethod  
     def update_response_ideal_answer(
         cls,
@@ -178,18 +248,11 @@ class FlowPromptService:
         context: t.Dict[str, t.Any],
         test_data: dict,
     ):
-        ideal_answer = test_data.get('ideal_answer', None)
-        if not ideal_answer:
+        data = cls.get_test_data(prompt_data, context, test_data)
+        if not data:
             return
         url = f"{cls.url}lib/tests"
         headers = {"Authorization": f"Token {api_token}"}
-        behavior_name = test_data.get('behavior_name') or test_data.get('behaviour_name')
-        data = {
-            "context": context,
-            "prompt": prompt_data,
-            "ideal_answer": ideal_answer,
-            "behavior_name": behavior_name
-        }
         logger.debug(f"Request to {url} with data: {data}")
         json_data = json.dumps(data)
         requests.post(url, headers=headers, data=json_data)
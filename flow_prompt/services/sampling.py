@@ -0,0 +1,63 @@
+import logging
+import random
+import typing as t
+from dataclasses import dataclass, field
+from decimal import Decimal
+
+from flow_prompt import settings
+from flow_prompt.ai_models.openai.responses import FINISH_REASON_ERROR
+from flow_prompt.responses import AIResponse
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class SamplingPolicy:
+    """
+    Decides if an interaction is logged before it's serialized.
+    Interactions are kept with the rate of their prompt from prompt_rates or with the default rate.
+    Errors, retried calls, calls slower than latency_threshold ms and calls more expensive
+    than price_threshold are always kept, as well as interactions with ideal answers for tests.
+    """
+
+    rate: float = settings.LOG_SAMPLING_RATE
+    prompt_rates: t.Dict[str, float] = field(default_factory=dict)
+    keep_errors: bool = True
+    keep_retries: bool = True
+    latency_threshold: t.Optional[int] = settings.LOG_SAMPLING_LATENCY_THRESHOLD_MS
+    price_threshold: t.Optional[Decimal] = settings.LOG_SAMPLING_PRICE_THRESHOLD
+
+    def get_rate(self, prompt_id: str) -> float:
+        return self.prompt_rates.get(prompt_id, self.rate)
+
+    def is_kept(
+        self,
+        prompt_id: str,
+        response: AIResponse,
+        attempt_number: int = 1,
+        test_data: dict = None,
+    ) -> bool:
+        if (test_data or {}).get("ideal_answer"):
+            return True
+        if self.is_tail(response, attempt_number):
+            return True
+        rate = self.get_rate(prompt_id)
+        return rate >= 1 or random.random() < rate
+
+    def is_tail(self, response: AIResponse, attempt_number: int = 1) -> bool:
+        metrics = response.metrics
+        if self.keep_errors and response.finish_reason == FINISH_REASON_ERROR:
+            return True
+        if self.keep_retries and attempt_number > 1:
+            return True
+        if (
+            self.latency_threshold is not None
+            and metrics.latency is not None
+            and metrics.latency > self.latency_threshold
+        ):
+            return True
+        return (
+            self.price_threshold is not None
+            and metrics.price_of_call is not None
+            and metrics.price_of_call > self.price_threshold
+        )
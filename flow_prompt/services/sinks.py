@@ -0,0 +1,247 @@
+import gzip
+import hashlib
+import json
+import logging
+import os
+import shutil
+import sqlite3
+import threading
+import typing as t
+from functools import lru_cache
+from time import time
+
+import requests
+
+from flow_prompt import settings
+from flow_prompt.services.flow_prompt import FlowPromptService
+
+logger = logging.getLogger(__name__)
+
+FLOW_PROMPT_SINK = "flow_prompt"
+JSONL_SINK = "jsonl"
+SQLITE_SINK = "sqlite"
+LOG_KIND = "log"
+TEST_KIND = "test"
+TOKEN_FINGERPRINT_LENGTH = 12
+# statuses of a server without the bulk endpoints
+BULK_UNSUPPORTED_STATUSES = (404, 405)
+
+
+class LogSink:
+    """
+    Destination of serialized interaction logs and tests sent by SaveWorker.
+    save raises on failure, so the batch is spooled or counted as failed.
+    """
+
+    # logs may refer to prompts and context values saved before by hash
+    supports_content_refs: bool = False
+
+    def save(self, api_token: str, logs: t.List[bytes], tests: t.List[bytes]):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class FlowPromptSink(LogSink):
+    """
+    Sends logs and tests to Flow Prompt with one bulk request each.
+    If the server doesn't have a bulk endpoint (404 or 405), the sink sends items
+    of that kind one by one to the per-item endpoint from then on.
+    """
+
+    supports_content_refs = True
+
+    def __init__(self):
+        self.has_bulk_logs = True
+        self.has_bulk_tests = True
+
+    def save(self, api_token: str, logs: t.List[bytes], tests: t.List[bytes]):
+        if logs:
+            self.has_bulk_logs = self._send(
+                api_token,
+                logs,
+                self.has_bulk_logs,
+                FlowPromptService.save_user_interactions,
+                FlowPromptService.save_serialized_interaction,
+            )
+        if tests:
+            self.has_bulk_tests = self._send(
+                api_token,
+                tests,
+                self.has_bulk_tests,
+                FlowPromptService.create_tests_with_ideal_answer,
+                FlowPromptService.create_serialized_test,
+            )
+
+    def _send(
+        self,
+        api_token: str,
+        items: t.List[bytes],
+        has_bulk: bool,
+        send_bulk: t.Callable[[str, t.List[bytes]], None],
+        send_item: t.Callable[[str, bytes], None],
+    ) -> bool:
+        """Returns False if the bulk endpoint isn't supported"""
+        if has_bulk:
+            try:
+                send_bulk(api_token, items)
+                return True
+            except requests.HTTPError as e:
+                if not is_bulk_unsupported(e):
+                    raise
+                logger.warning(f"Bulk endpoint isn't supported, sending items one by one: {e}")
+        for item in items:
+            send_item(api_token, item)
+        return False
+
+
+class JSONLSink(LogSink):
+    """
+    Appends a line {"token_fingerprint", "kind": "log" | "test", "data"} per log and test
+    to path, the api token itself isn't written.
+    The file is rotated to path.1 ... path.{backups} when it grows over max_bytes,
+    rotated files are gzipped to path.1.gz ... if compress is set.
+    """
+
+    def __init__(
+        self,
+        path: str = settings.LOG_SINK_JSONL_PATH,
+        max_bytes: int = settings.LOG_SINK_JSONL_MAX_BYTES,
+        backups: int = settings.LOG_SINK_JSONL_BACKUPS,
+        compress: bool = settings.LOG_SINK_JSONL_COMPRESS,
+    ):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.compress = compress
+        self._lock = threading.Lock()
+        self._file = open(path, "ab")
+        self._size = self._file.tell()
+
+    def save(self, api_token: str, logs: t.List[bytes], tests: t.List[bytes]):
+        fingerprint = get_token_fingerprint(api_token)
+        prefix = b'{"token_fingerprint":' + json.dumps(fingerprint).encode() + b',"kind":'
+        lines = b"".join(
+            [prefix + b'"log","data":' + log + b"}\n" for log in logs]
+            + [prefix + b'"test","data":' + test + b"}\n" for test in tests]
+        )
+        with self._lock:
+            if self._size and self._size + len(lines) > self.max_bytes:
+                self._rotate()
+            self._file.write(lines)
+            self._file.flush()
+            self._size += len(lines)
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+    def get_backup_path(self, number: int) -> str:
+        return f"{self.path}.{number}.gz" if self.compress else f"{self.path}.{number}"
+
+    def _rotate(self):
+        self._file.close()
+        if self.backups > 0:
+            for number in range(self.backups - 1, 0, -1):
+                if os.path.exists(self.get_backup_path(number)):
+                    os.replace(self.get_backup_path(number), self.get_backup_path(number + 1))
+            if self.compress:
+                with open(self.path, "rb") as src, gzip.open(self.get_backup_path(1), "wb") as dst:
+                    shutil.copyfileobj(src, dst)
+                os.remove(self.path)
+            else:
+                os.replace(self.path, self.get_backup_path(1))
+        else:
+            os.remove(self.path)
+        self._file = open(self.path, "ab")
+        self._size = 0
+
+
+class SQLiteSink(LogSink):
+    """
+    Inserts logs and tests into the logs table of a local database,
+    rows have the fingerprint of the api token instead of the token
+    """
+
+    def __init__(self, path: str = settings.LOG_SINK_SQLITE_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._connection:
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS logs (id INTEGER PRIMARY KEY, "
+                "token_fingerprint TEXT NOT NULL, kind TEXT NOT NULL, data TEXT NOT NULL, "
+                "created_at REAL NOT NULL)"
+            )
+
+    def save(self, api_token: str, logs: t.List[bytes], tests: t.List[bytes]):
+        created_at = time()
+        fingerprint = get_token_fingerprint(api_token)
+        rows = [(fingerprint, LOG_KIND, log.decode(), created_at) for log in logs] + [
+            (fingerprint, TEST_KIND, test.decode(), created_at) for test in tests
+        ]
+        with self._lock, self._connection:
+            self._connection.executemany(
+                "INSERT INTO logs (token_fingerprint, kind, data, created_at) VALUES (?, ?, ?, ?)",
+                rows,
+            )
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+class FanOutSink(LogSink):
+    """
+    Saves logs to every sink. Failure of the first sink is raised, so the batch is retried
+    or spooled. Failures of the others are logged, to not duplicate logs in the first one.
+    """
+
+    def __init__(self, sinks: t.List[LogSink]):
+        if not sinks:
+            raise ValueError("FanOutSink requires at least one sink")
+        self.sinks = sinks
+        self.supports_content_refs = all(sink.supports_content_refs for sink in sinks)
+
+    def save(self, api_token: str, logs: t.List[bytes], tests: t.List[bytes]):
+        primary, *others = self.sinks
+        primary.save(api_token, logs, tests)
+        for sink in others:
+            try:
+                sink.save(api_token, logs, tests)
+            except Exception as e:
+                logger.exception(f"{type(sink).__name__} failed to save logs: {e}")
+
+    def close(self):
+        for sink in self.sinks:
+            sink.close()
+
+
+@lru_cache(maxsize=128)
+def get_token_fingerprint(api_token: str) -> str:
+    """Prefix of the token's sha256, tells logs of different tokens apart without the secret"""
+    return hashlib.sha256(api_token.encode()).hexdigest()[:TOKEN_FINGERPRINT_LENGTH]
+
+
+def is_bulk_unsupported(e: requests.HTTPError) -> bool:
+    response = getattr(e, "response", None)
+    return response is not None and response.status_code in BULK_UNSUPPORTED_STATUSES
+
+
+SINKS = {
+    FLOW_PROMPT_SINK: FlowPromptSink,
+    JSONL_SINK: JSONLSink,
+    SQLITE_SINK: SQLiteSink,
+}
+
+
+def get_default_sink(names: str = settings.LOG_SINKS) -> LogSink:
+    """Sinks by comma separated names: flow_prompt, jsonl, sqlite"""
+    sinks = []
+    for name in names.split(","):
+        name = name.strip().lower()
+        if name not in SINKS:
+            raise ValueError(f"Unknown log sink {name}, available: {', '.join(SINKS)}")
+        sinks.append(SINKS[name]())
+    return sinks[0] if len(sinks) == 1 else FanOutSink(sinks)
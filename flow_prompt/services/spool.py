@@ -0,0 +1,212 @@
+import logging
+import os
+import struct
+import threading
+import typing as t
+import zlib
+from enum import Enum
+from time import monotonic
+
+from flow_prompt import settings
+
+logger = logging.getLogger(__name__)
+
+SEGMENT_SUFFIX = ".seg"
+CURSOR_FILE_NAME = "cursor"
+# length and crc32 of the payload
+HEADER = struct.Struct(">II")
+# records hold logs of users, so only the owner of the process can read them
+DIRECTORY_MODE = 0o700
+FILE_MODE = 0o600
+
+Position = t.Tuple[int, int]
+
+
+class FsyncPolicy(Enum):
+    ALWAYS = "always"
+    INTERVAL = "interval"
+    NEVER = "never"
+
+
+class Spool:
+    """
+    Append-only queue of records in segment files on local disk.
+    Every record is framed with its length and crc32, so a torn or corrupted tail
+    of a segment is detected and skipped. Records are read in order from the cursor,
+    which is moved by ack and kept in the cursor file to survive restarts.
+    Segments are rotated by segment_bytes, the oldest ones are deleted
+    when the spool grows over max_bytes.
+    One directory must be used by one process only, it's accessible to its owner only.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        max_bytes: int = settings.SAVE_WORKER_SPOOL_MAX_BYTES,
+        segment_bytes: int = settings.SAVE_WORKER_SPOOL_SEGMENT_BYTES,
+        fsync_policy: t.Union[FsyncPolicy, str] = settings.SAVE_WORKER_SPOOL_FSYNC,
+        fsync_interval: float = settings.SAVE_WORKER_SPOOL_FSYNC_INTERVAL_SECONDS,
+    ):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.segment_bytes = segment_bytes
+        self.fsync_policy = FsyncPolicy(fsync_policy)
+        self.fsync_interval = fsync_interval
+        self._lock = threading.Lock()
+        os.makedirs(path, mode=DIRECTORY_MODE, exist_ok=True)
+        os.chmod(path, DIRECTORY_MODE)
+        self.segments = sorted(
+            int(name[: -len(SEGMENT_SUFFIX)])
+            for name in os.listdir(path)
+            if name.endswith(SEGMENT_SUFFIX)
+        )
+        self._cursor = self._load_cursor()
+        self.size = 0
+        for segment in [s for s in self.segments if s < self._cursor[0]]:
+            self._delete_segment(segment)
+        self.size = sum(
+            os.path.getsize(self._get_segment_path(segment)) for segment in self.segments
+        )
+        # records are never appended after a possibly torn tail of the previous run
+        self._file = None
+        self._file_size = 0
+        self._synced_at = monotonic()
+        self._open_segment()
+        if self._cursor[0] not in self.segments:
+            segment = min((s for s in self.segments if s >= self._cursor[0]), default=None)
+            self._set_cursor((self.segments[0], 0) if segment is None else (segment, 0))
+
+    def append(self, payload: bytes) -> bool:
+        """Returns False if the record doesn't fit into max_bytes"""
+        frame = HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+        with self._lock:
+            if len(frame) > self.max_bytes:
+                return False
+            if self._file_size and self._file_size + len(frame) > self.segment_bytes:
+                self._open_segment()
+            while self.size + len(frame) > self.max_bytes and len(self.segments) > 1:
+                logger.warning("Spool is full, the oldest segment is deleted")
+                self._delete_segment(self.segments[0])
+            if self.size + len(frame) > self.max_bytes:
+                return False
+            self._file.write(frame)
+            self._file.flush()
+            self._file_size += len(frame)
+            self.size += len(frame)
+            self._sync()
+            return True
+
+    def read(self) -> t.Optional[t.Tuple[Position, bytes]]:
+        """The oldest not acknowledged record and the position to ack it with"""
+        with self._lock:
+            while True:
+                segment, offset = self._cursor
+                record = self._read_record(segment, offset)
+                if record is not None:
+                    return record
+                if segment == self.segments[-1]:
+                    return None
+                # the segment is consumed or its tail is broken
+                self._delete_segment(segment)
+                self._set_cursor((self.segments[0], 0))
+
+    def ack(self, position: Position):
+        with self._lock:
+            if position[0] in self.segments:
+                self._set_cursor(position)
+
+    def is_empty(self) -> bool:
+        with self._lock:
+            return self._cursor == (self.segments[-1], self._file_size)
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.flush()
+                if self.fsync_policy != FsyncPolicy.NEVER:
+                    os.fsync(self._file.fileno())
+                self._file.close()
+                self._file = None
+
+    def _read_record(self, segment: int, offset: int) -> t.Optional[t.Tuple[Position, bytes]]:
+        with open(self._get_segment_path(segment), "rb") as f:
+            f.seek(offset)
+            header = f.read(HEADER.size)
+            if len(header) < HEADER.size:
+                return None
+            length, crc = HEADER.unpack(header)
+            payload = f.read(length)
+        if len(payload) < length:
+            if segment != self.segments[-1]:
+                logger.warning(f"Spool segment {segment} has a truncated record")
+            return None
+        if zlib.crc32(payload) != crc:
+            logger.warning(f"Spool segment {segment} has a corrupted record")
+            return None
+        return (segment, offset + HEADER.size + length), payload
+
+    def _open_segment(self):
+        if self._file is not None:
+            self._file.close()
+        segment = self.segments[-1] + 1 if self.segments else 0
+        self._file = open(self._get_segment_path(segment), "ab", opener=open_private)
+        self._file_size = 0
+        self.segments.append(segment)
+        if len(self.segments) == 1:
+            self._set_cursor((segment, 0))
+
+    def _delete_segment(self, segment: int):
+        segment_path = self._get_segment_path(segment)
+        if os.path.exists(segment_path):
+            self.size -= os.path.getsize(segment_path)
+            os.remove(segment_path)
+        self.segments.remove(segment)
+        if self._cursor[0] == segment:
+            self._set_cursor((self.segments[0], 0))
+
+    def _sync(self):
+        if self.fsync_policy == FsyncPolicy.NEVER:
+            return
+        now = monotonic()
+        if (
+            self.fsync_policy == FsyncPolicy.INTERVAL
+            and now - self._synced_at < self.fsync_interval
+        ):
+            return
+        os.fsync(self._file.fileno())
+        self._synced_at = now
+
+    def _load_cursor(self) -> Position:
+        try:
+            with open(os.path.join(self.path, CURSOR_FILE_NAME)) as f:
+                segment, offset = f.read().split()
+                return int(segment), int(offset)
+        except (OSError, ValueError):
+            return (self.segments[0], 0) if self.segments else (0, 0)
+
+    def _set_cursor(self, position: Position):
+        self._cursor = position
+        cursor_path = os.path.join(self.path, CURSOR_FILE_NAME)
+        with open(f"{cursor_path}.tmp", "w", opener=open_private) as f:
+            f.write(f"{position[0]} {position[1]}")
+        os.replace(f"{cursor_path}.tmp", cursor_path)
+
+    def _get_segment_path(self, segment: int) -> str:
+        return os.path.join(self.path, f"{segment:012d}{SEGMENT_SUFFIX}")
+
+
+def open_private(path: str, flags: int) -> int:
+    return os.open(path, flags, FILE_MODE)
+
+
+_spools: t.Dict[str, Spool] = {}
+_spools_lock = threading.Lock()
+
+
+def get_spool(path: str) -> Spool:
+    """Spool of the directory shared by all workers of the process"""
+    path = os.path.abspath(path)
+    with _spools_lock:
+        if path not in _spools:
+            _spools[path] = Spool(path)
+        return _spools[path]
@@ -1,4 +1,5 @@
 from dataclasses import dataclass, field
+from decimal import Decimal
 import json
 import os
 
@@ -39,6 +40,146 @@ RECEIVE_PROMPT_FROM_SERVER = parse_bool(
 )
 PIPE_PROMPTS = {}
 
+RESPONSE_CACHE_MAX_SIZE = int(os.environ.get("FLOW_PROMPT_RESPONSE_CACHE_MAX_SIZE", 1000))
+RESPONSE_CACHE_TTL_SECONDS = int(
+    os.environ.get("FLOW_PROMPT_RESPONSE_CACHE_TTL_SECONDS", 24 * 60 * 60)
+)  # 1 day by default
+RESPONSE_CACHE_PATH = os.environ.get(
+    "FLOW_PROMPT_RESPONSE_CACHE_PATH", "flow_prompt_responses.sqlite3"
+)
+NEAR_DUPLICATE_THRESHOLD = float(
+    os.environ.get("FLOW_PROMPT_NEAR_DUPLICATE_THRESHOLD", 0.9)
+)
+
+# interaction logs are sent in batches by count, bytes or time since the first log
+SAVE_WORKER_MAX_BATCH_SIZE = int(os.environ.get("FLOW_PROMPT_SAVE_WORKER_MAX_BATCH_SIZE", 100))
+SAVE_WORKER_MAX_BATCH_BYTES = int(
+    os.environ.get("FLOW_PROMPT_SAVE_WORKER_MAX_BATCH_BYTES", 1024 * 1024)
+)
+SAVE_WORKER_MAX_BATCH_INTERVAL_SECONDS = float(
+    os.environ.get("FLOW_PROMPT_SAVE_WORKER_MAX_BATCH_INTERVAL_SECONDS", 1)
+)
+SAVE_WORKER_GZIP = parse_bool(os.environ.get("FLOW_PROMPT_SAVE_WORKER_GZIP", True))
+SAVE_WORKER_GZIP_LEVEL = int(os.environ.get("FLOW_PROMPT_SAVE_WORKER_GZIP_LEVEL", 6))
+# queued interactions are bounded, on overflow the oldest or the newest one is dropped,
+# or the caller is blocked for SAVE_WORKER_BLOCK_TIMEOUT_SECONDS at most ("block")
+SAVE_WORKER_MAX_QUEUE_SIZE = int(os.environ.get("FLOW_PROMPT_SAVE_WORKER_MAX_QUEUE_SIZE", 10000))
+SAVE_WORKER_OVERFLOW_POLICY = os.environ.get(
+    "FLOW_PROMPT_SAVE_WORKER_OVERFLOW_POLICY", "drop_oldest"
+)
+SAVE_WORKER_BLOCK_TIMEOUT_SECONDS = float(
+    os.environ.get("FLOW_PROMPT_SAVE_WORKER_BLOCK_TIMEOUT_SECONDS", 1)
+)
+SAVE_WORKER_THREADS = int(os.environ.get("FLOW_PROMPT_SAVE_WORKER_THREADS", 1))
+# prompts and context values of SAVE_WORKER_CONTENT_REF_MIN_BYTES and more are sent once,
+# later logs refer to them by hash, off by default as the server must support the refs
+SAVE_WORKER_CONTENT_REFS = parse_bool(
+    os.environ.get("FLOW_PROMPT_SAVE_WORKER_CONTENT_REFS", False)
+)
+SAVE_WORKER_CONTENT_REF_MIN_BYTES = int(
+    os.environ.get("FLOW_PROMPT_SAVE_WORKER_CONTENT_REF_MIN_BYTES", 1024)
+)
+SAVE_WORKER_CONTENT_INDEX_SIZE = int(
+    os.environ.get("FLOW_PROMPT_SAVE_WORKER_CONTENT_INDEX_SIZE", 10000)
+)
+# queued interactions are sent on interpreter exit within the timeout
+SAVE_WORKER_EXIT_TIMEOUT_SECONDS = float(
+    os.environ.get("FLOW_PROMPT_SAVE_WORKER_EXIT_TIMEOUT_SECONDS", 5)
+)
+# overflowed and not sent interactions are kept on disk in the spool directory if it's set
+SAVE_WORKER_SPOOL_PATH = os.environ.get("FLOW_PROMPT_SAVE_WORKER_SPOOL_PATH", "")
+SAVE_WORKER_SPOOL_MAX_BYTES = int(
+    os.environ.get("FLOW_PROMPT_SAVE_WORKER_SPOOL_MAX_BYTES", 256 * 1024 * 1024)
+)
+SAVE_WORKER_SPOOL_SEGMENT_BYTES = int(
+    os.environ.get("FLOW_PROMPT_SAVE_WORKER_SPOOL_SEGMENT_BYTES", 8 * 1024 * 1024)
+)
+# always, interval or never
+SAVE_WORKER_SPOOL_FSYNC = os.environ.get("FLOW_PROMPT_SAVE_WORKER_SPOOL_FSYNC", "interval")
+SAVE_WORKER_SPOOL_FSYNC_INTERVAL_SECONDS = float(
+    os.environ.get("FLOW_PROMPT_SAVE_WORKER_SPOOL_FSYNC_INTERVAL_SECONDS", 1)
+)
+SAVE_WORKER_SPOOL_RETRY_SECONDS = float(
+    os.environ.get("FLOW_PROMPT_SAVE_WORKER_SPOOL_RETRY_SECONDS", 30)
+)
+
+# comma separated destinations of interaction logs: flow_prompt, jsonl, sqlite
+LOG_SINKS = os.environ.get("FLOW_PROMPT_LOG_SINKS", "flow_prompt")
+LOG_SINK_JSONL_PATH = os.environ.get("FLOW_PROMPT_LOG_SINK_JSONL_PATH", "flow_prompt_logs.jsonl")
+LOG_SINK_JSONL_MAX_BYTES = int(
+    os.environ.get("FLOW_PROMPT_LOG_SINK_JSONL_MAX_BYTES", 100 * 1024 * 1024)
+)
+LOG_SINK_JSONL_BACKUPS = int(os.environ.get("FLOW_PROMPT_LOG_SINK_JSONL_BACKUPS", 5))
+LOG_SINK_JSONL_COMPRESS = parse_bool(
+    os.environ.get("FLOW_PROMPT_LOG_SINK_JSONL_COMPRESS", False)
+)
+LOG_SINK_SQLITE_PATH = os.environ.get(
+    "FLOW_PROMPT_LOG_SINK_SQLITE_PATH", "flow_prompt_logs.sqlite3"
+)
+
+# share of logged interactions, errors, retries, slow and expensive calls are always logged
+LOG_SAMPLING_RATE = float(os.environ.get("FLOW_PROMPT_LOG_SAMPLING_RATE", 1))
+LOG_SAMPLING_LATENCY_THRESHOLD_MS = (
+    int(os.environ["FLOW_PROMPT_LOG_SAMPLING_LATENCY_THRESHOLD_MS"])
+    if os.environ.get("FLOW_PROMPT_LOG_SAMPLING_LATENCY_THRESHOLD_MS")
+    else None
+)
+LOG_SAMPLING_PRICE_THRESHOLD = (
+    Decimal(os.environ["FLOW_PROMPT_LOG_SAMPLING_PRICE_THRESHOLD"])
+    if os.environ.get("FLOW_PROMPT_LOG_SAMPLING_PRICE_THRESHOLD")
+    else None
+)
+
+# return LeanAIResponse without SDK objects from FlowPrompt calls
+LEAN_RESPONSES = parse_bool(os.environ.get("FLOW_PROMPT_LEAN_RESPONSES", False))
+
+# compiled output schemas of prompts
+SCHEMA_VALIDATORS_CACHE_SIZE = int(
+    os.environ.get("FLOW_PROMPT_SCHEMA_VALIDATORS_CACHE_SIZE", 256)
+)
+
+BATCH_POLL_INTERVAL_SECONDS = int(
+    os.environ.get("FLOW_PROMPT_BATCH_POLL_INTERVAL_SECONDS", 30)
+)
+
+# count of stream events waiting for the consumer of FlowPrompt.stream
+STREAM_MAX_BUFFERED_EVENTS = int(
+    os.environ.get("FLOW_PROMPT_STREAM_MAX_BUFFERED_EVENTS", 100)
+)
+
+# check_connection of streamed calls is called at most once in this interval
+STREAM_CHECK_CONNECTION_INTERVAL_SECONDS = float(
+    os.environ.get("FLOW_PROMPT_STREAM_CHECK_CONNECTION_INTERVAL_SECONDS", 0.5)
+)
+STREAM_CHECK_CONNECTION_IN_BACKGROUND = parse_bool(
+    os.environ.get("FLOW_PROMPT_STREAM_CHECK_CONNECTION_IN_BACKGROUND", False)
+)
+
+# coalescing of streamed deltas, 0 bytes delivers every delta as is
+STREAM_FLUSH_MAX_BYTES = int(os.environ.get("FLOW_PROMPT_STREAM_FLUSH_MAX_BYTES", 0))
+STREAM_FLUSH_INTERVAL_SECONDS = float(
+    os.environ.get("FLOW_PROMPT_STREAM_FLUSH_INTERVAL_SECONDS", 0.1)
+)
+STREAM_FLUSH_ON_SENTENCE_END = parse_bool(
+    os.environ.get("FLOW_PROMPT_STREAM_FLUSH_ON_SENTENCE_END", True)
+)
+
+GEMINI_CONTEXT_CACHE_TTL_SECONDS = int(
+    os.environ.get("FLOW_PROMPT_GEMINI_CONTEXT_CACHE_TTL_SECONDS", 60 * 60)
+)
+# cached content is prolonged when it expires sooner than in this time
+GEMINI_CONTEXT_CACHE_REFRESH_SECONDS = int(
+    os.environ.get("FLOW_PROMPT_GEMINI_CONTEXT_CACHE_REFRESH_SECONDS", 5 * 60)
+)
+# contents which failed to be cached aren't retried for this time
+GEMINI_CONTEXT_CACHE_RETRY_SECONDS = int(
+    os.environ.get("FLOW_PROMPT_GEMINI_CONTEXT_CACHE_RETRY_SECONDS", 10 * 60)
+)
+# Gemini doesn't cache smaller contents
+GEMINI_CONTEXT_CACHE_MIN_TOKENS = int(
+    os.environ.get("FLOW_PROMPT_GEMINI_CONTEXT_CACHE_MIN_TOKENS", 32768)
+)
+
 
 @dataclass
 class Secrets:
@@ -0,0 +1,434 @@
+import asyncio
+import concurrent.futures
+import logging
+import math
+import queue
+import re
+import threading
+import typing as t
+from dataclasses import dataclass, field
+from time import monotonic
+
+from flow_prompt import settings
+from flow_prompt.cancellation import CancellationToken
+from flow_prompt.exceptions import CallCancelledError, ConnectionLostError
+from flow_prompt.responses import AIResponse, Metrics
+
+logger = logging.getLogger(__name__)
+
+PUT_EVENT_TIMEOUT_SECONDS = 0.1
+SENTENCE_END_RE = re.compile(r"[.!?\n][\"')\]]*\s*$")
+# end of the buffered text matched with SENTENCE_END_RE, a sentence end may span deltas
+SENTENCE_END_TAIL_CHARS = 32
+STREAM_METRICS = (
+    "time_to_first_token",
+    "inter_chunk_gap_p50",
+    "inter_chunk_gap_p99",
+    "tokens_per_second",
+    "stream_function_time",
+    "check_connection_time",
+)
+
+
+@dataclass
+class StreamEvent:
+    pass
+
+
+@dataclass
+class TextDelta(StreamEvent):
+    text: str
+
+
+@dataclass
+class ToolCallDelta(StreamEvent):
+    index: int
+    id: str = None
+    name: str = None
+    arguments: str = ""
+
+
+@dataclass
+class Usage(StreamEvent):
+    prompt_tokens: int = None
+    completion_tokens: int = None
+
+
+@dataclass
+class FinalResponse(StreamEvent):
+    response: AIResponse
+
+
+@dataclass
+class FlushPolicy:
+    """
+    Coalesces small streamed deltas before they are delivered.
+    Buffered text is flushed when it reaches max_bytes, when max_interval seconds
+    passed since the last flush, or when it ends a sentence if flush_on_sentence_end.
+    The interval is checked when a delta arrives and by a timer while the next one
+    is awaited, the rest is flushed at the end of the stream.
+    max_bytes=0 delivers every delta as is.
+    """
+
+    max_bytes: int = None
+    max_interval: float = None
+    flush_on_sentence_end: bool = None
+
+    def __post_init__(self):
+        if self.max_bytes is None:
+            self.max_bytes = settings.STREAM_FLUSH_MAX_BYTES
+        if self.max_interval is None:
+            self.max_interval = settings.STREAM_FLUSH_INTERVAL_SECONDS
+        if self.flush_on_sentence_end is None:
+            self.flush_on_sentence_end = settings.STREAM_FLUSH_ON_SENTENCE_END
+
+    def should_flush(self, buffered_bytes: int, buffered: str, last_flush_at: float) -> bool:
+        if buffered_bytes >= self.max_bytes:
+            return True
+        if self.max_interval and monotonic() - last_flush_at >= self.max_interval:
+            return True
+        return bool(self.flush_on_sentence_end and SENTENCE_END_RE.search(buffered))
+
+
+@dataclass
+class StreamHandler:
+    """
+    Receives streamed deltas from AI models, collects the content and delivers deltas
+    to the legacy stream_function callback and to the on_event listener.
+    The same handler is used by all AI models, so streaming works the same way for them.
+
+    check_connection is called at most once in check_connection_interval seconds,
+    in a background thread if check_connection_in_background is set, so a slow check
+    doesn't delay tokens. A lost connection cancels the token, which closes the provider stream.
+    Deltas are coalesced according to flush_policy, AI models call flush at the end of the stream.
+    parser (response_parsers.stream_parser) receives every delta and its parsed values are emitted
+    as soon as they are complete, finish gives the parser the end of a successful stream. With stop_when_complete AI models stop reading
+    and close the provider stream when the parser has the whole structure (is_stopped).
+    Arrival times of deltas and time spent in the callbacks are recorded for update_metrics.
+    """
+
+    stream_function: t.Callable = None
+    check_connection: t.Callable = None
+    stream_params: dict = field(default_factory=dict)
+    on_event: t.Callable[[StreamEvent], None] = None
+    cancellation_token: CancellationToken = None
+    check_connection_interval: float = None
+    check_connection_in_background: bool = None
+    flush_policy: FlushPolicy = None
+    parser: t.Any = None
+    stop_when_complete: bool = False
+
+    def __post_init__(self):
+        self.stream_params = self.stream_params or {}
+        if self.check_connection_interval is None:
+            self.check_connection_interval = (
+                settings.STREAM_CHECK_CONNECTION_INTERVAL_SECONDS
+            )
+        if self.check_connection_in_background is None:
+            self.check_connection_in_background = (
+                settings.STREAM_CHECK_CONNECTION_IN_BACKGROUND
+            )
+        if self.flush_policy is None:
+            self.flush_policy = FlushPolicy()
+        self._chunks: t.List[str] = []
+        self._buffer: t.List[str] = []
+        self._buffered_bytes = 0
+        self._buffered_tail = ""
+        self._last_flush_at = monotonic()
+        # buffered text is flushed by the model's thread and by the interval timer
+        self._flush_lock = threading.RLock()
+        self._flush_timer: t.Optional[threading.Thread] = None
+        self._next_check_at = None
+        self._closed = threading.Event()
+        self._monitor: t.Optional[threading.Thread] = None
+        self.is_connection_lost = False
+        self._started_at = monotonic()
+        self._first_chunk_at = None
+        self._last_chunk_at = None
+        self._gaps: t.List[float] = []
+        self._completion_tokens = None
+        self._stream_function_time = 0.0
+        self._check_connection_time = 0.0
+
+    @property
+    def content(self) -> str:
+        return "".join(self._chunks)
+
+    @property
+    def is_stopped(self) -> bool:
+        return (
+            self.stop_when_complete
+            and self.parser is not None
+            and self.parser.is_complete
+            and self.parser.result is not None
+        )
+
+    def on_text(self, text: t.Optional[str]):
+        if self.cancellation_token:
+            self.cancellation_token.raise_if_cancelled()
+        self._check_connection()
+        if not text:
+            return
+        self._record_chunk()
+        self._chunks.append(text)
+        with self._flush_lock:
+            if self.parser is not None:
+                for parsed_event in self.parser.feed(text):
+                    self._emit(parsed_event)
+            self._buffer.append(text)
+            self._buffered_bytes += len(text.encode())
+            self._buffered_tail = (self._buffered_tail + text)[-SENTENCE_END_TAIL_CHARS:]
+            if self.flush_policy.should_flush(
+                self._buffered_bytes, self._buffered_tail, self._last_flush_at
+            ):
+                self.flush()
+            elif self.flush_policy.max_interval and self._flush_timer is None:
+                self._flush_timer = threading.Thread(
+                    target=self._flush_on_interval, daemon=True
+                )
+                self._flush_timer.start()
+
+    def on_tool_call(
+        self, index: int, id: str = None, name: str = None, arguments: str = ""
+    ):
+        if self.cancellation_token:
+            self.cancellation_token.raise_if_cancelled()
+        self._record_chunk()
+        with self._flush_lock:
+            self.flush()
+            self._emit(
+                ToolCallDelta(index=index, id=id, name=name, arguments=arguments or "")
+            )
+
+    def on_usage(self, prompt_tokens: int = None, completion_tokens: int = None):
+        self._completion_tokens = completion_tokens
+        with self._flush_lock:
+            self.flush()
+            self._emit(
+                Usage(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens)
+            )
+
+    def flush(self):
+        """Delivers buffered text"""
+        with self._flush_lock:
+            self._last_flush_at = monotonic()
+            if not self._buffer:
+                return
+            text = "".join(self._buffer)
+            self._buffer = []
+            self._buffered_bytes = 0
+            self._buffered_tail = ""
+            if self.stream_function:
+                started_at = monotonic()
+                self.stream_function(text, **self.stream_params)
+                self._stream_function_time += monotonic() - started_at
+            self._emit(TextDelta(text=text))
+
+    def finish(self):
+        """Ends the stream, values completed by its end are emitted after the buffered text"""
+        with self._flush_lock:
+            self.flush()
+            if self.parser is not None:
+                for parsed_event in self.parser.finish():
+                    self._emit(parsed_event)
+
+    def close(self):
+        """Stops the background connection checks and the interval flushes"""
+        self._closed.set()
+
+    def _flush_on_interval(self):
+        """Flushes text buffered for max_interval while the next delta is awaited"""
+        interval = self.flush_policy.max_interval
+        timeout = interval
+        while not self._closed.wait(timeout):
+            with self._flush_lock:
+                if self._buffer and monotonic() - self._last_flush_at >= interval:
+                    try:
+                        self.flush()
+                    except Exception as e:
+                        logger.exception(f"Failed to deliver streamed text: {e}")
+                        return
+                timeout = interval
+                if self._buffer:
+                    timeout = max(self._last_flush_at + interval - monotonic(), 0)
+
+    def _check_connection(self):
+        if self.is_connection_lost:
+            raise ConnectionLostError("Connection was lost!")
+        if not self.check_connection:
+            return
+        if self.check_connection_in_background:
+            if self._monitor is None:
+                self._monitor = threading.Thread(target=self._monitor_connection, daemon=True)
+                self._monitor.start()
+            return
+        now = monotonic()
+        if self._next_check_at is not None and now < self._next_check_at:
+            return
+        self._next_check_at = now + self.check_connection_interval
+        if not self.is_connected():
+            self._set_connection_lost()
+            raise ConnectionLostError("Connection was lost!")
+
+    def _monitor_connection(self):
+        while not self._closed.is_set():
+            if not self.is_connected():
+                self._set_connection_lost()
+                return
+            if self.cancellation_token and self.cancellation_token.is_cancelled:
+                return
+            self._closed.wait(self.check_connection_interval)
+
+    def is_connected(self) -> bool:
+        started_at = monotonic()
+        try:
+            return bool(self.check_connection(**self.stream_params))
+        except Exception as e:
+            logger.warning(f"check_connection failed, considering connection as lost: {e}")
+            return False
+        finally:
+            self._check_connection_time += monotonic() - started_at
+
+    def update_metrics(self, metrics: Metrics, completion_tokens: int = None):
+        """
+        Sets streaming metrics of the call, they are cleared if nothing was streamed,
+        e.g. for a reused response.
+        Tokens reported by the provider are preferred over completion_tokens.
+        """
+        for name in STREAM_METRICS:
+            setattr(metrics, name, None)
+        if self._first_chunk_at is None:
+            return
+        metrics.time_to_first_token = to_ms(self._first_chunk_at - self._started_at)
+        if self._gaps:
+            metrics.inter_chunk_gap_p50 = to_ms(get_percentile(self._gaps, 50))
+            metrics.inter_chunk_gap_p99 = to_ms(get_percentile(self._gaps, 99))
+        completion_tokens = self._completion_tokens or completion_tokens
+        generation_time = self._last_chunk_at - self._first_chunk_at
+        if completion_tokens and generation_time > 0:
+            metrics.tokens_per_second = round(completion_tokens / generation_time, 3)
+        metrics.stream_function_time = to_ms(self._stream_function_time)
+        metrics.check_connection_time = to_ms(self._check_connection_time)
+
+    def _record_chunk(self):
+        now = monotonic()
+        if self._first_chunk_at is None:
+            self._first_chunk_at = now
+        else:
+            self._gaps.append(now - self._last_chunk_at)
+        self._last_chunk_at = now
+
+    def _set_connection_lost(self):
+        logger.info("Connection was lost, closing the stream")
+        self.is_connection_lost = True
+        if self.cancellation_token:
+            self.cancellation_token.cancel(ConnectionLostError("Connection was lost!"))
+
+    def _emit(self, event: StreamEvent):
+        if self.on_event:
+            self.on_event(event)
+
+
+def get_percentile(values: t.List[float], percent: float) -> float:
+    """Nearest-rank percentile"""
+    ordered = sorted(values)
+    rank = max(math.ceil(percent / 100 * len(ordered)), 1)
+    return ordered[rank - 1]
+
+
+def to_ms(seconds: float) -> float:
+    return round(seconds * 1000, 3)
+
+
+@dataclass
+class _StreamError:
+    error: BaseException
+
+
+def iterate_events(
+    run: t.Callable[[t.Callable[[StreamEvent], None]], AIResponse],
+    cancellation_token: CancellationToken,
+    max_buffered_events: int,
+) -> t.Iterator[StreamEvent]:
+    """
+    Runs run(on_event) in a background thread and yields its events, FinalResponse is the last one.
+    The thread waits while max_buffered_events are not consumed.
+    When the consumer stops iterating, the token is cancelled to close the provider stream.
+    """
+    events = queue.Queue(maxsize=max_buffered_events)
+
+    def put(event):
+        while True:
+            try:
+                events.put(event, timeout=PUT_EVENT_TIMEOUT_SECONDS)
+                return
+            except queue.Full:
+                cancellation_token.raise_if_cancelled()
+
+    def produce():
+        try:
+            put(FinalResponse(response=run(put)))
+        except BaseException as e:
+            try:
+                put(_StreamError(error=e))
+            except CallCancelledError:
+                logger.debug(f"Stream consumer has left, dropping error: {e}")
+
+    threading.Thread(target=produce, daemon=True).start()
+    try:
+        while True:
+            event = events.get()
+            if isinstance(event, _StreamError):
+                raise event.error
+            yield event
+            if isinstance(event, FinalResponse):
+                return
+    finally:
+        cancellation_token.cancel()
+
+
+async def aiterate_events(
+    run: t.Callable[[t.Callable[[StreamEvent], None]], AIResponse],
+    cancellation_token: CancellationToken,
+    max_buffered_events: int,
+) -> t.AsyncIterator[StreamEvent]:
+    """
+    Async version of iterate_events. run(on_event) is called in a dedicated thread
+    which puts events into an asyncio.Queue of the running loop,
+    so concurrent streams don't hold threads of the default executor.
+    """
+    loop = asyncio.get_running_loop()
+    events = asyncio.Queue(maxsize=max_buffered_events)
+
+    def put(event):
+        future = asyncio.run_coroutine_threadsafe(events.put(event), loop)
+        while True:
+            try:
+                future.result(timeout=PUT_EVENT_TIMEOUT_SECONDS)
+                return
+            except concurrent.futures.TimeoutError:
+                if cancellation_token.is_cancelled:
+                    future.cancel()
+                cancellation_token.raise_if_cancelled()
+
+    def produce():
+        try:
+            put(FinalResponse(response=run(put)))
+        except BaseException as e:
+            try:
+                put(_StreamError(error=e))
+            except (CallCancelledError, RuntimeError):
+                # the consumer has left or its loop is closed
+                logger.debug(f"Stream consumer has left, dropping error: {e}")
+
+    threading.Thread(target=produce, daemon=True).start()
+    try:
+        while True:
+            event = await events.get()
+            if isinstance(event, _StreamError):
+                raise event.error
+            yield event
+            if isinstance(event, FinalResponse):
+                return
+    finally:
+        cancellation_token.cancel()
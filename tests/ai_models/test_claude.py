@@ -0,0 +1,256 @@
+import json
+
+import anthropic
+import httpx
+import pytest
+
+from flow_prompt.ai_models.attempt_to_call import AttemptToCall
+from flow_prompt.cancellation import CancellationToken
+from flow_prompt.exceptions import RetryableCustomError
+from flow_prompt.ai_models.claude.claude_model import (
+    PROMPT_CACHING_BETA_HEADERS,
+    ClaudeAIModel,
+)
+from flow_prompt.ai_models.openai.responses import FINISH_REASON_STRUCTURE_COMPLETE
+from flow_prompt.prompt.pipe_prompt import PipePrompt
+from flow_prompt.response_parsers.stream_parser import JSONStreamParser
+from flow_prompt.streaming import StreamHandler, Usage
+
+
+@pytest.fixture
+def claude_model():
+    return ClaudeAIModel(
+        model="claude-3-haiku-20240307", max_tokens=4096, prompt_caching=True
+    )
+
+
+@pytest.fixture
+def requests(monkeypatch, claude_model):
+    requests = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        requests.append(request)
+        return httpx.Response(
+            200,
+            json={
+                "id": "msg_1",
+                "type": "message",
+                "role": "assistant",
+                "model": claude_model.model,
+                "content": [{"type": "text", "text": "Hello"}],
+                "stop_reason": "end_turn",
+                "usage": {
+                    "input_tokens": 10,
+                    "output_tokens": 5,
+                    "cache_read_input_tokens": 3000,
+                    "cache_creation_input_tokens": 0,
+                },
+            },
+        )
+
+    client = anthropic.Anthropic(
+        api_key="123", http_client=httpx.Client(transport=httpx.MockTransport(handler))
+    )
+    monkeypatch.setattr(claude_model, "get_client", lambda client_secrets: client)
+    return requests
+
+
+def test_static_system_prefix_is_sent_as_cached_system_block(claude_model, requests):
+    messages = [
+        {"role": "system", "content": "You are a support bot."},
+        {"role": "system", "content": "Answer shortly."},
+        {"role": "user", "content": "Question"},
+    ]
+    response = claude_model.call(messages, 100, static_prefix_count=2)
+
+    body = json.loads(requests[0].content)
+    assert requests[0].headers["anthropic-beta"] == PROMPT_CACHING_BETA_HEADERS["anthropic-beta"]
+    assert body["system"] == [
+        {
+            "type": "text",
+            "text": "You are a support bot.\nAnswer shortly.",
+            "cache_control": {"type": "ephemeral"},
+        }
+    ]
+    assert body["messages"] == [
+        {"role": "user", "content": [{"type": "text", "text": "Question"}]}
+    ]
+    assert response.content == "Hello"
+    assert response.metrics.cache_read_tokens == 3000
+    assert response.metrics.cache_creation_tokens == 0
+
+
+def test_static_user_messages_keep_their_role(claude_model):
+    messages = [
+        {"role": "system", "content": "You are a support bot."},
+        {"role": "user", "content": "Instructions"},
+        {"role": "assistant", "content": "Ok"},
+        {"role": "user", "content": "Question"},
+    ]
+    request_args = claude_model.get_request_args(messages, static_prefix_count=3)
+
+    assert request_args["system"] == [{"type": "text", "text": "You are a support bot."}]
+    assert request_args["messages"] == [
+        {"role": "user", "content": [{"type": "text", "text": "Instructions"}]},
+        {
+            "role": "assistant",
+            "content": [
+                {"type": "text", "text": "Ok", "cache_control": {"type": "ephemeral"}}
+            ],
+        },
+        {"role": "user", "content": [{"type": "text", "text": "Question"}]},
+    ]
+
+
+def test_prompt_caching_is_opt_in():
+    claude_model = ClaudeAIModel(model="claude-3-haiku-20240307", max_tokens=4096)
+    messages = [
+        {"role": "system", "content": "Instructions"},
+        {"role": "user", "content": "Question"},
+    ]
+    request_args = claude_model.get_request_args(messages, static_prefix_count=1)
+    assert request_args == {
+        "messages": [{"role": "user", "content": "InstructionsQuestion"}]
+    }
+
+
+def test_messages_without_static_prefix_are_not_cached(claude_model, requests):
+    messages = [
+        {"role": "system", "content": "Hi "},
+        {"role": "user", "content": "there"},
+    ]
+    claude_model.call(messages, 100)
+
+    body = json.loads(requests[0].content)
+    assert "system" not in body
+    assert "anthropic-beta" not in requests[0].headers
+    assert body["messages"] == [{"role": "user", "content": "Hi there"}]
+
+
+def test_whole_static_prompt_keeps_last_message_as_user_turn(claude_model):
+    messages = [
+        {"role": "system", "content": "Instructions"},
+        {"role": "user", "content": "Question"},
+    ]
+    request_args = claude_model.get_request_args(messages, static_prefix_count=2)
+    assert request_args["system"][0]["text"] == "Instructions"
+    assert request_args["messages"] == [
+        {"role": "user", "content": [{"type": "text", "text": "Question"}]}
+    ]
+
+
+def test_cached_tokens_are_cheaper(claude_model):
+    full_price = claude_model.get_prompt_price(10_000)
+    assert claude_model.get_prompt_price(10_000, cache_read_tokens=9_000) < full_price
+    assert claude_model.get_prompt_price(10_000, cache_creation_tokens=9_000) > full_price
+
+
+def test_static_prefix_count_of_resolved_prompt(claude_model):
+    prompt = PipePrompt(id="static-prefix")
+    prompt.add("You are a support bot.", role="system")
+    prompt.add("Answer shortly.")
+    prompt.add("{question}")
+    prompt.add("Thanks!")
+    prompt.add("{history}", is_multiple=True)
+
+    user_prompt = prompt.create_prompt(AttemptToCall(ai_model=claude_model, weight=1))
+    calling_messages = user_prompt.resolve({"question": "How?"})
+    assert calling_messages.static_prefix_count == 2
+
+
+def test_cacheable_chat_with_placeholder_is_in_static_prefix(claude_model):
+    prompt = PipePrompt(id="cacheable-prefix")
+    prompt.add("{documents}", cacheable=True)
+    prompt.add("{question}")
+
+    user_prompt = prompt.create_prompt(AttemptToCall(ai_model=claude_model, weight=1))
+    calling_messages = user_prompt.resolve({"documents": "Docs", "question": "How?"})
+    assert calling_messages.static_prefix_count == 1
+    assert prompt.dump()["priorities"][0][0]["cacheable"] is True
+
+
+def test_client_does_not_retry_within_deadline(claude_model, monkeypatch):
+    requests = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        requests.append(request)
+        return httpx.Response(500, json={"type": "error", "error": {"type": "api_error"}})
+
+    client = anthropic.Anthropic(
+        api_key="123", http_client=httpx.Client(transport=httpx.MockTransport(handler))
+    )
+    monkeypatch.setattr(claude_model, "get_client", lambda client_secrets: client)
+    messages = [{"role": "user", "content": "Question"}]
+
+    with pytest.raises(RetryableCustomError):
+        claude_model.call(messages, 100, cancellation_token=CancellationToken(timeout=10))
+    assert len(requests) == 1
+
+
+def get_sse(events):
+    return "".join(
+        f"event: {event['type']}\ndata: {json.dumps(event)}\n\n" for event in events
+    ).encode()
+
+
+def test_early_stop_does_not_report_partial_output_tokens(claude_model, monkeypatch):
+    deltas = ['{"a": ', "1}", " and more"]
+    events = [
+        {
+            "type": "message_start",
+            "message": {
+                "id": "msg_1",
+                "type": "message",
+                "role": "assistant",
+                "model": claude_model.model,
+                "content": [],
+                "stop_reason": None,
+                "usage": {"input_tokens": 10, "output_tokens": 1},
+            },
+        },
+        {
+            "type": "content_block_start",
+            "index": 0,
+            "content_block": {"type": "text", "text": ""},
+        },
+        *[
+            {
+                "type": "content_block_delta",
+                "index": 0,
+                "delta": {"type": "text_delta", "text": text},
+            }
+            for text in deltas
+        ],
+        {"type": "content_block_stop", "index": 0},
+        {
+            "type": "message_delta",
+            "delta": {"stop_reason": "end_turn"},
+            "usage": {"output_tokens": 9},
+        },
+        {"type": "message_stop"},
+    ]
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        return httpx.Response(
+            200, content=get_sse(events), headers={"content-type": "text/event-stream"}
+        )
+
+    client = anthropic.Anthropic(
+        api_key="123", http_client=httpx.Client(transport=httpx.MockTransport(handler))
+    )
+    monkeypatch.setattr(claude_model, "get_client", lambda client_secrets: client)
+    stream_events = []
+    stream_handler = StreamHandler(
+        on_event=stream_events.append, parser=JSONStreamParser(), stop_when_complete=True
+    )
+
+    response = claude_model.call(
+        [{"role": "user", "content": "Question"}],
+        100,
+        stream=True,
+        stream_handler=stream_handler,
+    )
+
+    assert response.content == '{"a": 1}'
+    assert response.finish_reason == FINISH_REASON_STRUCTURE_COMPLETE
+    assert stream_events[-1] == Usage(prompt_tokens=10, completion_tokens=None)
@@ -1,10 +1,14 @@
+import threading
+import time
 import pytest
 from decimal import Decimal
 from unittest.mock import patch, MagicMock
 
 from flow_prompt.ai_models.gemini.gemini_model import GeminiAIModel, FamilyModel
+from flow_prompt.cancellation import CancellationToken
 from flow_prompt.exceptions import RetryableCustomError, ConnectionLostError
 from flow_prompt.responses import AIResponse, Prompt
+from flow_prompt.streaming import StreamHandler
 from openai.types.chat import ChatCompletionMessage as Message
 
 
@@ -109,6 +113,7 @@ def test_gemini_ai_model_get_sample_price():
     assert price == expected_price
 
 
+@patch("flow_prompt.settings.STREAM_CHECK_CONNECTION_INTERVAL_SECONDS", 0)
 @patch("flow_prompt.ai_models.gemini.gemini_model.genai.GenerativeModel")
 def test_gemini_ai_model_call_with_connection_lost(mock_gen_model):
     mock_chunk = MagicMock()
@@ -138,6 +143,73 @@ def test_gemini_ai_model_call_with_connection_lost(mock_gen_model):
         )
 
 
+class BlockingStream:
+    """Response of generate_content which waits for the next chunk until the gRPC call is cancelled"""
+
+    def __init__(self):
+        self.cancelled = threading.Event()
+        self._iterator = MagicMock(cancel=self.cancelled.set)
+
+    def __iter__(self):
+        yield MagicMock(text="chunk text")
+        if not self.cancelled.wait(5):
+            yield MagicMock(text="late chunk")
+        raise Exception("Locally cancelled by application")
+
+
+@patch("flow_prompt.ai_models.gemini.gemini_model.genai.GenerativeModel")
+def test_gemini_ai_model_cancel_closes_blocked_stream(mock_gen_model):
+    response = BlockingStream()
+    mock_gen_model().generate_content.return_value = response
+    model = GeminiAIModel(model="gemini-1.5-pro")
+    token = CancellationToken()
+    threading.Timer(0.1, token.cancel).start()
+
+    start = time.monotonic()
+    with pytest.raises(RetryableCustomError):
+        model.call(
+            [{"content": "Hello", "role": "user"}],
+            100,
+            {"api_key": "test_api_key"},
+            stream=True,
+            cancellation_token=token,
+        )
+    assert response.cancelled.is_set()
+    assert time.monotonic() - start < 2
+
+
+@patch("flow_prompt.ai_models.gemini.gemini_model.genai.GenerativeModel")
+def test_gemini_ai_model_disconnect_closes_blocked_stream(mock_gen_model):
+    response = BlockingStream()
+    mock_gen_model().generate_content.return_value = response
+    model = GeminiAIModel(model="gemini-1.5-pro")
+    token = CancellationToken()
+    is_connected = threading.Event()
+    is_connected.set()
+    stream_handler = StreamHandler(
+        check_connection=is_connected.is_set,
+        check_connection_interval=0.01,
+        check_connection_in_background=True,
+        cancellation_token=token,
+    )
+    threading.Timer(0.1, is_connected.clear).start()
+
+    start = time.monotonic()
+    with pytest.raises(RetryableCustomError):
+        model.call(
+            [{"content": "Hello", "role": "user"}],
+            100,
+            {"api_key": "test_api_key"},
+            stream=True,
+            cancellation_token=token,
+            stream_handler=stream_handler,
+        )
+    assert response.cancelled.is_set()
+    assert time.monotonic() - start < 2
+    with pytest.raises(ConnectionLostError):
+        token.raise_if_cancelled()
+
+
 @patch("flow_prompt.ai_models.gemini.gemini_model.genai.GenerativeModel")
 def test_gemini_ai_model_call_with_retryable_error(mock_gen_model):
     mock_gen_model().generate_content.side_effect = Exception("Test Exception")
@@ -150,4 +222,67 @@ def test_gemini_ai_model_call_with_retryable_error(mock_gen_model):
     client_secrets = {"api_key": "test_api_key"}
 
     with pytest.raises(RetryableCustomError):
-        model.call(messages, max_tokens, client_secrets)
\ No newline at end of file
+        model.call(messages, max_tokens, client_secrets)
+
+@patch("flow_prompt.ai_models.gemini.gemini_model.genai.GenerativeModel")
+def test_gemini_ai_model_call_with_cached_context(mock_gen_model):
+    mock_response = MagicMock()
+    mock_response.text = "Test response"
+    mock_response.usage_metadata.cached_content_token_count = 40_000
+    cached_model = mock_gen_model.from_cached_content.return_value
+    cached_model.generate_content.return_value = mock_response
+    context_cache = MagicMock()
+
+    model = GeminiAIModel(
+        model="gemini-1.5-flash-001", context_caching=True, context_cache=context_cache
+    )
+    documents = "document " * 20_000
+    messages = [
+        {"content": documents, "role": "user"},
+        {"content": "Question", "role": "user"},
+    ]
+    response = model.call(
+        messages, 100, {"api_key": "test_api_key"}, static_prefix_count=1
+    )
+
+    context_cache.get.assert_called_once_with(
+        "models/gemini-1.5-flash-001", documents, "test_api_key"
+    )
+    mock_gen_model.from_cached_content.assert_called_once_with(
+        context_cache.get.return_value
+    )
+    assert cached_model.generate_content.call_args.args[0] == "Question"
+    assert response.metrics.cache_read_tokens == 40_000
+
+
+def test_gemini_ai_model_context_caching_is_off_by_default():
+    context_cache = MagicMock()
+    model = GeminiAIModel(model="gemini-1.5-flash-001", context_cache=context_cache)
+    messages = [
+        {"content": "document " * 20_000, "role": "user"},
+        {"content": "Question", "role": "user"},
+    ]
+    assert model.get_cached_content(messages, 1) is None
+    context_cache.get.assert_not_called()
+
+
+def test_gemini_ai_model_small_context_is_not_cached():
+    context_cache = MagicMock()
+    model = GeminiAIModel(
+        model="gemini-1.5-flash-001", context_caching=True, context_cache=context_cache
+    )
+    messages = [
+        {"content": "Short instructions", "role": "user"},
+        {"content": "Question", "role": "user"},
+    ]
+    assert model.get_cached_content(messages, 1) is None
+    context_cache.get.assert_not_called()
+
+
+def test_gemini_ai_model_get_prompt_price_with_cached_tokens():
+    model = GeminiAIModel(model="gemini-1.5-pro")
+
+    price = model.get_prompt_price(500, cache_read_tokens=400)
+
+    expected_price = Decimal(0.0007).quantize(Decimal("0.00001"))
+    assert price == expected_price
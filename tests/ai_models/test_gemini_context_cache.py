@@ -0,0 +1,69 @@
+from unittest.mock import patch
+
+from flow_prompt.ai_models.gemini import context_cache as context_cache_module
+
+from flow_prompt.ai_models.gemini.context_cache import GeminiContextCache
+
+
+@patch("flow_prompt.ai_models.gemini.context_cache.caching.CachedContent.create")
+def test_context_is_uploaded_once(mock_create):
+    context_cache = GeminiContextCache(ttl=3600, refresh_before=60)
+
+    first = context_cache.get("models/gemini-1.5-flash-001", "documents")
+    second = context_cache.get("models/gemini-1.5-flash-001", "documents")
+    context_cache.get("models/gemini-1.5-flash-001", "other documents")
+
+    assert first is second is mock_create.return_value
+    assert mock_create.call_count == 2
+    mock_create.return_value.update.assert_not_called()
+
+
+@patch("flow_prompt.ai_models.gemini.context_cache.caching.CachedContent.create")
+def test_context_is_refreshed_before_expiration(mock_create):
+    context_cache = GeminiContextCache(ttl=30, refresh_before=60)
+
+    context_cache.get("models/gemini-1.5-flash-001", "documents")
+    context_cache.get("models/gemini-1.5-flash-001", "documents")
+
+    mock_create.assert_called_once()
+    mock_create.return_value.update.assert_called_once()
+
+
+@patch("flow_prompt.ai_models.gemini.context_cache.caching.CachedContent.create")
+def test_context_is_cached_per_api_key(mock_create):
+    context_cache = GeminiContextCache()
+
+    context_cache.get("models/gemini-1.5-flash-001", "documents", "first key")
+    context_cache.get("models/gemini-1.5-flash-001", "documents", "second key")
+    context_cache.get("models/gemini-1.5-flash-001", "documents", "first key")
+
+    assert mock_create.call_count == 2
+
+
+@patch("flow_prompt.ai_models.gemini.context_cache.caching.CachedContent.create")
+def test_failed_context_is_retried_after_backoff(mock_create):
+    mock_create.side_effect = [ValueError("too small"), mock_create.return_value]
+    context_cache = GeminiContextCache(retry_after=60)
+
+    assert context_cache.get("models/gemini-1.5-flash-001", "documents") is None
+    assert context_cache.get("models/gemini-1.5-flash-001", "documents") is None
+    mock_create.assert_called_once()
+
+    context_cache.retry_after = 0
+    context_cache._failed_keys.clear()
+    context_cache._add_failed("other")
+    assert context_cache.get("models/gemini-1.5-flash-001", "documents") is not None
+    assert mock_create.call_count == 2
+
+
+@patch("flow_prompt.ai_models.gemini.context_cache.caching.CachedContent.create")
+def test_failed_keys_are_capped(mock_create, monkeypatch):
+    monkeypatch.setattr(context_cache_module, "MAX_FAILED_KEYS", 2)
+    mock_create.side_effect = ValueError("unavailable")
+    context_cache = GeminiContextCache()
+
+    for contents in ["first", "second", "third"]:
+        context_cache.get("models/gemini-1.5-flash-001", contents)
+
+    assert len(context_cache._failed_keys) == 2
+    assert not context_cache._key_locks
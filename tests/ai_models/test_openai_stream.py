@@ -0,0 +1,136 @@
+from unittest.mock import MagicMock
+
+from openai.types.chat import ChatCompletionChunk
+
+from flow_prompt.ai_models.constants import C_128K
+from flow_prompt.ai_models.openai.openai_models import OpenAIModel, OpenAIStreamResponse
+from flow_prompt.ai_models.openai.responses import FINISH_REASON_STRUCTURE_COMPLETE
+from flow_prompt.response_parsers.stream_parser import JSONStreamParser
+from flow_prompt.streaming import StreamHandler, TextDelta, ToolCallDelta, Usage
+
+
+def make_chunk(delta=None, finish_reason=None, usage=None):
+    return ChatCompletionChunk(
+        id="chunk",
+        object="chat.completion.chunk",
+        created=0,
+        model="gpt-4o",
+        choices=[{"index": 0, "delta": delta or {}, "finish_reason": finish_reason}]
+        if usage is None
+        else [],
+        usage=usage,
+    )
+
+
+def test_stream_collects_content_and_tool_calls():
+    events = []
+    chunks = [
+        make_chunk({"role": "assistant", "content": "Hel"}),
+        make_chunk({"content": "lo"}),
+        make_chunk(
+            {
+                "tool_calls": [
+                    {
+                        "index": 0,
+                        "id": "call_1",
+                        "type": "function",
+                        "function": {"name": "search", "arguments": '{"q": '},
+                    }
+                ]
+            }
+        ),
+        make_chunk({"tool_calls": [{"index": 0, "function": {"arguments": '"cats"}'}}]}),
+        make_chunk(finish_reason="tool_calls"),
+        make_chunk(usage={"prompt_tokens": 5, "completion_tokens": 7, "total_tokens": 12}),
+    ]
+    response = OpenAIStreamResponse(
+        stream_handler=StreamHandler(on_event=events.append), original_result=chunks
+    ).stream()
+
+    assert response.content == "Hello"
+    assert response.finish_reason == "tool_calls"
+    assert response.tool_calls[0].function.name == "search"
+    assert response.get_function_args(response.tool_calls[0]) == {"q": "cats"}
+    assert [e.text for e in events if isinstance(e, TextDelta)] == ["Hel", "lo"]
+    assert [e.arguments for e in events if isinstance(e, ToolCallDelta)] == ['{"q": ', '"cats"}']
+    assert events[-1] == Usage(prompt_tokens=5, completion_tokens=7)
+
+
+class FakeStream:
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.read = 0
+        self.closed = False
+
+    def __iter__(self):
+        for chunk in self.chunks:
+            if self.closed:
+                return
+            self.read += 1
+            yield chunk
+
+    def close(self):
+        self.closed = True
+
+
+def test_stream_is_closed_when_structure_is_complete():
+    stream = FakeStream(
+        [
+            make_chunk({"role": "assistant", "content": '```json\n{"a": '}),
+            make_chunk({"content": "1}"}),
+            make_chunk({"content": "\n```\nHope it helps!"}),
+            make_chunk(finish_reason="stop"),
+        ]
+    )
+    response = OpenAIStreamResponse(
+        stream_handler=StreamHandler(parser=JSONStreamParser(), stop_when_complete=True),
+        original_result=stream,
+    ).stream()
+
+    assert stream.closed
+    assert stream.read == 2
+    assert response.content == '```json\n{"a": 1}'
+    assert response.finish_reason == FINISH_REASON_STRUCTURE_COMPLETE
+
+
+def test_stream_is_not_closed_on_braces_in_prose():
+    stream = FakeStream(
+        [
+            make_chunk({"role": "assistant", "content": "Here is the answer for {user}:\n"}),
+            make_chunk({"content": '```json\n{"a": 1}'}),
+            make_chunk({"content": "\n```\nHope it helps!"}),
+            make_chunk(finish_reason="stop"),
+        ]
+    )
+    handler = StreamHandler(parser=JSONStreamParser(), stop_when_complete=True)
+    response = OpenAIStreamResponse(stream_handler=handler, original_result=stream).stream()
+
+    assert stream.read == 2
+    assert handler.parser.result == {"a": 1}
+    assert response.finish_reason == FINISH_REASON_STRUCTURE_COMPLETE
+
+
+def test_stream_requests_usage(monkeypatch):
+    model = OpenAIModel(model="gpt-4o", max_tokens=C_128K)
+    client = MagicMock()
+    client.chat.completions.create.return_value = [
+        make_chunk({"role": "assistant", "content": "Hello"}),
+        make_chunk(finish_reason="stop"),
+        make_chunk(usage={"prompt_tokens": 5, "completion_tokens": 1, "total_tokens": 6}),
+    ]
+    monkeypatch.setattr(model, "get_client", lambda client_secrets: client)
+
+    events = []
+
+    response = model.call_chat_completion(
+        [{"role": "user", "content": "Hi"}],
+        100,
+        stream=True,
+        stream_handler=StreamHandler(on_event=events.append),
+    )
+
+    kwargs = client.chat.completions.create.call_args.kwargs
+    assert kwargs["stream_options"] == {"include_usage": True}
+    assert response.content == "Hello"
+    assert response.finish_reason == "stop"
+    assert events[-1] == Usage(prompt_tokens=5, completion_tokens=1)
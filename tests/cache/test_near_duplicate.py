@@ -0,0 +1,58 @@
+from openai.types.chat import ChatCompletionMessage as Message
+
+from flow_prompt.ai_models.openai.responses import OpenAIResponse
+from flow_prompt.cache.near_duplicate import NearDuplicateCache
+
+TEXT = (
+    "Summarize the support ticket for the on-call engineer. Ticket {id} was opened at "
+    "{time} by a customer who cannot log in to the dashboard after resetting the "
+    "password, the reset email arrives but the link says that the token is expired. "
+    "The customer already tried another browser and cleared the cookies."
+)
+
+
+def make_messages(ticket_id="1234", time="10:00", text=TEXT):
+    return [{"role": "user", "content": text.format(id=ticket_id, time=time)}]
+
+
+def make_response(content="Summary"):
+    return OpenAIResponse(
+        message=Message(content=content, role="assistant"), content=content
+    )
+
+
+def test_similar_prompt_is_found():
+    cache = NearDuplicateCache(["ticket"], threshold=0.7)
+    cache.set("scope", make_messages(), make_response())
+
+    response = cache.get("scope", make_messages("98765", "11:42"))
+    assert response.content == "Summary"
+
+
+def test_whitespace_differences_are_ignored():
+    cache = NearDuplicateCache(["ticket"], threshold=0.99)
+    cache.set("scope", make_messages(), make_response())
+    assert cache.get("scope", make_messages(text=TEXT.replace(" ", "  \n"))) is not None
+
+
+def test_different_prompt_or_scope_is_not_found():
+    cache = NearDuplicateCache(["ticket"], threshold=0.7)
+    cache.set("scope", make_messages(), make_response())
+
+    other = "Translate the following release notes into German and keep the markdown."
+    assert cache.get("scope", make_messages(text=other)) is None
+    assert cache.get("other-scope", make_messages()) is None
+
+
+def test_least_recently_used_entries_are_evicted():
+    cache = NearDuplicateCache(["ticket"], threshold=0.99, max_size=2)
+    texts = [f"{TEXT} Note number {i} is {'x ' * i}" for i in range(3)]
+    for i, text in enumerate(texts):
+        cache.set("scope", make_messages(text=text), make_response(str(i)))
+
+    assert cache.get("scope", make_messages(text=texts[0])) is None
+    assert cache.get("scope", make_messages(text=texts[2])).content == "2"
+    assert len(cache._entries) == 2
+    assert all(
+        entry_id in cache._entries for bucket in cache._buckets.values() for entry_id in bucket
+    )
@@ -0,0 +1,75 @@
+from time import sleep
+
+from openai.types.chat import ChatCompletionMessage as Message
+
+from flow_prompt.ai_models.claude.responses import ClaudeAIReponse
+from flow_prompt.ai_models.openai.responses import FINISH_REASON_ERROR, OpenAIResponse
+from flow_prompt.cache.response_cache import MemoryResponseCache, SQLiteResponseCache
+from flow_prompt.responses import Prompt
+
+
+def make_response(content="Hello", cls=OpenAIResponse, **kwargs):
+    return cls(
+        message=Message(content=content, role="assistant"),
+        content=content,
+        finish_reason="stop",
+        prompt=Prompt(messages=[{"role": "user", "content": "Hi"}], max_tokens=10),
+        **kwargs,
+    )
+
+
+def test_memory_cache_returns_copy():
+    cache = MemoryResponseCache()
+    response = make_response()
+    cache.set("key", response)
+    response.content = "changed"
+
+    cached = cache.get("key")
+    assert cached.content == "Hello"
+    cached.content = "changed"
+    assert cache.get("key").content == "Hello"
+
+
+def test_memory_cache_evicts_least_recently_used():
+    cache = MemoryResponseCache(max_size=2)
+    cache.set("a", make_response("a"))
+    cache.set("b", make_response("b"))
+    cache.get("a")
+    cache.set("c", make_response("c"))
+
+    assert cache.get("b") is None
+    assert cache.get("a").content == "a"
+    assert cache.get("c").content == "c"
+
+
+def test_memory_cache_expires_records():
+    cache = MemoryResponseCache(ttl=0.01)
+    cache.set("key", make_response())
+    sleep(0.02)
+    assert cache.get("key") is None
+
+
+def test_failed_responses_are_not_cached():
+    cache = MemoryResponseCache()
+    cache.set("key", OpenAIResponse(finish_reason=FINISH_REASON_ERROR))
+    assert cache.get("key") is None
+
+
+def test_sqlite_cache_persists_responses(tmp_path):
+    path = str(tmp_path / "cache.sqlite3")
+    cache = SQLiteResponseCache(path)
+    cache.set("key", make_response(cls=ClaudeAIReponse))
+    cache.close()
+
+    cached = SQLiteResponseCache(path).get("key")
+    assert isinstance(cached, ClaudeAIReponse)
+    assert cached.content == "Hello"
+    assert cached.message.content == "Hello"
+    assert cached.prompt.messages == [{"role": "user", "content": "Hi"}]
+
+
+def test_sqlite_cache_expires_records(tmp_path):
+    cache = SQLiteResponseCache(str(tmp_path / "cache.sqlite3"), ttl=0.01)
+    cache.set("key", make_response())
+    sleep(0.02)
+    assert cache.get("key") is None
@@ -0,0 +1,87 @@
+import threading
+from time import sleep
+
+from flow_prompt.cache.single_flight import REUSED_FROM_SINGLE_FLIGHT, SingleFlight
+from flow_prompt.exceptions import DeadlineExceededError
+from flow_prompt.responses import AIResponse
+
+
+def run_concurrently(count, function):
+    results = [None] * count
+
+    def run(i):
+        try:
+            results[i] = function()
+        except Exception as e:
+            results[i] = e
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def test_concurrent_calls_are_coalesced():
+    single_flight = SingleFlight()
+    calls = []
+
+    def call():
+        calls.append(1)
+        sleep(0.2)
+        return AIResponse(content="Hello")
+
+    results = run_concurrently(5, lambda: single_flight.do("key", call))
+
+    assert len(calls) == 1
+    assert [r.content for r in results] == ["Hello"] * 5
+    assert len({id(r) for r in results}) == 5
+    reused = [r for r in results if r.metrics.reused_from == REUSED_FROM_SINGLE_FLIGHT]
+    assert len(reused) == 4
+    assert not single_flight._calls
+
+
+def test_error_is_raised_for_all_waiters():
+    single_flight = SingleFlight()
+
+    def call():
+        sleep(0.2)
+        raise ValueError("failed")
+
+    results = run_concurrently(3, lambda: single_flight.do("key", call))
+    assert all(isinstance(r, ValueError) for r in results)
+
+
+def test_sequential_calls_are_not_coalesced():
+    single_flight = SingleFlight()
+    calls = []
+
+    def call():
+        calls.append(1)
+        return AIResponse(content="Hello")
+
+    single_flight.do("key", call)
+    single_flight.do("key", call)
+    assert len(calls) == 2
+
+
+def test_waiters_call_again_if_leader_is_cancelled():
+    single_flight = SingleFlight()
+    calls = []
+    lock = threading.Lock()
+
+    def call():
+        with lock:
+            calls.append(1)
+            is_first = len(calls) == 1
+        sleep(0.2)
+        if is_first:
+            raise DeadlineExceededError("leader's deadline")
+        return AIResponse(content="Hello")
+
+    results = run_concurrently(3, lambda: single_flight.do("key", call))
+
+    assert len(calls) == 2
+    assert sum(isinstance(r, DeadlineExceededError) for r in results) == 1
+    assert [r.content for r in results if isinstance(r, AIResponse)] == ["Hello"] * 2
@@ -0,0 +1,148 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest.mock import MagicMock
+
+import pytest
+
+from flow_prompt import settings
+from flow_prompt.ai_models.attempt_to_call import AttemptToCall
+from flow_prompt.ai_models.behaviour import AIModelsBehaviour
+from flow_prompt.ai_models.openai.openai_models import C_128K, OpenAIModel
+from flow_prompt.ai_models.openai.responses import FINISH_REASON_ERROR
+from flow_prompt.prompt.pipe_prompt import PipePrompt
+from flow_prompt.services.sampling import SamplingPolicy
+
+
+class FakeBatchHandler(BaseHTTPRequestHandler):
+    """Minimal OpenAI files and batches endpoints"""
+
+    files = {}
+    batches = {}
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, data, content_type="application/json"):
+        body = data if isinstance(data, bytes) else json.dumps(data).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        if self.path == "/v1/files":
+            file_id = f"file-{len(self.files)}"
+            self.files[file_id] = [
+                json.loads(line)
+                for line in body.decode().splitlines()
+                if line.startswith('{"custom_id"')
+            ]
+            self._send({"id": file_id, "object": "file", "purpose": "batch"})
+        elif self.path == "/v1/batches":
+            data = json.loads(body)
+            batch_id = f"batch-{len(self.batches)}"
+            self.batches[batch_id] = {"input": data["input_file_id"], "polls": 0}
+            self._send(self._batch(batch_id))
+
+    def do_GET(self):
+        if self.path.startswith("/v1/batches/"):
+            batch_id = self.path.split("/")[-1]
+            self.batches[batch_id]["polls"] += 1
+            self._send(self._batch(batch_id))
+        elif self.path.endswith("/content"):
+            file_id = self.path.split("/")[-2]
+            self._send("\n".join(self._results(file_id)).encode(), "application/jsonl")
+
+    def _batch(self, batch_id):
+        batch = self.batches[batch_id]
+        is_completed = batch["polls"] > 1
+        return {
+            "id": batch_id,
+            "object": "batch",
+            "status": "completed" if is_completed else "in_progress",
+            "output_file_id": f"output-{batch['input']}" if is_completed else None,
+        }
+
+    def _results(self, file_id):
+        for request in self.files[file_id.replace("output-", "")]:
+            content = request["body"]["messages"][-1]["content"]
+            if "fail" in content:
+                response = {"status_code": 400, "body": {"error": "bad request"}}
+            else:
+                response = {
+                    "status_code": 200,
+                    "body": {
+                        "choices": [
+                            {
+                                "index": 0,
+                                "finish_reason": "stop",
+                                "message": {"role": "assistant", "content": content.upper()},
+                            }
+                        ]
+                    },
+                }
+            yield json.dumps({"custom_id": request["custom_id"], "response": response})
+
+
+@pytest.fixture
+def batch_server(monkeypatch):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeBatchHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setenv("OPENAI_BASE_URL", f"http://127.0.0.1:{server.server_port}/v1")
+    monkeypatch.setattr(settings, "USE_API_SERVICE", False)
+    yield server
+    server.shutdown()
+
+
+def test_submit_batch(flow_prompt, batch_server):
+    prompt = PipePrompt(id="batch-prompt")
+    prompt.add("Say {name}")
+    behaviour = AIModelsBehaviour(
+        attempts=[
+            AttemptToCall(
+                ai_model=OpenAIModel(model="gpt-4o-mini", max_tokens=C_128K),
+                weight=100,
+            )
+        ]
+    )
+
+    responses = flow_prompt.submit_batch(
+        prompt.id,
+        [{"name": "hello"}, {"name": "fail"}, {"name": "world"}],
+        behaviour,
+        poll_interval=0,
+    )
+
+    assert [r.content for r in responses] == ["SAY HELLO", "", "SAY WORLD"]
+    assert responses[1].finish_reason == FINISH_REASON_ERROR
+    assert responses[0].metrics.prompt_tokens_used > 0
+    assert responses[0].metrics.price_of_call is not None
+    assert responses[0].metrics.ai_model_details["model"] == "gpt-4o-mini"
+
+
+def test_batch_errors_are_logged_when_sampled_out(flow_prompt, batch_server, monkeypatch):
+    monkeypatch.setattr(settings, "USE_API_SERVICE", True)
+    flow_prompt.api_token = "token"
+    flow_prompt.worker = MagicMock()
+    flow_prompt.sampling_policy = SamplingPolicy(rate=0)
+    prompt = PipePrompt(id="batch-prompt")
+    prompt.add("Say {name}")
+    behaviour = AIModelsBehaviour(
+        attempts=[
+            AttemptToCall(
+                ai_model=OpenAIModel(model="gpt-4o-mini", max_tokens=C_128K),
+                weight=100,
+            )
+        ]
+    )
+
+    flow_prompt.submit_batch(
+        prompt.id, [{"name": "hello"}, {"name": "fail"}], behaviour, poll_interval=0
+    )
+
+    logged = flow_prompt.worker.add_task.call_args_list
+    assert [call.args[2] for call in logged] == [{"name": "fail"}]
+    assert logged[0].args[3].finish_reason == FINISH_REASON_ERROR
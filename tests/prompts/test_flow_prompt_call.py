@@ -0,0 +1,444 @@
+import asyncio
+import threading
+from dataclasses import dataclass
+from time import sleep
+from unittest.mock import MagicMock
+
+import pytest
+from openai.types.chat import ChatCompletionMessage as Message
+
+from flow_prompt import settings
+from flow_prompt.ai_models.ai_model import AI_MODELS_PROVIDER, AIModel
+from flow_prompt.ai_models.attempt_to_call import AttemptToCall
+from flow_prompt.ai_models.behaviour import AIModelsBehaviour
+from flow_prompt.ai_models.openai.responses import (
+    FINISH_REASON_ERROR,
+    FINISH_REASON_STRUCTURE_COMPLETE,
+    OpenAIResponse,
+)
+from flow_prompt.cache.near_duplicate import (
+    REUSED_FROM_NEAR_DUPLICATE,
+    NearDuplicateCache,
+)
+from flow_prompt.cache.response_cache import REUSED_FROM_CACHE, MemoryResponseCache
+from flow_prompt.cache.single_flight import SingleFlight
+from flow_prompt.cancellation import CancellationToken
+from flow_prompt.exceptions import (
+    BehaviourIsNotDefined,
+    CallCancelledError,
+    DeadlineExceededError,
+    RetryableCustomError,
+)
+from flow_prompt.prompt.flow_prompt import FlowPrompt
+from flow_prompt.prompt.pipe_prompt import PipePrompt
+from flow_prompt.responses import LeanAIResponse
+from flow_prompt.response_parsers.stream_parser import (
+    JSONStreamParser,
+    ParsedValue,
+    YAMLStreamParser,
+)
+from flow_prompt.services.sampling import SamplingPolicy
+from flow_prompt.streaming import FinalResponse, FlushPolicy, TextDelta, Usage
+
+
+@dataclass(kw_only=True)
+class FakeAIModel(AIModel):
+    max_tokens: int = 4096
+    provider: AI_MODELS_PROVIDER = AI_MODELS_PROVIDER.OPENAI
+    answer: str = "Hello"
+    delay: float = 0
+    fail: bool = False
+    calls: int = 0
+    chunk_delay: float = 0
+    streamed_chunks: int = 0
+
+    @property
+    def name(self) -> str:
+        return "fake"
+
+    def get_prompt_price(self, count_tokens: int, **kwargs):
+        return 0
+
+    def get_sample_price(self, prompt_sample, count_tokens: int):
+        return 0
+
+    def call(
+        self, messages, max_tokens, cancellation_token=None, stream_handler=None, **kwargs
+    ):
+        self.calls += 1
+        closed = threading.Event()
+        if cancellation_token:
+            cancellation_token.register(closed.set)
+        if self.delay:
+            closed.wait(self.delay)
+        if closed.is_set():
+            raise RetryableCustomError("connection was closed")
+        if self.fail:
+            raise RetryableCustomError("fake error")
+        if kwargs.get("stream"):
+            for word in self.answer.split(" "):
+                sleep(self.chunk_delay)
+                stream_handler.on_text(word + " ")
+                self.streamed_chunks += 1
+                if stream_handler.is_stopped:
+                    break
+            stream_handler.on_usage(prompt_tokens=1, completion_tokens=1)
+        if stream_handler is not None and stream_handler.is_stopped:
+            return OpenAIResponse(
+                message=Message(content=stream_handler.content, role="assistant"),
+                content=stream_handler.content,
+                finish_reason=FINISH_REASON_STRUCTURE_COMPLETE,
+            )
+        return OpenAIResponse(
+            message=Message(content=self.answer, role="assistant"),
+            content=self.answer,
+        )
+
+
+@pytest.fixture(autouse=True)
+def without_api_service(monkeypatch):
+    monkeypatch.setattr(settings, "USE_API_SERVICE", False)
+
+
+@pytest.fixture
+def prompt():
+    prompt = PipePrompt(id="fake-prompt")
+    prompt.add("Hello {name}")
+    return prompt
+
+
+def fake_behaviour(ai_model: AIModel) -> AIModelsBehaviour:
+    return AIModelsBehaviour(attempts=[AttemptToCall(ai_model=ai_model, weight=100)])
+
+
+def test_call_returns_response(flow_prompt, prompt):
+    response = flow_prompt.call(prompt.id, {"name": "World"}, fake_behaviour(FakeAIModel()))
+    assert response.content == "Hello"
+
+
+def test_call_stops_retries_when_deadline_passes(flow_prompt, prompt):
+    ai_model = FakeAIModel(delay=0.05, fail=True)
+    with pytest.raises(DeadlineExceededError):
+        flow_prompt.call(
+            prompt.id,
+            {"name": "World"},
+            fake_behaviour(ai_model),
+            count_of_retries=100,
+            timeout=0.12,
+        )
+    assert ai_model.calls < 5
+
+
+def test_call_cancelled_from_another_thread(flow_prompt, prompt):
+    ai_model = FakeAIModel(delay=5)
+    token = CancellationToken()
+    threading.Timer(0.05, token.cancel).start()
+    with pytest.raises(CallCancelledError):
+        flow_prompt.call(
+            prompt.id,
+            {"name": "World"},
+            fake_behaviour(ai_model),
+            cancellation_token=token,
+        )
+    assert ai_model.calls == 1
+
+
+def test_identical_concurrent_calls_are_coalesced(flow_prompt, prompt):
+    flow_prompt.single_flight = SingleFlight()
+    ai_model = FakeAIModel(delay=0.2)
+    behaviour = fake_behaviour(ai_model)
+    results = []
+
+    def call():
+        results.append(flow_prompt.call(prompt.id, {"name": "World"}, behaviour))
+
+    threads = [threading.Thread(target=call) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert ai_model.calls == 1
+    assert [r.content for r in results] == ["Hello"] * 3
+    assert sum(r.metrics.reused_from is not None for r in results) == 2
+
+
+def test_deterministic_call_is_taken_from_cache(flow_prompt, prompt):
+    flow_prompt.response_cache = MemoryResponseCache()
+    ai_model = FakeAIModel()
+    behaviour = fake_behaviour(ai_model)
+
+    first = flow_prompt.call(prompt.id, {"name": "World"}, behaviour)
+    second = flow_prompt.call(prompt.id, {"name": "World"}, behaviour)
+    other = flow_prompt.call(prompt.id, {"name": "Moon"}, behaviour)
+
+    assert ai_model.calls == 2
+    assert second.content == first.content
+    assert first.metrics.reused_from is None
+    assert second.metrics.reused_from == REUSED_FROM_CACHE
+    assert second.metrics.price_of_call == 0
+    assert other.metrics.reused_from is None
+
+
+def test_near_duplicate_cache_is_used_for_allowed_prompts(flow_prompt):
+    prompt = PipePrompt(id="near-duplicate-prompt")
+    prompt.add(
+        "Classify the sentiment of the review received at {time} as positive, negative "
+        "or neutral. The review says that the delivery was fast, the package was "
+        "intact and the headphones sound great but the case feels a bit cheap."
+    )
+    flow_prompt.near_duplicate_cache = NearDuplicateCache([prompt.id], threshold=0.7)
+    ai_model = FakeAIModel()
+    behaviour = fake_behaviour(ai_model)
+
+    first = flow_prompt.call(prompt.id, {"time": "10:00:01"}, behaviour)
+    second = flow_prompt.call(prompt.id, {"time": "17:45:13"}, behaviour)
+
+    assert ai_model.calls == 1
+    assert first.metrics.reused_from is None
+    assert second.metrics.reused_from == REUSED_FROM_NEAR_DUPLICATE
+
+    flow_prompt.near_duplicate_cache = NearDuplicateCache(["other"], threshold=0.7)
+    flow_prompt.call(prompt.id, {"time": "10:00:01"}, behaviour)
+    flow_prompt.call(prompt.id, {"time": "17:45:13"}, behaviour)
+    assert ai_model.calls == 3
+
+
+def test_near_duplicate_is_stored_with_messages_before_the_call(flow_prompt):
+    prompt = PipePrompt(id="near-duplicate-mutating-prompt")
+    prompt.add(
+        "Classify the sentiment of the review received at {time} as positive, negative "
+        "or neutral. The review says that the delivery was fast, the package was "
+        "intact and the headphones sound great but the case feels a bit cheap."
+    )
+    flow_prompt.near_duplicate_cache = NearDuplicateCache([prompt.id], threshold=0.7)
+    ai_model = FakeAIModel()
+    call = ai_model.call
+
+    def call_changing_messages(messages, *args, **kwargs):
+        # like merging messages of the same role by Claude
+        messages[0]["content"] = "completely different text " * 10
+        return call(messages, *args, **kwargs)
+
+    ai_model.call = call_changing_messages
+    behaviour = fake_behaviour(ai_model)
+    flow_prompt.call(prompt.id, {"time": "10:00:01"}, behaviour)
+    second = flow_prompt.call(prompt.id, {"time": "17:45:13"}, behaviour)
+
+    assert ai_model.calls == 1
+    assert second.metrics.reused_from == REUSED_FROM_NEAR_DUPLICATE
+
+
+def test_stream_yields_typed_events(flow_prompt, prompt):
+    ai_model = FakeAIModel(answer="Hello dear World")
+    events = list(flow_prompt.stream(prompt.id, {"name": "World"}, fake_behaviour(ai_model)))
+
+    texts = [e.text for e in events if isinstance(e, TextDelta)]
+    assert texts == ["Hello ", "dear ", "World "]
+    assert isinstance(events[-2], Usage)
+    assert isinstance(events[-1], FinalResponse)
+    assert events[-1].response.content == "Hello dear World"
+    assert events[-1].response.metrics.latency is not None
+
+
+def test_closed_stream_cancels_the_call(flow_prompt, prompt):
+    ai_model = FakeAIModel(answer="word " * 100, chunk_delay=0.01)
+    events = flow_prompt.stream(
+        prompt.id, {"name": "World"}, fake_behaviour(ai_model), max_buffered_events=1
+    )
+    assert isinstance(next(events), TextDelta)
+    events.close()
+    sleep(0.1)
+    assert ai_model.calls == 1
+    assert ai_model.streamed_chunks < 20
+
+
+def test_astream_yields_typed_events(flow_prompt, prompt):
+    ai_model = FakeAIModel(answer="Hello dear World")
+
+    async def collect():
+        return [
+            event
+            async for event in flow_prompt.astream(
+                prompt.id, {"name": "World"}, fake_behaviour(ai_model)
+            )
+        ]
+
+    events = asyncio.run(collect())
+    assert "".join(e.text for e in events if isinstance(e, TextDelta)) == "Hello dear World "
+    assert events[-1].response.content == "Hello dear World"
+
+
+def test_concurrent_astreams_dont_hold_the_default_executor(flow_prompt, prompt):
+    ai_model = FakeAIModel(answer="Hello dear World", delay=1)
+
+    async def collect():
+        return [
+            event
+            async for event in flow_prompt.astream(
+                prompt.id, {"name": "World"}, fake_behaviour(ai_model)
+            )
+        ]
+
+    async def run_all():
+        streams = asyncio.gather(*[collect() for _ in range(64)])
+        await asyncio.sleep(0.05)
+        loop = asyncio.get_running_loop()
+        # the default executor is free while all streams are running
+        await asyncio.wait_for(loop.run_in_executor(None, lambda: None), timeout=0.5)
+        assert not streams.done()
+        return await streams
+
+    results = asyncio.run(run_all())
+    assert len(results) == 64
+    for events in results:
+        assert events[-1].response.content == "Hello dear World"
+
+
+def test_stream_with_flush_policy(flow_prompt, prompt):
+    ai_model = FakeAIModel(answer="Hello dear World. Bye")
+    events = flow_prompt.stream(
+        prompt.id,
+        {"name": "World"},
+        fake_behaviour(ai_model),
+        flush_policy=FlushPolicy(max_bytes=1000, max_interval=0, flush_on_sentence_end=True),
+    )
+    texts = [e.text for e in events if isinstance(e, TextDelta)]
+    assert texts == ["Hello dear World. ", "Bye "]
+
+
+def test_stream_emits_parsed_values(flow_prompt, prompt):
+    ai_model = FakeAIModel(answer='{"first": 1, "second": [1, 2]}')
+    events = list(
+        flow_prompt.stream(
+            prompt.id,
+            {"name": "World"},
+            fake_behaviour(ai_model),
+            parser_class=JSONStreamParser,
+        )
+    )
+    parsed = [e for e in events if isinstance(e, ParsedValue)]
+    assert parsed == [ParsedValue("first", 1), ParsedValue("second", [1, 2])]
+    assert events.index(parsed[0]) < events.index(parsed[1])
+
+
+def test_stream_emits_last_yaml_entry_at_the_end(flow_prompt, prompt):
+    ai_model = FakeAIModel(answer="```yaml\nname: John\nage: 30")
+    events = list(
+        flow_prompt.stream(
+            prompt.id,
+            {"name": "World"},
+            fake_behaviour(ai_model),
+            parser_class=YAMLStreamParser,
+        )
+    )
+    parsed = [e for e in events if isinstance(e, ParsedValue)]
+    assert parsed == [ParsedValue("name", "John"), ParsedValue("age", 30)]
+    assert isinstance(events[-1], FinalResponse)
+
+
+def test_call_stops_when_structure_is_complete(flow_prompt, prompt):
+    ai_model = FakeAIModel(answer='{"first": 1} Let me know if you need anything else')
+    response = flow_prompt.call(
+        prompt.id,
+        {"name": "World"},
+        fake_behaviour(ai_model),
+        parser_class=JSONStreamParser,
+        stop_when_complete=True,
+    )
+    assert response.finish_reason == FINISH_REASON_STRUCTURE_COMPLETE
+    assert response.content == '{"first": 1} '
+    assert ai_model.streamed_chunks == 2
+
+
+def test_stop_when_complete_waits_for_root_type_of_schema(flow_prompt):
+    prompt = PipePrompt(id="fake-prompt-with-schema", output_schema={"type": "object"})
+    prompt.add("Hello {name}")
+    ai_model = FakeAIModel(answer='See [1] {"first": 1} Let me know')
+    response = flow_prompt.call(
+        prompt.id,
+        {"name": "World"},
+        fake_behaviour(ai_model),
+        parser_class=JSONStreamParser,
+        stop_when_complete=True,
+    )
+    assert response.finish_reason == FINISH_REASON_STRUCTURE_COMPLETE
+    assert response.content == 'See [1] {"first": 1} '
+    assert response.parsed_content == {"first": 1}
+
+
+def test_stop_when_complete_requires_parser(flow_prompt, prompt):
+    with pytest.raises(ValueError):
+        flow_prompt.call(
+            prompt.id, {"name": "World"}, fake_behaviour(FakeAIModel()), stop_when_complete=True
+        )
+
+
+def test_streamed_call_has_stream_metrics(flow_prompt, prompt):
+    ai_model = FakeAIModel(answer="one two three", chunk_delay=0.01)
+    response = flow_prompt.call(
+        prompt.id, {"name": "World"}, fake_behaviour(ai_model), params={"stream": True}
+    )
+    assert response.metrics.time_to_first_token > 0
+    assert response.metrics.inter_chunk_gap_p50 > 0
+    assert response.metrics.tokens_per_second > 0
+
+    response = flow_prompt.call(prompt.id, {"name": "World"}, fake_behaviour(ai_model))
+    assert response.metrics.time_to_first_token is None
+
+
+OUTPUT_SCHEMA = {
+    "type": "object",
+    "properties": {"name": {"type": "string"}},
+    "required": ["name"],
+}
+
+
+def test_invalid_output_is_retried_with_next_attempt(flow_prompt):
+    prompt = PipePrompt(id="fake-prompt-with-schema", output_schema=OUTPUT_SCHEMA)
+    prompt.add("Hello {name}")
+    invalid_model = FakeAIModel(answer='{"title": "World"}')
+    valid_model = FakeAIModel(answer='```json\n{"name": "World"}\n```')
+    behaviour = AIModelsBehaviour(
+        attempts=[AttemptToCall(ai_model=invalid_model, weight=100)],
+        fallback_attempt=AttemptToCall(ai_model=valid_model, weight=100),
+    )
+    flow_prompt.response_cache = MemoryResponseCache()
+
+    response = flow_prompt.call(prompt.id, {"name": "World"}, behaviour)
+
+    assert invalid_model.calls > 0
+    assert valid_model.calls == 1
+    assert response.parsed_content == {"name": "World"}
+    # invalid responses are not cached
+    assert len(flow_prompt.response_cache._records) == 1
+
+
+def test_call_returns_lean_response(flow_prompt, prompt):
+    flow_prompt.lean_responses = True
+    response = flow_prompt.call(prompt.id, {"name": "World"}, fake_behaviour(FakeAIModel()))
+    assert isinstance(response, LeanAIResponse)
+    assert response.content == "Hello"
+    assert response.metrics.latency is not None
+
+
+def test_failed_attempts_are_logged_when_sampled_out(monkeypatch, prompt):
+    monkeypatch.setattr(settings, "USE_API_SERVICE", True)
+    worker = MagicMock()
+    flow_prompt = FlowPrompt(
+        api_token="token", worker=worker, sampling_policy=SamplingPolicy(rate=0)
+    )
+    flow_prompt.clients[AI_MODELS_PROVIDER.OPENAI] = {}
+    behaviour = fake_behaviour(FakeAIModel(fail=True))
+
+    with pytest.raises(BehaviourIsNotDefined):
+        flow_prompt.call(prompt.id, {"name": "World"}, behaviour, count_of_retries=1)
+
+    responses = [call.args[3] for call in worker.add_task.call_args_list]
+    assert responses
+    assert all(r.finish_reason == FINISH_REASON_ERROR for r in responses)
+    assert responses[0].metrics.ai_model_details is not None
+
+    worker.reset_mock()
+    flow_prompt.call(prompt.id, {"name": "World"}, fake_behaviour(FakeAIModel()))
+    worker.add_task.assert_not_called()
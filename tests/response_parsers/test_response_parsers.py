@@ -1,7 +1,7 @@
 import pytest
 from flow_prompt.responses import AIResponse
 from flow_prompt.exceptions import NotParsedResponseException
-from flow_prompt.response_parsers.response_parser import get_yaml_from_response, get_json_from_response, _get_format_from_response, Tag
+from flow_prompt.response_parsers.response_parser import get_yaml_from_response, get_json_from_response, iter_blocks, iter_json_from_response, iter_tagged_content, BRACES_BLOCK, FENCED_BLOCK
 
 
 def test_get_yaml_from_response_valid_yaml():
@@ -35,16 +35,80 @@ def test_get_json_from_response_invalid_json():
     with pytest.raises(NotParsedResponseException):
         get_json_from_response(response)
 
-def test__get_format_from_response():
-    response = AIResponse(_response="```json\n{\"key\": \"value\"}\n```")
-    tags = [Tag("```json", "```", 0)]
-    content, start_ind, end_ind = _get_format_from_response(response, tags)
-    
-    assert content == '{"key": "value"}'
+def test_iter_blocks_fenced_json():
+    text = "```json\n{\"key\": \"value\"}\n```"
+    block = next(iter_blocks(text))
+
+    assert (block.kind, block.language) == (FENCED_BLOCK, "json")
+    assert text[block.start_ind : block.end_ind].strip() == '{"key": "value"}'
+
+def test_iter_blocks_no_blocks():
+    assert list(iter_blocks("No tags here")) == []
+
+
+def test_get_json_from_response_balanced_braces():
+    text = 'Sure! {"a": {"b": "} not the end {"}, "c": "say \\"}\\""} and {"d": 1}'
+    tagged_content = get_json_from_response(AIResponse(_response=text))
+
+    assert tagged_content.parsed_content == {"a": {"b": "} not the end {"}, "c": 'say "}"'}
+    assert text[tagged_content.start_ind : tagged_content.end_ind] == tagged_content.content
+    assert get_json_from_response(AIResponse(_response=text), start_from=tagged_content.end_ind).parsed_content == {"d": 1}
+
+def test_get_json_from_response_prefers_json_fence():
+    text = 'Example: {"a": 1}\n```json\n{"b": 2}\n```'
+    assert get_json_from_response(AIResponse(_response=text)).parsed_content == {"b": 2}
+
+def test_get_json_from_response_python_literals_without_eval():
+    response = AIResponse(_response="{'key': True, 'none': None}")
+    assert get_json_from_response(response).parsed_content == {"key": True, "none": None}
+
+    response = AIResponse(_response="{'key': __import__('os').getcwd()}")
+    with pytest.raises(NotParsedResponseException):
+        get_json_from_response(response)
+
+def test_get_yaml_from_response_skips_fence_language():
+    response = AIResponse(_response="Here:\n```yml\nkey: value\n```\n```yaml\nother: 1\n```")
+    assert get_yaml_from_response(response).parsed_content == {"key": "value"}
+
+    response = AIResponse(_response="```\nkey: value\n")
+    assert get_yaml_from_response(response).parsed_content == {"key": "value"}
+
+def test_iter_blocks():
+    text = 'a {"x": 1} ```json\n{"y": 2}\n``` b'
+    blocks = list(iter_blocks(text))
+
+    assert [(block.kind, block.language) for block in blocks] == [
+        (BRACES_BLOCK, ""), (FENCED_BLOCK, "json"), (BRACES_BLOCK, "")
+    ]
+    assert [text[block.start_ind : block.end_ind] for block in blocks] == [
+        '{"x": 1}', '\n{"y": 2}\n', '{"y": 2}'
+    ]
+
+def test_iter_json_from_response():
+    text = 'First {"a": 1}, not json {name}.\n```json\n{"b": {"c": 2}}\n```\nLast {"d": [3]}'
+    tagged_contents = list(iter_json_from_response(AIResponse(_response=text)))
+
+    assert [tagged.parsed_content for tagged in tagged_contents] == [
+        {"a": 1}, {"b": {"c": 2}}, {"d": [3]}
+    ]
+    for tagged in tagged_contents:
+        assert text[tagged.start_ind : tagged.end_ind].strip() == tagged.content
+
+    start_from = tagged_contents[0].end_ind
+    assert len(list(iter_json_from_response(AIResponse(_response=text), start_from))) == 2
+
+def test_iter_json_from_response_invalid_json_fence():
+    response = AIResponse(_response='{"a": 1}\n```json\n{key: value}\n```')
+    tagged_contents = iter_json_from_response(response)
+    assert next(tagged_contents).parsed_content == {"a": 1}
+    with pytest.raises(NotParsedResponseException):
+        next(tagged_contents)
 
-def test__get_format_from_response_no_tags():
-    response = AIResponse(_response="No tags here")
-    tags = [Tag("```json", "```", 0)]
-    content, start_ind, end_ind = _get_format_from_response(response, tags)
-    assert content is None
+def test_iter_tagged_content():
+    text = "```python\nprint(1)\n```\ntext\n```YAML\nkey: value\n```"
+    tagged_contents = list(iter_tagged_content(AIResponse(_response=text)))
+    assert [tagged.content for tagged in tagged_contents] == ["print(1)", "key: value"]
 
+    tagged_contents = list(iter_tagged_content(AIResponse(_response=text), languages=["yaml"]))
+    assert [tagged.content for tagged in tagged_contents] == ["key: value"]
+    assert text[tagged_contents[0].start_ind : tagged_contents[0].end_ind] == "\nkey: value\n"
@@ -0,0 +1,114 @@
+import pytest
+
+from flow_prompt.exceptions import OutputValidationError, RetryableCustomError
+from flow_prompt.prompt.pipe_prompt import PipePrompt
+from flow_prompt.response_parsers.schema_validator import compile_schema, get_validator
+from flow_prompt.responses import AIResponse
+
+SCHEMA = {
+    "title": "Person",
+    "type": "object",
+    "properties": {
+        "name": {"type": "string", "minLength": 1},
+        "age": {"type": "integer", "minimum": 0},
+        "role": {"enum": ["admin", "user"]},
+        "skills": {"type": "array", "items": {"type": "string"}, "maxItems": 2},
+        "manager": {"anyOf": [{"type": "null"}, {"type": "string", "pattern": "^[A-Z]"}]},
+    },
+    "required": ["name"],
+    "additionalProperties": False,
+}
+
+
+@pytest.mark.parametrize(
+    "value",
+    [
+        {"name": "John"},
+        {"name": "John", "age": 30, "role": "admin", "skills": ["python"], "manager": None},
+        {"name": "John", "age": 30.0, "manager": "Ann"},
+    ],
+)
+def test_valid_values(value):
+    compile_schema(SCHEMA)(value)
+
+
+@pytest.mark.parametrize(
+    "value, error",
+    [
+        ([], "$: expected object"),
+        ({}, "$: name is required"),
+        ({"name": ""}, "$.name: shorter than 1"),
+        ({"name": "John", "age": -1}, "$.age: minimum is 0"),
+        ({"name": "John", "age": True}, "$.age: expected integer"),
+        ({"name": "John", "role": "owner"}, "$.role: 'owner' is not one of"),
+        ({"name": "John", "skills": ["a", 1]}, "$.skills[1]: expected string"),
+        ({"name": "John", "skills": ["a", "b", "c"]}, "$.skills: expected at most 2"),
+        ({"name": "John", "manager": "ann"}, "$.manager: doesn't match anyOf"),
+        ({"name": "John", "email": "j@x.com"}, "$.email: no value is allowed"),
+    ],
+)
+def test_invalid_values(value, error):
+    with pytest.raises(OutputValidationError, match=error.replace("$", r"\$").replace("[", r"\[")):
+        compile_schema(SCHEMA)(value)
+
+
+def test_validation_error_is_retryable():
+    assert issubclass(OutputValidationError, RetryableCustomError)
+
+
+@pytest.mark.parametrize(
+    "schema",
+    [
+        {"properties": {"a": {"$ref": "#/$defs/a"}}},
+        {"not": {"type": "string"}},
+        {"type": "array", "uniqueItems": True},
+        {"type": "number", "multipleOf": 5},
+        {"type": "object", "minProperties": 1},
+        {"prefixItems": [{"type": "string"}]},
+        {"items": [{"type": "string"}]},
+        {"contains": {"type": "string"}},
+        {"if": {"type": "string"}, "then": {"minLength": 1}},
+        {"anyOf": [{"type": "string"}, {"dependentRequired": {"a": ["b"]}}]},
+        {"type": "str"},
+        {"type": ["string", "datetime"]},
+    ],
+)
+def test_unsupported_schema(schema):
+    with pytest.raises(ValueError, match="not supported"):
+        compile_schema(schema)
+
+
+def test_invalid_output_schema_fails_before_call():
+    with pytest.raises(ValueError, match="uniqueItems"):
+        PipePrompt(id="prompt-with-invalid-schema", output_schema={"uniqueItems": True})
+
+    prompt = PipePrompt(id="prompt-with-schema", output_schema=SCHEMA)
+    with pytest.raises(ValueError, match="'str'"):
+        prompt.output_schema = {"type": "str"}
+    prompt.output_schema = {"type": "array"}
+    with pytest.raises(OutputValidationError, match="expected array"):
+        prompt.validate_output(AIResponse(_response='{"name": "John"}'))
+
+
+def test_validator_is_compiled_once():
+    assert get_validator(SCHEMA) is get_validator(dict(reversed(SCHEMA.items())))
+    prompt = PipePrompt(id="prompt-with-schema", output_schema=SCHEMA)
+    assert prompt.get_output_validator() is prompt.get_output_validator()
+
+
+def test_prompt_validates_output():
+    prompt = PipePrompt(id="prompt-with-schema", output_schema=SCHEMA)
+    response = AIResponse(_response='Here it is: {"name": "John"}')
+    prompt.validate_output(response)
+    assert response.parsed_content == {"name": "John"}
+
+    with pytest.raises(OutputValidationError):
+        prompt.validate_output(AIResponse(_response="I don't know"))
+    with pytest.raises(OutputValidationError):
+        prompt.validate_output(AIResponse(_response='```json\n{"name": \n```'))
+
+
+def test_output_schema_is_dumped():
+    prompt = PipePrompt(id="prompt-with-schema", output_schema=SCHEMA)
+    assert PipePrompt.load(prompt.dump()).output_schema == SCHEMA
+    assert "output_schema" not in PipePrompt(id="prompt-without-schema").dump()
@@ -0,0 +1,170 @@
+import json
+
+import pytest
+
+from flow_prompt.response_parsers.stream_parser import (
+    JSONStreamParser,
+    ParsedValue,
+    ParsedValuesReset,
+    YAMLStreamParser,
+    get_root_type,
+)
+
+
+def feed_by_chars(parser, text):
+    parsed = []
+    for i, char in enumerate(text):
+        parsed.extend((i, value) for value in parser.feed(char))
+    return parsed
+
+
+def test_json_fields_are_parsed_as_soon_as_they_close():
+    data = {"title": "A {tricky}, \"quoted\" title", "items": [1, {"a": [2, 3]}], "n": 5}
+    text = "Sure!\n```json\n" + json.dumps(data) + "\n```\nHope it helps"
+    parser = JSONStreamParser()
+    parsed = feed_by_chars(parser, text)
+
+    assert [value for _, value in parsed] == [
+        ParsedValue(key="title", value=data["title"]),
+        ParsedValue(key="items", value=data["items"]),
+        ParsedValue(key="n", value=5),
+    ]
+    title_end = text.index(', "items"')
+    assert parsed[0][0] == title_end
+    assert parser.is_complete
+    assert parser.result == data
+
+
+def test_json_list_items_are_parsed():
+    parser = JSONStreamParser()
+    parsed = parser.feed('[{"id": 1}, {"id": 2')
+    assert parsed == [ParsedValue(key=0, value={"id": 1})]
+    assert not parser.is_complete
+
+    parsed = parser.feed("}] trailing text [3]")
+    assert parsed == [ParsedValue(key=1, value={"id": 2})]
+    assert parser.result == [{"id": 1}, {"id": 2}]
+
+
+def test_json_empty_object():
+    parser = JSONStreamParser()
+    assert parser.feed("{ }") == []
+    assert parser.is_complete
+    assert parser.result == {}
+
+
+def test_yaml_entries_are_parsed_when_next_entry_starts():
+    text = "Here you go:\n```yaml\nname: John\nskills:\n  - python\n  - sql\nage: 30\n```\nBye"
+    parser = YAMLStreamParser()
+    parsed = feed_by_chars(parser, text)
+
+    assert [value for _, value in parsed] == [
+        ParsedValue(key="name", value="John"),
+        ParsedValue(key="skills", value=["python", "sql"]),
+        ParsedValue(key="age", value=30),
+    ]
+    assert parsed[0][0] == text.index("skills:")
+    assert parser.is_complete
+    assert parser.result == {"name": "John", "skills": ["python", "sql"], "age": 30}
+
+
+def test_yaml_list_items():
+    parser = YAMLStreamParser()
+    parsed = parser.feed("```yaml\n- a\n- b: 1\n  c: 2\n")
+    assert parsed == [ParsedValue(key=0, value="a")]
+    parsed = parser.feed("`")
+    assert parsed == [ParsedValue(key=1, value={"b": 1, "c": 2})]
+    assert not parser.is_complete
+    parser.feed("``\n")
+    assert parser.is_complete
+    assert parser.result == ["a", {"b": 1, "c": 2}]
+
+
+def test_yaml_list_without_indentation_is_value_of_key():
+    parser = YAMLStreamParser()
+    parsed = parser.feed("```\nskills:\n- python\n- sql\nage: 30\n")
+    assert parsed == [ParsedValue(key="skills", value=["python", "sql"])]
+
+
+@pytest.mark.parametrize("by_chars", [False, True])
+def test_json_braces_in_prose_are_skipped(by_chars):
+    text = 'Here is the answer for {user} [see below]:\n```json\n{"a": 1, "b": [2]}\n```'
+    parser = JSONStreamParser()
+    if by_chars:
+        values = [value for _, value in feed_by_chars(parser, text)]
+    else:
+        values = parser.feed(text)
+    assert values == [ParsedValue("a", 1), ParsedValue("b", [2])]
+    assert parser.is_complete
+    assert parser.result == {"a": 1, "b": [2]}
+
+
+def test_json_is_not_complete_until_result_is_parsed():
+    parser = JSONStreamParser()
+    parser.feed("{'a': }")
+    assert not parser.is_complete
+    assert parser.result is None
+
+
+@pytest.mark.parametrize("by_chars", [False, True])
+def test_json_root_of_other_type_is_skipped(by_chars):
+    text = 'The user is described below, see [1]:\n{"name": "John", "refs": [1]}'
+    parser = JSONStreamParser(root_type="object")
+    if by_chars:
+        values = [value for _, value in feed_by_chars(parser, text)]
+    else:
+        values = parser.feed(text)
+    assert values == [ParsedValue("name", "John"), ParsedValue("refs", [1])]
+    assert parser.result == {"name": "John", "refs": [1]}
+
+    parser = JSONStreamParser()
+    parser.feed(text)
+    assert parser.result == [1]
+
+
+def test_yaml_entries_of_other_type_are_skipped():
+    parser = YAMLStreamParser(root_type="object")
+    assert parser.feed("```yaml\n- a\nname: John\n```\n") == [ParsedValue("name", "John")]
+    assert parser.result == {"name": "John"}
+
+
+def test_root_type_of_schema():
+    assert get_root_type({"type": "object", "properties": {}}) == "object"
+    assert get_root_type({"type": "array"}) == "array"
+    assert get_root_type({"type": "string"}) is None
+    assert get_root_type(None) is None
+    with pytest.raises(ValueError):
+        JSONStreamParser(root_type="string")
+
+
+def test_json_values_of_invalid_candidate_are_reset():
+    parser = JSONStreamParser()
+    assert parser.feed('Use {"a": 1, ') == [ParsedValue("a", 1)]
+    assert parser.feed('"b" = 2} instead:\n{"c": 3}') == [
+        ParsedValuesReset(),
+        ParsedValue("c", 3),
+    ]
+    assert parser.result == {"c": 3}
+
+
+def test_json_values_of_invalid_candidate_in_one_feed_are_dropped():
+    parser = JSONStreamParser()
+    assert parser.feed('Use {"a": 1, "b" = 2} instead:\n{"c": 3}') == [ParsedValue("c", 3)]
+
+
+@pytest.mark.parametrize("tail", ["", "\n", "\n  "])
+def test_yaml_last_entry_is_parsed_at_finish_without_fence(tail):
+    parser = YAMLStreamParser()
+    assert parser.feed("```yaml\nname: John\nage: 30" + tail) == [ParsedValue("name", "John")]
+    assert not parser.is_complete
+    assert parser.finish() == [ParsedValue("age", 30)]
+    assert parser.is_complete
+    assert parser.result == {"name": "John", "age": 30}
+    assert parser.finish() == []
+
+
+def test_yaml_part_of_closing_fence_is_ignored_at_finish():
+    parser = YAMLStreamParser()
+    assert len(parser.feed("```yaml\nname: John\nage: 30\n``")) == 2
+    assert parser.finish() == []
+    assert parser.result == {"name": "John", "age": 30}
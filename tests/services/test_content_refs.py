@@ -0,0 +1,66 @@
+from flow_prompt.services import content_refs
+from flow_prompt.services.content_refs import ContentIndex, get_content_hash
+
+PROMPT = {"prompt_id": "prompt", "version": "1", "chats": [{"content": "system"}]}
+LARGE_TEXT = "document " * 200
+
+
+def get_log_data(context):
+    return {"prompt": PROMPT, "context": context, "response": {"content": "answer"}}
+
+
+def test_content_is_sent_once_and_then_referred_by_hash():
+    index = ContentIndex(min_bytes=100)
+    context = {"question": "short", "document": LARGE_TEXT}
+    hashes = set()
+    log = index.replace_with_refs("token", get_log_data(context), hashes)
+
+    prompt_hash = get_content_hash(PROMPT)
+    assert log["prompt"] == {**PROMPT, "hash": prompt_hash}
+    assert log["context"] == context
+    document_hash = log["context_hashes"]["document"]
+    assert hashes == {prompt_hash, document_hash}
+
+    index.add("token", hashes)
+    log = index.replace_with_refs("token", get_log_data(context), set())
+    assert log["prompt"] == {"prompt_id": "prompt", "version": "1", "hash": prompt_hash}
+    assert log["context"] == {"question": "short"}
+    assert log["context_refs"] == {"document": document_hash}
+    assert "context_hashes" not in log
+
+    # hashes are uploaded per api token
+    log = index.replace_with_refs("other", get_log_data(context), set())
+    assert log["context"] == context
+
+
+def test_large_structured_values_are_hashed():
+    index = ContentIndex(min_bytes=100)
+    assert index.get_value_hash({"items": list(range(100))}) is not None
+    assert index.get_value_hash({"items": [1]}) is None
+    assert index.get_value_hash(12345) is None
+
+
+def test_oldest_hashes_are_evicted():
+    index = ContentIndex(max_size=2)
+    index.add("token", ["a", "b"])
+    assert index.is_uploaded("token", "a")
+    index.add("token", ["c"])
+    assert not index.is_uploaded("token", "b")
+    assert index.is_uploaded("token", "a")
+    assert index.is_uploaded("token", "c")
+
+
+def test_prompt_is_hashed_once_per_version(monkeypatch):
+    index = ContentIndex()
+    calls = []
+    monkeypatch.setattr(
+        content_refs, "get_content_hash", lambda data: calls.append(data) or str(len(calls))
+    )
+    first = index.get_prompt_hash(dict(PROMPT))
+    assert index.get_prompt_hash(dict(PROMPT)) == first
+    assert len(calls) == 1
+
+    # a prompt changed without a new version is hashed again
+    changed = {**PROMPT, "chats": [{"content": "changed"}]}
+    assert index.get_prompt_hash(changed) != first
+    assert len(calls) == 2
@@ -0,0 +1,43 @@
+from decimal import Decimal
+from unittest.mock import MagicMock
+
+from flow_prompt import settings
+from flow_prompt.ai_models.openai.responses import FINISH_REASON_ERROR
+from flow_prompt.prompt.flow_prompt import FlowPrompt
+from flow_prompt.responses import AIResponse, Metrics
+from flow_prompt.services.sampling import SamplingPolicy
+
+
+def test_interactions_are_sampled_by_prompt_rate():
+    policy = SamplingPolicy(rate=1, prompt_rates={"noisy": 0, "half": 0.5})
+    response = AIResponse(content="answer")
+    assert policy.is_kept("other", response)
+    assert not any(policy.is_kept("noisy", response) for _ in range(100))
+    kept = sum(policy.is_kept("half", response) for _ in range(1000))
+    assert 350 < kept < 650
+
+
+def test_tail_interactions_are_always_kept():
+    policy = SamplingPolicy(rate=0, latency_threshold=1000, price_threshold=Decimal("0.1"))
+    assert not policy.is_kept("prompt", AIResponse(metrics=Metrics(latency=500)))
+    assert policy.is_kept("prompt", AIResponse(finish_reason=FINISH_REASON_ERROR))
+    assert policy.is_kept("prompt", AIResponse(), attempt_number=2)
+    assert policy.is_kept("prompt", AIResponse(metrics=Metrics(latency=1500)))
+    assert policy.is_kept("prompt", AIResponse(metrics=Metrics(price_of_call=Decimal("0.2"))))
+    assert policy.is_kept("prompt", AIResponse(), test_data={"ideal_answer": "42"})
+
+
+def test_sampled_out_interaction_is_not_serialized(monkeypatch):
+    monkeypatch.setattr(settings, "USE_API_SERVICE", True)
+    worker = MagicMock()
+    flow_prompt = FlowPrompt(
+        api_token="token", worker=worker, sampling_policy=SamplingPolicy(rate=0)
+    )
+    pipe_prompt = MagicMock(id="prompt")
+
+    flow_prompt._save_interaction(pipe_prompt, {}, AIResponse(content="answer"))
+    pipe_prompt.service_dump.assert_not_called()
+    worker.add_task.assert_not_called()
+
+    flow_prompt._save_interaction(pipe_prompt, {}, AIResponse(), attempt_number=2)
+    worker.add_task.assert_called_once()
@@ -0,0 +1,403 @@
+import gc
+import gzip
+import json
+import os
+import threading
+from time import monotonic, sleep
+from unittest.mock import MagicMock, patch
+
+import pytest
+import requests
+
+from flow_prompt.prompt.flow_prompt import FlowPrompt
+from flow_prompt.responses import AIResponse
+from flow_prompt.services import SaveWorker as save_worker_module
+from flow_prompt.services.flow_prompt import FlowPromptService
+from flow_prompt.services.SaveWorker import (
+    Batch,
+    SaveWorker,
+    acquire_worker,
+    release_worker,
+)
+from flow_prompt.services.content_refs import ContentIndex
+from flow_prompt.services.spool import Spool
+
+PROMPT_DATA = {"prompt_id": "prompt", "chats": []}
+
+
+@pytest.fixture
+def service(monkeypatch):
+    service = MagicMock()
+    monkeypatch.setattr(FlowPromptService, "save_user_interactions", service.save_logs)
+    monkeypatch.setattr(
+        FlowPromptService, "create_tests_with_ideal_answer", service.save_tests
+    )
+    return service
+
+
+def add_tasks(worker, count, api_token="token", test_data=None, start=0):
+    for i in range(start, start + count):
+        worker.add_task(
+            api_token,
+            PROMPT_DATA,
+            {"i": i},
+            AIResponse(content=f"answer {i}", id=f"prompt#{i}"),
+            test_data,
+        )
+
+
+def get_sent_logs(service):
+    return [
+        [json.loads(log) for log in call.args[1]]
+        for call in service.save_logs.call_args_list
+    ]
+
+
+def test_tasks_are_batched_by_count(service):
+    worker = SaveWorker(max_batch_size=3, max_batch_interval=10)
+    add_tasks(worker, 6)
+    worker.queue.join()
+
+    batches = get_sent_logs(service)
+    assert [len(logs) for logs in batches] == [3, 3]
+    assert batches[0][0]["context"] == {"i": 0}
+    assert batches[0][0]["response"] == {"content": "answer 0"}
+    assert batches[0][0]["timestamp"] == "0"
+
+
+def test_tasks_are_batched_by_bytes(service):
+    worker = SaveWorker(max_batch_size=100, max_batch_bytes=1, max_batch_interval=10)
+    add_tasks(worker, 2)
+    worker.queue.join()
+    assert [len(logs) for logs in get_sent_logs(service)] == [1, 1]
+
+
+def test_tasks_are_sent_after_interval(service):
+    worker = SaveWorker(max_batch_size=100, max_batch_interval=0.05)
+    started_at = monotonic()
+    add_tasks(worker, 2)
+    worker.queue.join()
+    assert monotonic() - started_at < 1
+    assert [len(logs) for logs in get_sent_logs(service)] == [2]
+
+
+def test_batches_are_grouped_by_api_token_with_tests(service):
+    worker = SaveWorker(max_batch_size=4, max_batch_interval=10)
+    add_tasks(worker, 2, api_token="first", test_data={"ideal_answer": "42"})
+    add_tasks(worker, 2, api_token="second")
+    worker.queue.join()
+
+    assert [call.args[0] for call in service.save_logs.call_args_list] == ["first", "second"]
+    service.save_tests.assert_called_once()
+    api_token, tests = service.save_tests.call_args.args
+    assert api_token == "first"
+    assert [json.loads(test)["ideal_answer"] for test in tests] == ["42", "42"]
+
+
+def test_failed_batch_does_not_stop_the_worker(service):
+    service.save_logs.side_effect = [ConnectionError("service is down"), None]
+    worker = SaveWorker(max_batch_size=1, max_batch_interval=10)
+    add_tasks(worker, 2)
+    worker.queue.join()
+    assert service.save_logs.call_count == 2
+    assert worker.stats.sent == 1
+    assert worker.stats.failed == 1
+
+
+def fill_queue(service, **kwargs):
+    """Worker is sending the first task, the rest wait in the queue of 2 tasks"""
+    sending, release = threading.Event(), threading.Event()
+
+    def save_logs(api_token, logs):
+        sending.set()
+        release.wait(5)
+
+    service.save_logs.side_effect = save_logs
+    worker = SaveWorker(max_batch_size=1, max_queue_size=2, **kwargs)
+    add_tasks(worker, 1)
+    assert sending.wait(5)
+    add_tasks(worker, 3, start=1)
+    release.set()
+    worker.queue.join()
+    return worker, [logs[0]["context"]["i"] for logs in get_sent_logs(service)]
+
+
+def test_oldest_task_is_dropped_on_overflow(service):
+    worker, sent = fill_queue(service, overflow_policy="drop_oldest")
+    assert sent == [0, 2, 3]
+    assert worker.stats.dropped == 1
+    assert worker.stats.enqueued == 4
+    assert worker.stats.sent == 3
+
+
+def test_newest_task_is_dropped_on_overflow(service):
+    worker, sent = fill_queue(service, overflow_policy="drop_newest")
+    assert sent == [0, 1, 2]
+    assert worker.stats.dropped == 1
+    assert worker.stats.enqueued == 3
+
+
+def test_overflow_blocks_until_timeout(service):
+    started_at = monotonic()
+    worker, sent = fill_queue(service, overflow_policy="block", block_timeout=0.05)
+    assert monotonic() - started_at >= 0.05
+    assert sent == [0, 1, 2]
+    assert worker.stats.dropped == 1
+
+
+def test_batches_are_sent_by_several_threads(service):
+    barrier = threading.Barrier(3, timeout=5)
+    service.save_logs.side_effect = lambda api_token, logs: barrier.wait()
+    worker = SaveWorker(max_batch_size=1, threads=3)
+    add_tasks(worker, 3)
+    worker.queue.join()
+    assert worker.stats.sent == 3
+    assert worker.stats.failed == 0
+
+
+def get_sent_contexts(service):
+    return [log["context"]["i"] for logs in get_sent_logs(service) for log in logs]
+
+
+def test_failed_batch_is_spooled_and_replayed_in_order(service, tmp_path):
+    service.save_logs.side_effect = [ConnectionError("service is down"), None, None]
+    worker = SaveWorker(max_batch_size=2, max_batch_interval=10, spool=Spool(str(tmp_path)))
+    add_tasks(worker, 2)
+    worker.queue.join()
+    assert worker.stats.spooled == 2
+    assert not worker.spool.is_empty()
+
+    add_tasks(worker, 2, start=2)
+    worker.queue.join()
+    worker.replay(blocking=True)
+    assert get_sent_contexts(service) == [0, 1, 2, 3, 0, 1]
+    assert worker.stats.sent == 4
+    assert worker.stats.failed == 0
+    assert worker.spool.is_empty()
+
+
+def test_logs_are_not_spooled_again_if_only_tests_failed(service, tmp_path):
+    service.save_tests.side_effect = [ConnectionError("service is down"), None]
+    worker = SaveWorker(max_batch_size=2, max_batch_interval=10, spool=Spool(str(tmp_path)))
+    add_tasks(worker, 2, test_data={"ideal_answer": "42"})
+    worker.queue.join()
+    assert worker.stats.sent == 2
+    assert worker.stats.spooled == 0
+    assert not worker.spool.is_empty()
+
+    worker.replay(blocking=True)
+    assert get_sent_contexts(service) == [0, 1]
+    assert service.save_tests.call_count == 2
+    assert len(service.save_tests.call_args.args[1]) == 2
+    assert worker.spool.is_empty()
+
+
+def test_overflow_is_spooled(service, tmp_path):
+    worker, sent = fill_queue(
+        service, overflow_policy="drop_newest", spool=Spool(str(tmp_path))
+    )
+    assert worker.stats.dropped == 0
+    assert worker.stats.spooled == 1
+    worker.replay(blocking=True)
+    assert sorted(get_sent_contexts(service)) == [0, 1, 2, 3]
+    assert worker.stats.sent == 4
+
+
+def test_spool_of_previous_run_is_replayed(service, tmp_path):
+    spool = Spool(str(tmp_path))
+    spool.append(Batch(logs=[b'{"context": {"i": 7}}']).dump("token"))
+    spool.close()
+
+    worker = SaveWorker(max_batch_size=1, spool=Spool(str(tmp_path)), spool_retry_interval=0.01)
+    # the token of the spooled batch isn't known until a task with it is added
+    worker.replay(blocking=True)
+    assert not service.save_logs.called
+    add_tasks(worker, 1, api_token="other")
+    worker.queue.join()
+    worker.replay(blocking=True)
+    assert not worker.spool.is_empty()
+
+    add_tasks(worker, 1, start=1)
+    worker.queue.join()
+    worker.replay(blocking=True)
+    assert service.save_logs.call_args.args == ("token", [b'{"context": {"i": 7}}'])
+    assert worker.spool.is_empty()
+
+
+def test_spool_does_not_store_api_token(service, tmp_path):
+    service.save_logs.side_effect = ConnectionError("service is down")
+    worker = SaveWorker(max_batch_size=1, spool=Spool(str(tmp_path / "spool")))
+    add_tasks(worker, 1, api_token="secret-token")
+    worker.close(timeout=5)
+    worker.spool.close()
+
+    assert worker.stats.spooled == 1
+    assert os.stat(tmp_path / "spool").st_mode & 0o777 == 0o700
+    for name in os.listdir(tmp_path / "spool"):
+        path = tmp_path / "spool" / name
+        assert os.stat(path).st_mode & 0o777 == 0o600
+        assert b"secret-token" not in path.read_bytes()
+
+
+def test_flush_sends_partial_batch(service):
+    worker = SaveWorker(max_batch_size=100, max_batch_interval=10)
+    add_tasks(worker, 2)
+    started_at = monotonic()
+    assert worker.flush(timeout=5)
+    assert monotonic() - started_at < 5
+    assert get_sent_contexts(service) == [0, 1]
+
+
+def test_flush_returns_false_on_timeout(service):
+    release = threading.Event()
+    service.save_logs.side_effect = lambda api_token, logs: release.wait(5)
+    worker = SaveWorker(max_batch_size=1)
+    add_tasks(worker, 1)
+    assert not worker.flush(timeout=0.05)
+    release.set()
+    assert worker.flush(timeout=5)
+
+
+def test_close_stops_threads_and_drops_later_tasks(service):
+    worker = SaveWorker(max_batch_size=100, max_batch_interval=10, threads=2)
+    add_tasks(worker, 2)
+    assert worker.close(timeout=5)
+    assert get_sent_contexts(service) == [0, 1]
+    assert not any(thread.is_alive() for thread in worker.threads)
+
+    add_tasks(worker, 1, start=2)
+    assert worker.stats.dropped == 1
+    assert get_sent_contexts(service) == [0, 1]
+
+
+def test_rejected_batch_is_sent_log_by_log(service):
+    def save_logs(api_token, logs):
+        if any(json.loads(log)["context"]["i"] == 1 for log in logs):
+            response = MagicMock(status_code=400)
+            raise requests.HTTPError("invalid log", response=response)
+
+    service.save_logs.side_effect = save_logs
+    worker = SaveWorker(max_batch_size=3, max_batch_interval=10)
+    add_tasks(worker, 3)
+    worker.queue.join()
+
+    assert get_sent_contexts(service)[3:] == [0, 1, 2]
+    assert worker.stats.sent == 2
+    assert worker.stats.failed == 1
+
+
+def test_unexpected_error_does_not_break_join(service):
+    worker = SaveWorker(max_batch_size=1, max_batch_interval=10)
+    with patch.object(worker, "send_or_spill", side_effect=[RuntimeError("bug"), True]):
+        add_tasks(worker, 2)
+        worker.queue.join()
+    assert worker.threads[0].is_alive()
+
+
+@pytest.fixture
+def shared_worker(monkeypatch):
+    monkeypatch.setattr(save_worker_module, "_shared_worker", None)
+
+
+def test_shared_worker_is_kept_when_released_by_all(service, shared_worker):
+    worker = acquire_worker()
+    assert acquire_worker() is worker
+    release_worker(worker)
+    release_worker(worker)
+    assert not worker.is_closed
+    assert acquire_worker() is worker
+
+    worker.close(timeout=5)
+    assert acquire_worker() is not worker
+
+
+def test_flow_prompt_instances_share_the_worker(service, shared_worker):
+    first, second = FlowPrompt(), FlowPrompt()
+    worker = first.worker
+    assert second.worker is worker
+
+    del first
+    gc.collect()
+    second.close(timeout=5)
+    assert not worker.is_closed
+
+    own_worker = SaveWorker()
+    flow_prompt = FlowPrompt(worker=own_worker)
+    flow_prompt.close(timeout=5)
+    assert not own_worker.is_closed
+
+
+def test_short_lived_flow_prompt_instances_reuse_the_worker(service, shared_worker):
+    threads_count = threading.active_count()
+    workers = set()
+    for _ in range(50):
+        flow_prompt = FlowPrompt()
+        workers.add(id(flow_prompt.worker))
+        flow_prompt.close(timeout=0)
+        del flow_prompt
+    assert len(workers) == 1
+    assert threading.active_count() <= threads_count + 1
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="fork isn't available")
+def test_worker_is_restarted_after_fork(service):
+    worker = SaveWorker(max_batch_size=1)
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        # the child has only the forking thread, the worker must start its own
+        try:
+            add_tasks(worker, 1)
+            is_ok = worker.flush(timeout=5) and all(t.is_alive() for t in worker.threads)
+            os.write(write_fd, b"1" if is_ok else b"0")
+        finally:
+            os._exit(0)
+    os.close(write_fd)
+    assert os.read(read_fd, 1) == b"1"
+    os.waitpid(pid, 0)
+    os.close(read_fd)
+
+
+def test_content_refs_are_off_by_default(service):
+    worker = SaveWorker(max_batch_size=1)
+    assert worker.content_index is None
+
+
+def test_logs_refer_to_content_sent_before(service):
+    service.save_logs.side_effect = [ConnectionError("service is down"), None, None]
+    worker = SaveWorker(max_batch_size=1, content_index=ContentIndex())
+    add_tasks(worker, 3)
+    worker.queue.join()
+
+    prompts = [logs[0]["prompt"] for logs in get_sent_logs(service)]
+    # the prompt isn't referred until the log with it is sent
+    assert prompts[0]["chats"] == prompts[1]["chats"] == []
+    assert prompts[2] == {"prompt_id": "prompt", "version": None, "hash": prompts[1]["hash"]}
+
+
+def test_logs_are_sent_in_full_if_refs_are_rejected(service):
+    response = MagicMock(status_code=400)
+    service.save_logs.side_effect = [None, requests.HTTPError(response=response), None, None]
+    worker = SaveWorker(max_batch_size=1, content_index=ContentIndex())
+    add_tasks(worker, 3)
+    worker.queue.join()
+
+    prompts = [logs[0]["prompt"] for logs in get_sent_logs(service)]
+    assert "hash" in prompts[1] and "chats" not in prompts[1]
+    assert prompts[2] == PROMPT_DATA
+    # the rejected hash is sent again before it's referred
+    assert prompts[3]["chats"] == [] and prompts[3]["hash"] == prompts[1]["hash"]
+    assert worker.stats.failed == 0
+
+
+def test_bulk_request_is_gzipped():
+    with patch("flow_prompt.services.flow_prompt.requests.post") as post:
+        FlowPromptService.save_user_interactions("token", [b'{"a": 1}', b'{"b": 2}'])
+
+    url = post.call_args.args[0]
+    headers = post.call_args.kwargs["headers"]
+    body = post.call_args.kwargs["data"]
+    assert url.endswith("lib/logs/bulk")
+    assert headers["Content-Encoding"] == "gzip"
+    assert json.loads(gzip.decompress(body)) == {"logs": [{"a": 1}, {"b": 2}]}
+    post.return_value.raise_for_status.assert_called_once()
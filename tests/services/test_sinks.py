@@ -0,0 +1,153 @@
+import gzip
+import json
+import sqlite3
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest.mock import MagicMock
+
+import pytest
+
+from flow_prompt.responses import AIResponse
+from flow_prompt.services.flow_prompt import FlowPromptService
+from flow_prompt.services.SaveWorker import SaveWorker
+from flow_prompt.services.sinks import (
+    FanOutSink,
+    FlowPromptSink,
+    JSONLSink,
+    SQLiteSink,
+    get_default_sink,
+    get_token_fingerprint,
+)
+
+
+def read_lines(path, opener=open):
+    with opener(path, "rb") as f:
+        return [json.loads(line) for line in f.read().splitlines()]
+
+
+def test_jsonl_sink_writes_logs_and_tests(tmp_path):
+    path = str(tmp_path / "logs.jsonl")
+    sink = JSONLSink(path)
+    sink.save("token", [b'{"a": 1}', b'{"a": 2}'], [b'{"t": 1}'])
+    sink.close()
+
+    fingerprint = get_token_fingerprint("token")
+    assert read_lines(path) == [
+        {"token_fingerprint": fingerprint, "kind": "log", "data": {"a": 1}},
+        {"token_fingerprint": fingerprint, "kind": "log", "data": {"a": 2}},
+        {"token_fingerprint": fingerprint, "kind": "test", "data": {"t": 1}},
+    ]
+    with open(path, "rb") as f:
+        assert b"token" not in f.read().replace(b"token_fingerprint", b"")
+
+
+@pytest.mark.parametrize("compress", [False, True])
+def test_jsonl_sink_is_rotated(tmp_path, compress):
+    path = str(tmp_path / "logs.jsonl")
+    sink = JSONLSink(path, max_bytes=60, backups=2, compress=compress)
+    for i in range(4):
+        sink.save("token", [json.dumps({"i": i}).encode()], [])
+    sink.close()
+
+    opener = gzip.open if compress else open
+    assert [line["data"] for line in read_lines(path)] == [{"i": 3}]
+    assert [line["data"] for line in read_lines(sink.get_backup_path(1), opener)] == [{"i": 2}]
+    assert [line["data"] for line in read_lines(sink.get_backup_path(2), opener)] == [{"i": 1}]
+    assert not (tmp_path / "logs.jsonl.3").exists()
+
+
+def test_sqlite_sink_inserts_rows(tmp_path):
+    path = str(tmp_path / "logs.sqlite3")
+    sink = SQLiteSink(path)
+    sink.save("token", [b'{"a": 1}'], [b'{"t": 1}'])
+    sink.close()
+
+    rows = sqlite3.connect(path).execute(
+        "SELECT token_fingerprint, kind, data FROM logs"
+    ).fetchall()
+    fingerprint = get_token_fingerprint("token")
+    assert rows == [(fingerprint, "log", '{"a": 1}'), (fingerprint, "test", '{"t": 1}')]
+    assert len(fingerprint) == 12 and fingerprint != get_token_fingerprint("other")
+
+
+def test_fan_out_raises_only_failures_of_the_first_sink():
+    first, second = MagicMock(supports_content_refs=True), MagicMock(supports_content_refs=False)
+    sink = FanOutSink([first, second])
+    assert not sink.supports_content_refs
+
+    second.save.side_effect = OSError("disk is full")
+    sink.save("token", [b"{}"], [])
+    first.save.assert_called_once_with("token", [b"{}"], [])
+
+    first.save.side_effect = ConnectionError("service is down")
+    with pytest.raises(ConnectionError):
+        sink.save("token", [b"{}"], [])
+
+
+def test_default_sink_by_names(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    assert isinstance(get_default_sink("flow_prompt"), FlowPromptSink)
+    sink = get_default_sink("flow_prompt, sqlite")
+    assert [type(s) for s in sink.sinks] == [FlowPromptSink, SQLiteSink]
+    with pytest.raises(ValueError):
+        get_default_sink("kafka")
+
+
+def test_worker_saves_full_logs_to_local_sink(tmp_path):
+    path = str(tmp_path / "logs.jsonl")
+    worker = SaveWorker(max_batch_size=1, sink=JSONLSink(path))
+    assert worker.content_index is None
+    for i in range(2):
+        worker.add_task(
+            "token",
+            {"prompt_id": "prompt", "chats": []},
+            {"i": i},
+            AIResponse(content="answer", id=f"prompt#{i}"),
+        )
+    worker.queue.join()
+    worker.sink.close()
+
+    logs = [line["data"] for line in read_lines(path)]
+    assert [log["context"] for log in logs] == [{"i": 0}, {"i": 1}]
+    assert logs[1]["prompt"] == {"prompt_id": "prompt", "chats": []}
+
+
+@pytest.fixture
+def server_without_bulk(monkeypatch):
+    """Flow Prompt server which has only the per-item endpoints"""
+    requests = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers["Content-Length"]))
+            requests.append((self.path, body))
+            self.send_response(404 if self.path.endswith("/bulk") else 200)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setattr(FlowPromptService, "url", f"http://127.0.0.1:{server.server_port}/")
+    yield requests
+    server.shutdown()
+    server.server_close()
+
+
+def test_flow_prompt_sink_falls_back_to_per_item_endpoints(server_without_bulk):
+    sink = FlowPromptSink()
+    sink.save("token", [b'{"a": 1}', b'{"a": 2}'], [b'{"t": 1}'])
+    sink.save("token", [b'{"a": 3}'], [])
+
+    assert [(path, body) for path, body in server_without_bulk] == [
+        ("/lib/logs/bulk", server_without_bulk[0][1]),
+        ("/lib/logs", b'{"a": 1}'),
+        ("/lib/logs", b'{"a": 2}'),
+        ("/lib/tests/bulk", server_without_bulk[3][1]),
+        ("/lib/tests", b'{"t": 1}'),
+        # the missing bulk endpoint is remembered
+        ("/lib/logs", b'{"a": 3}'),
+    ]
+    assert not sink.has_bulk_logs and not sink.has_bulk_tests
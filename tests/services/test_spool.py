@@ -0,0 +1,67 @@
+import os
+
+from flow_prompt.services.spool import HEADER, Spool
+
+
+def read_all(spool):
+    records = []
+    while True:
+        record = spool.read()
+        if record is None:
+            return records
+        position, payload = record
+        records.append(payload)
+        spool.ack(position)
+
+
+def test_records_are_read_in_order_after_restart(tmp_path):
+    spool = Spool(str(tmp_path), fsync_policy="always")
+    for i in range(3):
+        assert spool.append(f"record {i}".encode())
+    position, payload = spool.read()
+    assert payload == b"record 0"
+    spool.ack(position)
+    spool.close()
+
+    spool = Spool(str(tmp_path))
+    assert not spool.is_empty()
+    assert read_all(spool) == [b"record 1", b"record 2"]
+    assert spool.is_empty()
+
+
+def test_segments_are_rotated_and_the_oldest_are_deleted(tmp_path):
+    record_size = HEADER.size + 10
+    spool = Spool(str(tmp_path), max_bytes=record_size * 4, segment_bytes=record_size * 2)
+    for i in range(6):
+        assert spool.append(f"record {i:03d}".encode())
+
+    assert len(spool.segments) == 2
+    assert spool.size <= spool.max_bytes
+    assert read_all(spool) == [f"record {i:03d}".encode() for i in range(2, 6)]
+    assert not spool.append(b"x" * spool.max_bytes)
+
+
+def test_consumed_segments_are_deleted(tmp_path):
+    record_size = HEADER.size + 1
+    spool = Spool(str(tmp_path), segment_bytes=record_size)
+    for i in range(3):
+        spool.append(str(i).encode())
+    assert read_all(spool) == [b"0", b"1", b"2"]
+    assert len([name for name in os.listdir(tmp_path) if name.endswith(".seg")]) == 1
+
+
+def test_corrupted_and_torn_records_are_skipped(tmp_path):
+    spool = Spool(str(tmp_path))
+    spool.append(b"first")
+    spool.append(b"second")
+    spool.close()
+    segment_path = spool._get_segment_path(spool.segments[-1])
+    with open(segment_path, "r+b") as f:
+        f.seek(HEADER.size + len(b"first") + HEADER.size)
+        f.write(b"S")
+    with open(segment_path, "ab") as f:
+        f.write(HEADER.pack(100, 0) + b"torn")
+
+    spool = Spool(str(tmp_path))
+    spool.append(b"third")
+    assert read_all(spool) == [b"first", b"third"]
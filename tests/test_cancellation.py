@@ -0,0 +1,75 @@
+from time import sleep
+from unittest.mock import MagicMock
+
+import pytest
+
+from flow_prompt.cancellation import CancellationToken
+from flow_prompt.exceptions import (
+    CallCancelledError,
+    ConnectionLostError,
+    DeadlineExceededError,
+)
+
+
+def test_cancel_calls_registered_callbacks():
+    token = CancellationToken()
+    callback = MagicMock()
+    token.register(callback)
+    token.cancel()
+    token.cancel()
+
+    assert token.is_cancelled
+    callback.assert_called_once()
+    with pytest.raises(CallCancelledError):
+        token.raise_if_cancelled()
+
+
+def test_register_after_cancel_calls_callback_immediately():
+    token = CancellationToken()
+    token.cancel()
+    callback = MagicMock()
+    token.register(callback)
+    callback.assert_called_once()
+
+
+def test_unregistered_callback_is_not_called():
+    token = CancellationToken()
+    callback = MagicMock()
+    callback_id = token.register(callback)
+    token.unregister(callback_id)
+    token.cancel()
+    callback.assert_not_called()
+
+
+def test_deadline_is_exceeded():
+    token = CancellationToken(timeout=0.01)
+    assert token.remaining() > 0
+    sleep(0.02)
+    assert token.remaining() == 0
+    with pytest.raises(DeadlineExceededError):
+        token.raise_if_cancelled()
+    assert token.is_cancelled
+
+
+def test_parent_cancels_child():
+    parent = CancellationToken(timeout=10)
+    child = CancellationToken(timeout=100, parent=parent)
+    assert child.deadline == parent.deadline
+
+    parent.cancel()
+    assert child.is_cancelled
+
+
+def test_released_child_is_not_cancelled_by_parent():
+    parent = CancellationToken()
+    child = CancellationToken(parent=parent)
+    child.release()
+    parent.cancel()
+    assert not child.is_cancelled
+
+
+def test_cancel_with_error():
+    token = CancellationToken()
+    token.cancel(ConnectionLostError("Connection was lost!"))
+    with pytest.raises(ConnectionLostError):
+        token.raise_if_cancelled()
@@ -0,0 +1,52 @@
+from openai.types.chat import ChatCompletionMessage as Message
+
+from flow_prompt.ai_models.openai.responses import OpenAIResponse
+from flow_prompt.responses import LeanAIResponse, LeanToolCall, Metrics
+
+
+def make_response():
+    message = Message(
+        content=None,
+        role="assistant",
+        tool_calls=[
+            {
+                "id": "call_1",
+                "type": "function",
+                "function": {"name": "search", "arguments": '{"q": "cats"}'},
+            }
+        ],
+    )
+    return OpenAIResponse(
+        message=message,
+        finish_reason="tool_calls",
+        original_result={"raw": "x" * 1000},
+        metrics=Metrics(prompt_tokens_used=5, sample_tokens_used=7),
+        id="prompt#1",
+    )
+
+
+def test_lean_response_keeps_only_the_data():
+    lean = LeanAIResponse.from_response(make_response())
+
+    assert lean.original_result is None
+    assert lean.finish_reason == "tool_calls"
+    assert lean.metrics.prompt_tokens_used == 5
+    assert lean.id == "prompt#1"
+    assert lean.is_function()
+    assert lean.tool_calls == [
+        LeanToolCall(id="call_1", name="search", arguments='{"q": "cats"}')
+    ]
+    assert lean.get_function_args(lean.tool_calls[0]) == {"q": "cats"}
+    assert not hasattr(lean, "__dict__")
+
+
+def test_lean_response_keeps_original_result_on_request():
+    lean = LeanAIResponse.from_response(make_response(), keep_original_result=True)
+    assert lean.original_result == {"raw": "x" * 1000}
+
+
+def test_lean_response_content():
+    response = OpenAIResponse(message=Message(content="Hello", role="assistant"))
+    lean = LeanAIResponse.from_response(response)
+    assert lean.response == "Hello"
+    assert lean.tool_calls is None
@@ -0,0 +1,161 @@
+import threading
+from time import monotonic, sleep
+from unittest.mock import MagicMock
+
+import pytest
+
+from flow_prompt.cancellation import CancellationToken
+from flow_prompt.exceptions import ConnectionLostError
+from flow_prompt.responses import Metrics
+from flow_prompt.streaming import FlushPolicy, StreamHandler, get_percentile
+
+
+def test_connection_is_checked_once_in_interval():
+    check_connection = MagicMock(return_value=True)
+    handler = StreamHandler(check_connection=check_connection, check_connection_interval=60)
+    for _ in range(100):
+        handler.on_text("token")
+
+    check_connection.assert_called_once()
+    assert handler.content == "token" * 100
+
+
+def test_lost_connection_cancels_token():
+    token = CancellationToken()
+    closed = MagicMock()
+    token.register(closed)
+    handler = StreamHandler(
+        check_connection=MagicMock(return_value=False), cancellation_token=token
+    )
+
+    with pytest.raises(ConnectionLostError):
+        handler.on_text("token")
+    closed.assert_called_once()
+    with pytest.raises(ConnectionLostError):
+        token.raise_if_cancelled()
+
+
+def test_background_check_does_not_block_tokens():
+    is_connected = threading.Event()
+    is_connected.set()
+
+    def check_connection():
+        sleep(0.05)
+        return is_connected.is_set()
+
+    token = CancellationToken()
+    handler = StreamHandler(
+        check_connection=check_connection,
+        check_connection_interval=0.01,
+        check_connection_in_background=True,
+        cancellation_token=token,
+    )
+    started_at = monotonic()
+    handler.on_text("first")
+    assert monotonic() - started_at < 0.05
+    is_connected.clear()
+    sleep(0.2)
+
+    assert token.is_cancelled
+    with pytest.raises(ConnectionLostError):
+        handler.on_text("second")
+    handler.close()
+    assert handler.content == "first"
+
+
+def test_deltas_are_coalesced_by_bytes():
+    stream_function = MagicMock()
+    handler = StreamHandler(
+        stream_function=stream_function,
+        flush_policy=FlushPolicy(max_bytes=10, max_interval=0, flush_on_sentence_end=False),
+    )
+    for text in ["a", "bb", "ccc", "dddd", "e"]:
+        handler.on_text(text)
+    handler.flush()
+
+    assert [c.args[0] for c in stream_function.call_args_list] == ["abbcccdddd", "e"]
+
+
+def test_deltas_are_flushed_at_sentence_end():
+    events = []
+    handler = StreamHandler(
+        on_event=events.append,
+        flush_policy=FlushPolicy(max_bytes=1000, max_interval=0, flush_on_sentence_end=True),
+    )
+    for text in ["Hello", " world", ". ", "How", " are", " you?", " Fine"]:
+        handler.on_text(text)
+    handler.on_usage(prompt_tokens=1, completion_tokens=2)
+
+    assert [getattr(e, "text", None) for e in events] == [
+        "Hello world. ",
+        "How are you?",
+        " Fine",
+        None,
+    ]
+
+
+def test_deltas_are_flushed_by_interval():
+    stream_function = MagicMock()
+    handler = StreamHandler(
+        stream_function=stream_function,
+        flush_policy=FlushPolicy(max_bytes=1000, max_interval=0.05, flush_on_sentence_end=False),
+    )
+    handler.on_text("a")
+    sleep(0.06)
+    handler.on_text("b")
+    handler.on_text("c")
+    handler.close()
+
+    stream_function.assert_called_once_with("a")
+
+
+def test_buffered_text_is_flushed_by_timer_while_next_delta_is_awaited():
+    stream_function = MagicMock()
+    handler = StreamHandler(
+        stream_function=stream_function,
+        flush_policy=FlushPolicy(max_bytes=1000, max_interval=0.05, flush_on_sentence_end=False),
+    )
+    handler.on_text("a")
+    handler.on_text("b")
+    deadline = monotonic() + 5
+    while not stream_function.called and monotonic() < deadline:
+        sleep(0.01)
+    handler.close()
+
+    stream_function.assert_called_once_with("ab")
+
+
+def test_stream_metrics():
+    stream_function = MagicMock(side_effect=lambda text: sleep(0.01))
+    handler = StreamHandler(
+        stream_function=stream_function, flush_policy=FlushPolicy(max_bytes=0)
+    )
+    sleep(0.02)
+    for text in ["a", "b", "c"]:
+        handler.on_text(text)
+        sleep(0.01)
+    handler.on_usage(prompt_tokens=5, completion_tokens=40)
+    metrics = Metrics()
+    handler.update_metrics(metrics, completion_tokens=3)
+
+    assert metrics.time_to_first_token >= 20
+    assert metrics.inter_chunk_gap_p50 >= 20
+    assert metrics.inter_chunk_gap_p99 >= metrics.inter_chunk_gap_p50
+    # tokens reported by the provider are used
+    assert 0 < metrics.tokens_per_second <= 40 / 0.04
+    assert metrics.stream_function_time >= 30
+    assert metrics.check_connection_time == 0
+
+
+def test_stream_metrics_are_cleared_if_nothing_was_streamed():
+    metrics = Metrics(time_to_first_token=10, tokens_per_second=5)
+    StreamHandler().update_metrics(metrics)
+    assert metrics.time_to_first_token is None
+    assert metrics.tokens_per_second is None
+
+
+def test_get_percentile():
+    values = [5, 1, 3, 2, 4]
+    assert get_percentile(values, 50) == 3
+    assert get_percentile(values, 99) == 5
+    assert get_percentile([7], 0) == 7